@@ -0,0 +1,744 @@
+"""asyncio interface to FTP, with the same surface as ftptool.
+
+`AsyncFTPHost` and `AsyncFTPFileProxy` work like `ftptool.FTPHost` and
+`ftptool.FTPFileProxy`, except that their methods are coroutines, and that
+they talk FTP over asyncio streams rather than through ftplib, so that many
+connections can be served by one event loop.
+
+Only passive mode is supported. This module requires Python 3.7 or later.
+"""
+
+import io
+import os
+import asyncio
+import ftplib
+import posixpath
+from os import path
+
+import ftptool
+from ftptool import TransferStats
+
+# How much to read from or write to a data connection at a time.
+BLOCKSIZE = 65536
+
+class AsyncFTP(object):
+    """A connection to an FTP server over asyncio streams, offering those
+    parts of ftplib.FTP that ftptool needs, as coroutines.
+
+    Replies are handled like ftplib does, and so are errors: 4xx replies raise
+    ftplib.error_temp, 5xx ftplib.error_perm, and so on.
+
+    Only one command can be in progress at a time on a connection; `lock`
+    is held while one is.
+    """
+
+    encoding = "utf-8"
+
+    def __init__(self):
+        self.host = None
+        self.port = None
+        self.welcome = None
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    def __repr__(self):
+        return "<%s %s:%s>" % (self.__class__.__name__, self.host, self.port)
+
+    async def connect(self, host, port=21, timeout=None):
+        self.host = host
+        self.port = port
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout)
+        self.welcome = await self.getresp()
+        return self.welcome
+
+    async def login(self, user="anonymous", passwd="", acct=""):
+        if user == "anonymous" and passwd in ("", "-"):
+            passwd = passwd + "anonymous@"
+        resp = await self.sendcmd("USER " + user)
+        if resp[0] == "3":
+            resp = await self.sendcmd("PASS " + (passwd or ""))
+        if resp[0] == "3":
+            resp = await self.sendcmd("ACCT " + (acct or ""))
+        if resp[0] != "2":
+            raise ftplib.error_reply(resp)
+        return resp
+
+    async def putcmd(self, line):
+        if "\r" in line or "\n" in line:
+            raise ValueError("an illegal newline character should not be "
+                             "contained")
+        self.writer.write((line + "\r\n").encode(self.encoding))
+        await self.writer.drain()
+
+    async def getline(self):
+        line = await self.reader.readline()
+        if not line:
+            raise EOFError("connection closed")
+        return line.decode(self.encoding).rstrip("\r\n")
+
+    async def getmultiline(self):
+        line = await self.getline()
+        if line[3:4] == "-":
+            code = line[:3]
+            while True:
+                nextline = await self.getline()
+                line = line + "\n" + nextline
+                if nextline[:3] == code and nextline[3:4] != "-":
+                    break
+        return line
+
+    async def getresp(self):
+        resp = await self.getmultiline()
+        c = resp[:1]
+        if c in ("1", "2", "3"):
+            return resp
+        if c == "4":
+            raise ftplib.error_temp(resp)
+        if c == "5":
+            raise ftplib.error_perm(resp)
+        raise ftplib.error_proto(resp)
+
+    async def voidresp(self):
+        resp = await self.getresp()
+        if resp[:1] != "2":
+            raise ftplib.error_reply(resp)
+        return resp
+
+    async def sendcmd(self, cmd):
+        await self.putcmd(cmd)
+        return await self.getresp()
+
+    async def voidcmd(self, cmd):
+        await self.putcmd(cmd)
+        return await self.voidresp()
+
+    async def pwd(self):
+        return ftplib.parse257(await self.voidcmd("PWD"))
+
+    async def cwd(self, dirname):
+        return await self.voidcmd("CWD " + dirname)
+
+    async def size(self, filename):
+        resp = await self.sendcmd("SIZE " + filename)
+        if resp[:3] == "213":
+            return int(resp[3:].strip())
+
+    async def mkd(self, dirname):
+        return await self.voidcmd("MKD " + dirname)
+
+    async def rmd(self, dirname):
+        return await self.voidcmd("RMD " + dirname)
+
+    async def delete(self, filename):
+        return await self.voidcmd("DELE " + filename)
+
+    async def rename(self, fromname, toname):
+        resp = await self.sendcmd("RNFR " + fromname)
+        if resp[0] != "3":
+            raise ftplib.error_reply(resp)
+        return await self.voidcmd("RNTO " + toname)
+
+    async def transfercmd(self, cmd, rest=None):
+        """Open a passive data connection, send `cmd` and return the data
+        connection as a (reader, writer) pair.
+        """
+        peer = self.writer.get_extra_info("peername")
+        try:
+            host, port = ftplib.parse229(await self.sendcmd("EPSV"), peer)
+        except ftplib.error_perm:
+            host, port = ftplib.parse227(await self.sendcmd("PASV"))
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            if rest is not None:
+                await self.sendcmd("REST %s" % (rest,))
+            resp = await self.sendcmd(cmd)
+            # Some servers apparently send a 200 reply to a LIST or STOR
+            # command before the 150 reply, like ftplib says.
+            if resp[0] == "2":
+                resp = await self.getresp()
+            if resp[0] != "1":
+                raise ftplib.error_reply(resp)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def end_transfer(self, writer, completed):
+        """Close the data connection of `writer` and read the reply on the
+        transfer, like ftptool._end_transfer: if it wasn't `completed`, the
+        server's complaint is discarded.
+        """
+        writer.close()
+        if not completed:
+            try:
+                await self.voidresp()
+            except ftplib.Error:
+                pass
+            return
+        await writer.wait_closed()
+        await self.voidresp()
+
+    async def quit(self):
+        try:
+            return await self.voidcmd("QUIT")
+        finally:
+            self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+class AsyncFTPHost(object):
+    """Represent a connection to a remote host, like ftptool.FTPHost, but
+    with coroutine methods.
+    """
+
+    def __init__(self, ftp_obj):
+        """Initialize with an AsyncFTP instance. Use the classmethod connect
+        to create an actual connection and get an AsyncFTPHost instance.
+        """
+        self.ftp_obj = ftp_obj
+        self._connect_args = None
+        self._features = None
+        self._cwd = None
+        # Absolute paths of directories known to exist, for makedirs.
+        self._known_dirs = set()
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.ftp_obj)
+
+    @classmethod
+    async def connect(cls, host, port=21, user=None, password=None,
+                      account=None, ftp_client=AsyncFTP, timeout=None):
+        """Connect to host, using port, and login if user is given. See
+        ftptool.FTPHost.connect.
+        """
+        ftp_obj = ftp_client()
+        await ftp_obj.connect(host, port, timeout)
+        if user:
+            await ftp_obj.login(user, password, account)
+        self = cls(ftp_obj)
+        self._connect_args = dict(host=host, port=port, user=user,
+            password=password, account=account, ftp_client=ftp_client,
+            timeout=timeout)
+        return self
+
+    async def clone(self):
+        """Open a new connection to the same server, with the parameters this
+        host was connected with, and return it as a new host instance.
+        """
+        if self._connect_args is None:
+            raise ValueError("%r was not created by connect" % (self,))
+        host = await self.__class__.connect(**self._connect_args)
+        host._known_dirs = self._known_dirs
+        return host
+
+    async def features(self):
+        """Return the features the server advertises, as a dict. See
+        ftptool.FTPHost.features.
+        """
+        if self._features is None:
+            features = {}
+            try:
+                async with self.ftp_obj.lock:
+                    resp = await self.ftp_obj.sendcmd("FEAT")
+            except ftplib.error_perm:
+                pass
+            else:
+                for line in resp.splitlines()[1:-1]:
+                    name, _, params = line.strip().partition(" ")
+                    features[name.upper()] = params
+            self._features = features
+        return self._features
+
+    async def has_mlsd(self):
+        features = await self.features()
+        return "MLST" in features or "MLSD" in features
+
+    async def get_current_directory(self):
+        if self._cwd is None:
+            async with self.ftp_obj.lock:
+                self._cwd = await self.ftp_obj.pwd()
+        return self._cwd
+
+    async def set_current_directory(self, directory):
+        async with self.ftp_obj.lock:
+            await self.ftp_obj.cwd(directory)
+            self._cwd = await self.ftp_obj.pwd()
+
+    async def file_proxy(self, filename):
+        """Creates a file proxy object for filename. See AsyncFTPFileProxy."""
+        return AsyncFTPFileProxy(self.ftp_obj, await self._absolute(filename),
+                                 host=self)
+
+    async def _absolute(self, filename):
+        if posixpath.isabs(filename):
+            return filename
+        return posixpath.join(await self.get_current_directory(), filename)
+
+    async def mkdir(self, directory):
+        """Make directory."""
+        async with self.ftp_obj.lock:
+            await self.ftp_obj.mkd(directory)
+        if posixpath.isabs(directory) or self._cwd is not None:
+            ftptool._add_known_dir(self._known_dirs, posixpath.normpath(
+                await self._absolute(directory)))
+
+    async def rmdir(self, directory):
+        """Remove directory."""
+        async with self.ftp_obj.lock:
+            await self.ftp_obj.rmd(directory)
+        if posixpath.isabs(directory) or self._cwd is not None:
+            ftptool._discard_known_dirs(self._known_dirs, posixpath.normpath(
+                await self._absolute(directory)))
+
+    async def makedirs(self, dpath):
+        """Make sure directory `dpath` exists, creating whatever parts of it
+        don't. See ftptool.FTPHost.makedirs.
+        """
+        known = self._known_dirs
+        directory = posixpath.normpath(await self._absolute(dpath))
+        if directory in known or directory == "/":
+            return
+        try:
+            await self.mkdir(directory)
+        except ftplib.Error:
+            pass
+        else:
+            return
+        if await self._isdir(directory):
+            ftptool._add_known_dir(known, directory)
+            return
+        missing = [directory]
+        directory = posixpath.dirname(directory)
+        while directory not in known and directory != "/":
+            if await self._isdir(directory):
+                ftptool._add_known_dir(known, directory)
+                break
+            missing.append(directory)
+            directory = posixpath.dirname(directory)
+        for directory in reversed(missing):
+            try:
+                await self.mkdir(directory)
+            except ftplib.Error:
+                pass
+
+    async def _isdir(self, directory):
+        if "MLST" in await self.features():
+            try:
+                async with self.ftp_obj.lock:
+                    resp = await self.ftp_obj.sendcmd("MLST " + directory)
+            except ftplib.error_perm:
+                return False
+            return ftptool._mlst_is_dir(resp)
+        cwd = await self.get_current_directory()
+        async with self.ftp_obj.lock:
+            try:
+                await self.ftp_obj.cwd(directory)
+            except ftplib.error_perm:
+                return False
+            await self.ftp_obj.cwd(cwd)
+        return True
+
+    async def iterdir(self, directory):
+        """Yield an FTPEntry for each entry in `directory` as the listing
+        comes in, using MLSD if the server supports it and LIST if not.
+
+        The connection is busy until the listing is done, so don't use this
+        host for anything else while iterating.
+        """
+        directory = directory.rstrip("/") or directory
+        if await self.has_mlsd():
+            command, parse = "MLSD", ftptool._parse_mlsd_line
+        else:
+            command, parse = "LIST", ftptool._parse_list_entry
+        if directory:
+            command += " " + directory
+        ftp_obj = self.ftp_obj
+        async with ftp_obj.lock:
+            await ftp_obj.voidcmd("TYPE A")
+            reader, writer = await ftp_obj.transfercmd(command)
+            completed = False
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    line = line.decode(ftp_obj.encoding).rstrip("\r\n")
+                    entry = parse(line)
+                    if entry is not None:
+                        yield entry
+                completed = True
+            finally:
+                writer.close()
+                if completed:
+                    await ftp_obj.voidresp()
+                else:
+                    try:
+                        await ftp_obj.voidresp()
+                    except ftplib.Error:
+                        pass
+
+    async def listdir(self, directory, links=False, entries=False):
+        """Returns a two-tuple (dirs, files), or (dirs, files, links) if
+        `links` is True, of what's in `directory`. See
+        ftptool.FTPHost.listdir.
+        """
+        subdirs, files = [], []
+        dsts = {"dir": subdirs, "file": files, "link": [] if links else None}
+        async for entry in self.iterdir(directory):
+            dst = dsts[entry.type]
+            if dst is not None:
+                dst.append(entry if entries else entry.name)
+        if links:
+            return (subdirs, files, dsts["link"])
+        return (subdirs, files)
+
+    async def walk(self, directory, entries=False):
+        """Emulates os.walk, as an asynchronous generator. Remove entries from
+        the subdirectory list to not descend into them.
+        """
+        (subdirs, files) = await self.listdir(directory, entries=entries)
+        yield (directory, subdirs, files)
+        for subdir in subdirs:
+            if entries:
+                subdir = subdir.name
+            async for x in self.walk(posixpath.join(directory, subdir),
+                                     entries):
+                yield x
+
+    async def mirror_to_local(self, source, destination, workers=1,
+                              incremental=False, dry_run=False):
+        """Download remote directory found by source to destination, with up
+        to `workers` downloads in flight over connections of their own. See
+        ftptool.FTPHost.mirror_to_local.
+
+        Returns a ftptool.TransferStats for the run.
+        """
+        source = source.rstrip("/")
+        destination = destination.rstrip("/")
+        exact_mtime = await self.has_mlsd()
+        stats = TransferStats()
+        async with _Workers(self, workers, stats) as pool:
+            async for current_dir, subdirs, files in self.walk(source, True):
+                if source:
+                    current_destination = path.join(destination,
+                        current_dir[len(source) + 1:])
+                else:
+                    current_destination = path.join(destination, current_dir)
+                for subdir in subdirs:
+                    subdir_full = path.join(current_destination, subdir.name)
+                    if not dry_run and not path.exists(subdir_full):
+                        os.mkdir(subdir_full)
+                for entry in files:
+                    transfer = (posixpath.join(current_dir, entry.name),
+                                path.join(current_destination, entry.name),
+                                entry.size,
+                                entry.mtime if exact_mtime else None)
+                    await pool.put(_download_one, transfer, incremental,
+                                   dry_run)
+        stats.finish()
+        return stats
+
+    async def mirror_to_remote(self, source, destination,
+                               create_destination=False, ignore_dotfiles=True,
+                               workers=1, incremental=False, dry_run=False):
+        """Upload local directory `source` to remote destination
+        `destination`, with up to `workers` uploads in flight over
+        connections of their own. See ftptool.FTPHost.mirror_to_remote.
+
+        Returns a ftptool.TransferStats for the run.
+        """
+        source = source.rstrip("/")
+        destination = destination.rstrip("/")
+        if ignore_dotfiles and \
+                any(part.startswith(".") for part in destination.split("/")):
+            raise ValueError("cannot have a destination with dots when "
+                "ignore_dotfiles is True")
+        if create_destination and not dry_run:
+            try:
+                await self.makedirs(destination)
+            except ftplib.Error:
+                pass
+        stats = TransferStats()
+        directories, transfers = ftptool._mirror_to_remote_plan(source,
+            destination, ignore_dotfiles)
+        if not dry_run:
+            for directory in directories:
+                if posixpath.normpath(directory) in self._known_dirs:
+                    continue
+                try:
+                    await self.mkdir(directory)
+                except ftplib.Error:
+                    pass
+        async with _Workers(self, workers, stats) as pool:
+            for transfer in transfers:
+                await pool.put(_upload_one, transfer, incremental, dry_run)
+        stats.finish()
+        return stats
+
+    async def quit(self):
+        """Send quit command and close connection."""
+        async with self.ftp_obj.lock:
+            await self.ftp_obj.quit()
+
+    def close(self):
+        """Close connection ungracefully."""
+        self.ftp_obj.close()
+
+    async def try_quit(self):
+        """Attempt a quit, always close."""
+        try:
+            await self.quit()
+        except Exception:
+            self.close()
+
+class AsyncFTPFileProxy(object):
+    """Represent a file on a remote host, like ftptool.FTPFileProxy, but with
+    coroutine methods.
+    """
+
+    def __init__(self, ftp_obj, filename, host=None):
+        self.ftp_obj = ftp_obj
+        self.filename = filename
+        self.host = host
+
+    async def upload(self, fp, rest=None):
+        """Upload file from file-like object fp. If `rest` is given, append
+        to the remote file instead.
+        """
+        command = "APPE %s" if rest else "STOR %s"
+        ftp_obj = self.ftp_obj
+        async with ftp_obj.lock:
+            await ftp_obj.voidcmd("TYPE I")
+            reader, writer = await ftp_obj.transfercmd(
+                command % (self.filename,))
+            try:
+                while True:
+                    buf = fp.read(BLOCKSIZE)
+                    if not buf:
+                        break
+                    writer.write(buf)
+                    await writer.drain()
+            except Exception:
+                # The reply is still to be read, to keep the connection in
+                # step.
+                await ftp_obj.end_transfer(writer, False)
+                raise
+            finally:
+                writer.close()
+            await ftp_obj.end_transfer(writer, True)
+
+    async def upload_from_str(self, v):
+        """Upload file from contents in bytes v."""
+        await self.upload(io.BytesIO(v))
+
+    async def upload_from_file(self, filename, resume=False):
+        """Upload file from file identified by name filename, appending only
+        what's past the size of the remote file if `resume` is True.
+        """
+        offset = 0
+        if resume:
+            try:
+                offset = await self.size()
+            except ftplib.error_perm:
+                offset = 0
+            local_size = path.getsize(filename)
+            if offset == local_size:
+                return
+            elif offset > local_size:
+                offset = 0
+        with open(filename, "rb") as fp:
+            fp.seek(offset)
+            await self.upload(fp, rest=offset)
+
+    async def size(self):
+        """Return the size of the file in bytes, as told by SIZE."""
+        async with self.ftp_obj.lock:
+            await self.ftp_obj.voidcmd("TYPE I")
+            return await self.ftp_obj.size(self.filename)
+
+    async def mtime(self):
+        """Return the modification time of the file as a UNIX timestamp, as
+        told by MDTM.
+        """
+        async with self.ftp_obj.lock:
+            resp = await self.ftp_obj.voidcmd("MDTM " + self.filename)
+        return ftptool._parse_timeval(resp[4:])
+
+    async def download(self, fp, rest=None):
+        """Download file into file-like object fp, starting at offset `rest`
+        if given.
+        """
+        ftp_obj = self.ftp_obj
+        async with ftp_obj.lock:
+            await ftp_obj.voidcmd("TYPE I")
+            reader, writer = await ftp_obj.transfercmd(
+                "RETR %s" % (self.filename,), rest)
+            try:
+                while True:
+                    data = await reader.read(BLOCKSIZE)
+                    if not data:
+                        break
+                    fp.write(data)
+            except Exception:
+                await ftp_obj.end_transfer(writer, False)
+                raise
+            finally:
+                writer.close()
+            await ftp_obj.end_transfer(writer, True)
+
+    async def download_to_str(self):
+        """Download file and return its contents."""
+        fp = io.BytesIO()
+        await self.download(fp)
+        return fp.getvalue()
+
+    async def download_to_file(self, filename, resume=False):
+        """Download file into file identified by name filename, continuing
+        from the size of the local file if `resume` is True.
+        """
+        offset = 0
+        if resume and path.exists(filename):
+            offset = path.getsize(filename)
+            if offset:
+                size = await self.size()
+                if offset == size:
+                    return
+                elif offset > size:
+                    offset = 0
+        with open(filename, "ab" if offset else "wb") as fp:
+            await self.download(fp, rest=offset or None)
+
+    async def delete(self):
+        """Delete file."""
+        async with self.ftp_obj.lock:
+            await self.ftp_obj.delete(self.filename)
+
+    async def rename(self, new_name):
+        """Rename file to new_name, and return an instance of that file."""
+        new_abs_name = posixpath.join(posixpath.dirname(self.filename),
+                                      new_name)
+        async with self.ftp_obj.lock:
+            await self.ftp_obj.rename(self.filename, new_abs_name)
+        return self.__class__(self.ftp_obj, new_abs_name, host=self.host)
+
+class _Workers(object):
+    """Run up to `count` transfers at a time, each worker task with a
+    connection cloned from `host`, recording results into `stats`. With a
+    count of one, transfers run over `host` itself, and errors are raised.
+
+    Like ftptool's workers, a failed transfer costs the worker its connection
+    (unless the failure was a 5xx reply or an error with a local file), and
+    it reconnects for the next one.
+    """
+
+    def __init__(self, host, count, stats):
+        self.host = host
+        self.count = count
+        self.stats = stats
+        # The queue itself is unbounded, so that stopping the workers never
+        # waits; `slots` holds back transfers beyond two per worker.
+        self.queue = asyncio.Queue()
+        self.slots = asyncio.Semaphore(count * 2)
+        self.tasks = []
+
+    async def __aenter__(self):
+        if self.count > 1:
+            self.tasks = [asyncio.ensure_future(self._run())
+                          for i in range(self.count)]
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            # Leave whatever is queued; the error is what matters.
+            for task in self.tasks:
+                task.cancel()
+        else:
+            # Stop each worker once the queue is through.
+            for task in self.tasks:
+                self.queue.put_nowait(None)
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def put(self, func, transfer, incremental, dry_run):
+        if self.count > 1:
+            await self.slots.acquire()
+            self.queue.put_nowait((func, transfer, incremental, dry_run))
+        else:
+            result = await func(self.host, transfer, incremental, dry_run)
+            ftptool._record_transfer(self.stats, (transfer, result, None))
+
+    async def _run(self):
+        host = None
+        try:
+            while True:
+                job = await self.queue.get()
+                if job is None:
+                    break
+                self.slots.release()
+                func, transfer, incremental, dry_run = job
+                try:
+                    if host is None:
+                        host = await self.host.clone()
+                    result = await func(host, transfer, incremental, dry_run)
+                except Exception as e:
+                    ftptool._record_transfer(self.stats, (transfer, None, e))
+                    if host is not None and \
+                            not ftptool._keeps_connection(e):
+                        host.close()
+                        host = None
+                else:
+                    ftptool._record_transfer(self.stats,
+                                             (transfer, result, None))
+        finally:
+            if host is not None:
+                await host.try_quit()
+
+async def _download_one(host, transfer, incremental, dry_run):
+    remote_file, target_file, size, mtime = transfer
+    f = await host.file_proxy(remote_file)
+    if incremental:
+        if path.exists(target_file):
+            st = os.stat(target_file)
+            if size is None:
+                size = await f.size()
+            if size == st.st_size:
+                if mtime is None:
+                    mtime = await _remote_mtime(f)
+                if mtime is None or mtime == int(st.st_mtime):
+                    return ftptool._skipped
+    if dry_run:
+        return ftptool._pending
+    await f.download_to_file(target_file)
+    if incremental:
+        if mtime is None:
+            mtime = await _remote_mtime(f)
+        if mtime is not None:
+            os.utime(target_file, (mtime, mtime))
+    return path.getsize(target_file)
+
+async def _remote_mtime(f):
+    try:
+        return await f.mtime()
+    except ftplib.error_perm:
+        return None
+
+async def _upload_one(host, transfer, incremental, dry_run):
+    local_file, remote_file = transfer
+    f = await host.file_proxy(remote_file)
+    if incremental:
+        st = os.stat(local_file)
+        try:
+            unchanged = await f.size() == st.st_size and \
+                await f.mtime() >= int(st.st_mtime)
+        except ftplib.error_perm:
+            unchanged = False
+        if unchanged:
+            return ftptool._skipped
+    if dry_run:
+        return ftptool._pending
+    await f.upload_from_file(local_file)
+    return path.getsize(local_file)
@@ -0,0 +1,892 @@
+"""Benchmarks for ftptool, against a local FTP server run in-process.
+
+The server serves a temporary directory over localhost, and can be told to
+delay every reply (``--latency``) and to limit the bandwidth of each data
+connection (``--bandwidth``), to get closer to what a real server far away
+behaves like. Run ``python bench.py --help`` for the options.
+
+Results can be saved with ``--json`` and compared against an earlier run
+with ``--compare``, to see what a change did.
+"""
+
+import io
+import os
+import sys
+import json
+import stat
+import time
+import zlib
+import shutil
+import socket
+import zipfile
+import tempfile
+import argparse
+import platform
+import posixpath
+import threading
+from functools import partial
+
+import six
+from six.moves import socketserver
+
+import ftptool
+
+class FTPHandler(socketserver.StreamRequestHandler):
+    """Just enough of an FTP server for ftptool, passive mode only."""
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        socketserver.StreamRequestHandler.setup(self)
+        self.cwd = "/"
+        self.rest = 0
+        self.pasv = None
+        self.port = None
+        self.rename_from = None
+        self.copy_from = None
+        self.hash = "SHA-256"
+        self.mode = "S"
+        self.level = 6
+        # Compressing the data connection in MODE Z.
+        self.deflate = None
+
+    def reply(self, *lines):
+        # The lines of a multiline reply arrive together.
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.wfile.write("".join(line + "\r\n" for line in lines)
+                         .encode("latin-1"))
+        self.wfile.flush()
+
+    def real_path(self, name):
+        name = posixpath.normpath(posixpath.join(self.cwd, name or "."))
+        return os.path.join(self.server.root, name.lstrip("/"))
+
+    def handle(self):
+        self.reply("220 ftptool benchmark server ready.")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode("latin-1").rstrip("\r\n")
+            command, _, arg = line.partition(" ")
+            command = command.upper()
+            method = getattr(self, "do_" + command, None)
+            if method is None:
+                self.reply("502 Command not implemented.")
+                continue
+            try:
+                if method(arg) is False:
+                    return
+            except (OSError, IOError) as e:
+                self.reply("550 %s." % (e.strerror or e,))
+
+    def do_USER(self, arg):
+        self.reply("331 Any password will do.")
+
+    def do_PASS(self, arg):
+        self.reply("230 Logged in.")
+
+    def do_NOOP(self, arg):
+        self.reply("200 Zzz.")
+
+    def do_TYPE(self, arg):
+        self.reply("200 Type set to %s." % (arg,))
+
+    def do_QUIT(self, arg):
+        self.reply("221 Bye.")
+        return False
+
+    def do_FEAT(self, arg):
+        if not self.server.features:
+            return self.reply("502 Command not implemented.")
+        self.reply("211-Features:",
+                   *[" " + feature for feature in self.server.features] +
+                   ["211 End"])
+
+    def do_PWD(self, arg):
+        self.reply('257 "%s" is the current directory.' % (self.cwd,))
+
+    def do_CWD(self, arg):
+        name = posixpath.normpath(posixpath.join(self.cwd, arg))
+        if not os.path.isdir(self.real_path(name)):
+            return self.reply("550 No such directory.")
+        self.cwd = name
+        self.reply("250 OK.")
+
+    def do_MKD(self, arg):
+        os.mkdir(self.real_path(arg))
+        self.reply('257 "%s" created.' % (arg,))
+
+    def do_RMD(self, arg):
+        os.rmdir(self.real_path(arg))
+        self.reply("250 Removed.")
+
+    def do_DELE(self, arg):
+        os.remove(self.real_path(arg))
+        self.reply("250 Deleted.")
+
+    def do_RNFR(self, arg):
+        if not os.path.exists(self.real_path(arg)):
+            return self.reply("550 No such file.")
+        self.rename_from = self.real_path(arg)
+        self.reply("350 Go on.")
+
+    def do_RNTO(self, arg):
+        os.rename(self.rename_from, self.real_path(arg))
+        self.reply("250 Renamed.")
+
+    def do_SIZE(self, arg):
+        name = self.real_path(arg)
+        if not os.path.isfile(name):
+            return self.reply("550 Not a file.")
+        self.reply("213 %d" % (os.path.getsize(name),))
+
+    def do_MDTM(self, arg):
+        name = self.real_path(arg)
+        if not os.path.isfile(name):
+            return self.reply("550 Not a file.")
+        self.reply("213 " + time.strftime("%Y%m%d%H%M%S",
+            time.gmtime(os.path.getmtime(name))))
+
+    def do_MLST(self, arg):
+        name = self.real_path(arg)
+        st = os.stat(name)
+        self.reply("250-Listing " + arg,
+                   " " + _mlsd_line(arg, st).rstrip("\r\n"), "250 End.")
+
+    def do_OPTS(self, arg):
+        option, _, value = arg.partition(" ")
+        option, value = option.upper(), value.upper()
+        if option == "MODE" and value.startswith("Z LEVEL "):
+            self.level = int(value[8:])
+            return self.reply("200 MODE Z LEVEL set to %d." % (self.level,))
+        if option != "HASH" or value not in _hashes:
+            return self.reply("501 Unknown option.")
+        self.hash = value
+        self.reply("200 %s" % (self.hash,))
+
+    def do_MODE(self, arg):
+        if arg.upper() not in ("S", "Z"):
+            return self.reply("504 Unknown mode.")
+        self.mode = arg.upper()
+        self.reply("200 Mode set to %s." % (self.mode,))
+
+    def do_HASH(self, arg):
+        name = self.real_path(arg)
+        if not os.path.isfile(name):
+            return self.reply("550 Not a file.")
+        self.reply("213 %s 0-%d %s %s" % (self.hash, os.path.getsize(name),
+            _hash_file(name, self.hash), arg))
+
+    def do_XCRC(self, arg):
+        self.reply("250 " + _hash_file(self.real_path(arg), "CRC32").upper())
+
+    def do_XMD5(self, arg):
+        self.reply("251 " + _hash_file(self.real_path(arg), "MD5").upper())
+
+    def do_XSHA1(self, arg):
+        self.reply("250 " + _hash_file(self.real_path(arg), "SHA-1"))
+
+    def do_REST(self, arg):
+        self.rest = int(arg)
+        self.reply("350 Restarting at %d." % (self.rest,))
+
+    def _listen(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(1)
+        self.pasv = sock
+        return sock.getsockname()[1]
+
+    def do_PASV(self, arg):
+        port = self._listen()
+        self.reply("227 Entering Passive Mode (127,0,0,1,%d,%d)." % (
+            port >> 8, port & 0xff))
+
+    def do_EPSV(self, arg):
+        self.reply("229 Entering Extended Passive Mode (|||%d|)." % (
+            self._listen(),))
+
+    def do_PORT(self, arg):
+        numbers = arg.split(",")
+        self.port = (".".join(numbers[:4]),
+                     int(numbers[4]) << 8 | int(numbers[5]))
+        self.reply("200 PORT command successful.")
+
+    def do_EPRT(self, arg):
+        _, _, address, port, _ = arg.split(arg[0])
+        self.port = (address, int(port))
+        self.reply("200 EPRT command successful.")
+
+    def do_SITE(self, arg):
+        command, _, arg = arg.partition(" ")
+        command = command.upper()
+        if not self.server.site_copy or command not in ("CPFR", "CPTO"):
+            return self.reply("500 Unknown SITE command.")
+        if command == "CPFR":
+            if not os.path.isfile(self.real_path(arg)):
+                return self.reply("550 No such file.")
+            self.copy_from = self.real_path(arg)
+            return self.reply("350 File exists, ready for destination name.")
+        shutil.copyfile(self.copy_from, self.real_path(arg))
+        self.reply("250 Copy successful.")
+
+    def open_data(self):
+        if self.pasv is None and self.port is None:
+            self.reply("425 Use PASV or PORT first.")
+            return None
+        self.reply("150 Opening data connection.")
+        if self.port is not None:
+            conn = socket.create_connection(self.port)
+            self.port = None
+        else:
+            conn, _ = self.pasv.accept()
+            self.pasv.close()
+            self.pasv = None
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.mode == "Z":
+            self.deflate = zlib.compressobj(self.level)
+        return conn
+
+    def close_data(self, conn):
+        if self.deflate is not None:
+            self.send_data(conn, None)
+            self.deflate = None
+        conn.close()
+
+    def send_data(self, conn, data):
+        """Send `data`, or with MODE Z the end of the compressed stream if
+        None.
+        """
+        if self.deflate is not None:
+            if data is None:
+                data = self.deflate.flush()
+            else:
+                data = self.deflate.compress(data)
+        if not self.server.bandwidth:
+            conn.sendall(data)
+            return
+        for i in range(0, len(data), 16384):
+            block = data[i:i + 16384]
+            conn.sendall(block)
+            self.throttle(len(block))
+
+    def throttle(self, size):
+        """Wait for as long as `size` bytes take at the server bandwidth."""
+        time.sleep(float(size) / self.server.bandwidth)
+
+    def send_listing(self, arg, format):
+        if arg.startswith("-"):
+            arg = ""
+        directory = self.real_path(arg)
+        lines = []
+        for name in sorted(os.listdir(directory)):
+            lines.append(format(name, os.lstat(os.path.join(directory,
+                                                            name))))
+        conn = self.open_data()
+        if conn is None:
+            return
+        self.send_data(conn, "".join(lines).encode("latin-1"))
+        self.close_data(conn)
+        self.reply("226 Listing sent.")
+
+    def do_LIST(self, arg):
+        self.send_listing(arg, _list_line)
+
+    def do_MLSD(self, arg):
+        self.send_listing(arg, _mlsd_line)
+
+    def do_RETR(self, arg):
+        name = self.real_path(arg)
+        rest, self.rest = self.rest, 0
+        if not os.path.isfile(name):
+            return self.reply("550 No such file.")
+        fp = open(name, "rb")
+        try:
+            fp.seek(rest)
+            conn = self.open_data()
+            if conn is None:
+                return
+            try:
+                while True:
+                    data = fp.read(65536)
+                    if not data:
+                        break
+                    self.send_data(conn, data)
+                self.close_data(conn)
+            except socket.error:
+                conn.close()
+                return self.reply("426 Transfer aborted.")
+        finally:
+            fp.close()
+        self.reply("226 Transfer complete.")
+
+    def receive_file(self, arg, append):
+        name = self.real_path(arg)
+        rest, self.rest = self.rest, 0
+        if append:
+            fp = open(name, "ab")
+        elif rest:
+            fp = open(name, "r+b")
+            fp.seek(rest)
+            fp.truncate()
+        else:
+            fp = open(name, "wb")
+        try:
+            conn = self.open_data()
+            if conn is None:
+                return
+            inflate = None
+            if self.deflate is not None:
+                self.deflate, inflate = None, zlib.decompressobj()
+            bandwidth = self.server.bandwidth
+            while True:
+                data = conn.recv(16384 if bandwidth else 65536)
+                if not data:
+                    break
+                if bandwidth:
+                    self.throttle(len(data))
+                fp.write(data if inflate is None else
+                         inflate.decompress(data))
+            if inflate is not None:
+                fp.write(inflate.flush())
+            conn.close()
+        finally:
+            fp.close()
+        self.reply("226 Transfer complete.")
+
+    def do_STOR(self, arg):
+        self.receive_file(arg, False)
+
+    def do_APPE(self, arg):
+        self.receive_file(arg, True)
+
+def _list_line(name, st):
+    if stat.S_ISDIR(st.st_mode):
+        type = "d"
+    elif stat.S_ISLNK(st.st_mode):
+        type = "l"
+    else:
+        type = "-"
+    return "%srw-r--r--   1 ftp      ftp      %12d %s %s\r\n" % (type,
+        st.st_size, time.strftime("%b %d %H:%M", time.gmtime(st.st_mtime)),
+        name)
+
+def _mlsd_line(name, st):
+    return "type=%s;size=%d;modify=%s;unix.mode=0%o; %s\r\n" % (
+        "dir" if stat.S_ISDIR(st.st_mode) else "file", st.st_size,
+        time.strftime("%Y%m%d%H%M%S", time.gmtime(st.st_mtime)),
+        st.st_mode & 0o777, name)
+
+# Algorithms by their names in the HASH command.
+_hashes = dict((name, algorithm)
+               for (algorithm, name) in ftptool._hash_names.items())
+
+def _hash_file(filename, name):
+    hash = ftptool._new_hash(_hashes[name])
+    return ftptool._hash_file(filename, hash).hexdigest()
+
+default_features = ("MLST type*;size*;modify*;", "MLSD", "SIZE", "MDTM",
+                    "REST STREAM", "HASH SHA-256*;SHA-1;MD5;CRC32", "XCRC",
+                    "XMD5", "XSHA1", "MODE Z")
+
+class FTPServer(socketserver.ThreadingTCPServer):
+    """FTP server for the directory `root` on a free port of localhost, run
+    in a thread of its own.
+
+    Every reply is delayed by `latency` seconds, and data connections carry
+    at most `bandwidth` bytes per second either way if given. `features`
+    are advertised in reply to FEAT. Files are copied with SITE CPFR and
+    CPTO if `site_copy` is True.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, root, latency=0, bandwidth=0,
+                 features=default_features):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0),
+                                                 FTPHandler)
+        self.root = root
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.features = list(features)
+        self.site_copy = True
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+# {{{ benchmarks
+benchmarks = []
+
+def benchmark(func):
+    """Register `func(bench)` as a benchmark. It returns a dict of what it
+    moved, "files" and "bytes", or None.
+    """
+    benchmarks.append(func)
+    return func
+
+def make_tree(root, dirs, files, size):
+    """Create `dirs` directories under `root`, each with `files` files of
+    `size` bytes.
+    """
+    data = b"x" * size
+    for i in range(dirs):
+        directory = os.path.join(root, "dir%03d" % (i,))
+        os.makedirs(directory)
+        for j in range(files):
+            with open(os.path.join(directory, "file%04d" % (j,)), "wb") as fp:
+                fp.write(data)
+
+def make_file(filename, size):
+    chunk = os.urandom(1 << 20)
+    with open(filename, "wb") as fp:
+        while size > 0:
+            fp.write(chunk[:size])
+            size -= len(chunk)
+
+class Bench(object):
+    """What a benchmark gets to work with: a server with an empty directory
+    of its own, a local scratch directory, and the options.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.scale = options.scale
+        self.root = tempfile.mkdtemp(prefix="ftptool-bench-remote-")
+        self.local = tempfile.mkdtemp(prefix="ftptool-bench-local-")
+        features = default_features
+        if options.no_mlsd:
+            features = [f for f in features if not f.startswith("ML")]
+        self.server = FTPServer(self.root, options.latency / 1000.0,
+                                options.bandwidth * 1024, features).start()
+
+    def connect(self, **kwds):
+        return ftptool.FTPHost.connect("127.0.0.1", port=self.server.port,
+            user="bench", password="bench", **kwds)
+
+    def close(self):
+        self.server.stop()
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.local)
+
+@benchmark
+def listdir_large(bench):
+    """listdir of one directory with 5000 files."""
+    make_tree(bench.root, 1, 5000 * bench.scale, 0)
+    host = bench.connect()
+    def run():
+        host.listdir("/dir000")
+    yield run
+    host.try_quit()
+
+@benchmark
+def listdir_large_list(bench):
+    """listdir of one directory with 50000 files, with LIST."""
+    make_tree(bench.root, 1, 50000 * bench.scale, 0)
+    bench.server.features = [f for f in bench.server.features
+                             if not f.startswith("ML")]
+    host = bench.connect()
+    def run():
+        return {"files": len(host.listdir("/dir000")[1])}
+    yield run
+    host.try_quit()
+
+def _list_payload(count):
+    text = "".join("-rw-r--r--    1 ftp      ftp      %12d Feb 18  2009 "
+                   "file%06d\r\n" % (i, i) for i in range(count))
+    return text.encode("ascii")
+
+def _parse_list_lines(bench, entries):
+    payload = _list_payload(200000 * bench.scale)
+    def run():
+        # The way listdir used to go about it: ftplib reads line by line
+        # from the data connection and calls back for each.
+        files, subdirs = [], []
+        callback = partial(ftptool._parse_list_line, files=files,
+                           subdirs=subdirs, entries=entries)
+        if six.PY3:
+            fp = io.TextIOWrapper(io.BufferedReader(io.BytesIO(payload)),
+                                  encoding="latin-1")
+        else:
+            fp = io.BytesIO(payload)
+        while True:
+            line = fp.readline()
+            if not line:
+                break
+            callback(line.rstrip("\r\n"))
+        return {"files": len(files)}
+    yield run
+
+def _parse_list_text(bench, entries):
+    payload = _list_payload(200000 * bench.scale)
+    def run():
+        text = payload.decode("latin-1") if six.PY3 else payload
+        listing = ftptool._parse_list_text(text)
+        if entries:
+            return {"files": len(list(listing))}
+        return {"files": len(listing.names_of("file"))}
+    yield run
+
+@benchmark
+def parse_list_lines(bench):
+    """Parsing 200000 LIST lines one by one, names only."""
+    return _parse_list_lines(bench, False)
+
+@benchmark
+def parse_list_text(bench):
+    """Parsing 200000 LIST lines all at once, names only."""
+    return _parse_list_text(bench, False)
+
+@benchmark
+def parse_list_lines_entries(bench):
+    """Parsing 200000 LIST lines one by one into FTPEntry objects."""
+    return _parse_list_lines(bench, True)
+
+@benchmark
+def parse_list_text_entries(bench):
+    """Parsing 200000 LIST lines all at once into FTPEntry objects."""
+    return _parse_list_text(bench, True)
+
+def _walk(bench, workers):
+    make_tree(bench.root, 200 * bench.scale, 10, 0)
+    host = bench.connect()
+    def run():
+        for x in host.walk("/", workers=workers):
+            pass
+    yield run
+    host.try_quit()
+
+@benchmark
+def walk(bench):
+    """walk of 200 directories with 10 files each."""
+    return _walk(bench, 1)
+
+@benchmark
+def walk_4_workers(bench):
+    """walk of 200 directories, over 4 connections."""
+    return _walk(bench, 4)
+
+def _walk_changes(bench, skip_unchanged):
+    make_tree(bench.root, 200 * bench.scale, 10, 0)
+    host = bench.connect()
+    index = ftptool.TreeIndex(os.path.join(bench.local, "index.db"))
+    for x in host.walk_changes("/", index):
+        pass
+    def run():
+        for x in host.walk_changes("/", index, skip_unchanged):
+            pass
+    yield run
+    index.close()
+    host.try_quit()
+
+@benchmark
+def walk_changes(bench):
+    """walk_changes of 200 unchanged directories with 10 files each."""
+    return _walk_changes(bench, False)
+
+@benchmark
+def walk_changes_skip_unchanged(bench):
+    """walk_changes of 200 unchanged directories, skipping subtrees."""
+    return _walk_changes(bench, True)
+
+def _mirror_to_local(bench, workers):
+    make_tree(bench.root, 10, 50 * bench.scale, 1024)
+    host = bench.connect()
+    def run():
+        destination = tempfile.mkdtemp(dir=bench.local)
+        return host.mirror_to_local("/", destination, workers=workers)
+    yield run
+    host.try_quit()
+
+@benchmark
+def mirror_to_local_small(bench):
+    """mirror_to_local of 500 files of 1 KiB."""
+    return _mirror_to_local(bench, 1)
+
+@benchmark
+def mirror_to_local_small_4_workers(bench):
+    """mirror_to_local of 500 files of 1 KiB, over 4 connections."""
+    return _mirror_to_local(bench, 4)
+
+def _mirror_to_remote(bench, workers):
+    source = os.path.join(bench.local, "source")
+    make_tree(source, 10, 50 * bench.scale, 1024)
+    host = bench.connect()
+    runs = [0]
+    def run():
+        runs[0] += 1
+        destination = "/run%d" % (runs[0],)
+        return host.mirror_to_remote(source, destination, workers=workers,
+                                     create_destination=True)
+    yield run
+    host.try_quit()
+
+@benchmark
+def mirror_to_remote_small(bench):
+    """mirror_to_remote of 500 files of 1 KiB."""
+    return _mirror_to_remote(bench, 1)
+
+@benchmark
+def mirror_to_remote_small_4_workers(bench):
+    """mirror_to_remote of 500 files of 1 KiB, over 4 connections."""
+    return _mirror_to_remote(bench, 4)
+
+@benchmark
+def download_large(bench):
+    """download_to_file of one 64 MiB file."""
+    make_file(os.path.join(bench.root, "large"), (64 << 20) * bench.scale)
+    host = bench.connect()
+    target = os.path.join(bench.local, "large")
+    def run():
+        host.file_proxy("/large").download_to_file(target)
+        return {"files": 1, "bytes": os.path.getsize(target)}
+    yield run
+    host.try_quit()
+
+@benchmark
+def download_large_segmented(bench):
+    """download_segmented of one 64 MiB file, in 4 segments."""
+    make_file(os.path.join(bench.root, "large"), (64 << 20) * bench.scale)
+    host = bench.connect()
+    target = os.path.join(bench.local, "large")
+    def run():
+        host.file_proxy("/large").download_segmented(target, segments=4)
+        return {"files": 1, "bytes": os.path.getsize(target)}
+    yield run
+    host.try_quit()
+
+@benchmark
+def download_large_verify(bench):
+    """download_to_file of one 64 MiB file, verified by SHA-256."""
+    make_file(os.path.join(bench.root, "large"), (64 << 20) * bench.scale)
+    host = bench.connect()
+    target = os.path.join(bench.local, "large")
+    def run():
+        host.file_proxy("/large").download_to_file(target, verify=True)
+        return {"files": 1, "bytes": os.path.getsize(target)}
+    yield run
+    host.try_quit()
+
+@benchmark
+def zip_member(bench):
+    """Reading the last of 64 members of 1 MiB out of a remote zip file."""
+    chunk = os.urandom(1 << 20)
+    with zipfile.ZipFile(os.path.join(bench.root, "large.zip"), "w") as z:
+        for i in range(64 * bench.scale):
+            z.writestr("%04d" % (i,), chunk)
+    host = bench.connect()
+    def run():
+        fp = host.file_proxy("/large.zip").open()
+        with zipfile.ZipFile(fp) as z:
+            z.read(z.namelist()[-1])
+        return {"files": 1, "fetched": fp.bytes_fetched}
+    yield run
+    host.try_quit()
+
+@benchmark
+def copy_large_fxp(bench):
+    """copy of one 64 MiB file within the server, sent server to server."""
+    make_file(os.path.join(bench.root, "large"), (64 << 20) * bench.scale)
+    bench.server.site_copy = False
+    host = bench.connect()
+    def run():
+        host.file_proxy("/large").copy("/large.copy")
+        return {"files": 1,
+                "bytes": os.path.getsize(os.path.join(bench.root, "large"))}
+    yield run
+    host.try_quit()
+
+def make_text_file(filename, size):
+    """Write `size` bytes of something like a web server's access log."""
+    line = '10.0.%d.%d - - [16/Oct/2026:10:%02d:%02d +0000] "GET /files/%d ' \
+        'HTTP/1.1" 200 %d "-" "Mozilla/5.0"\n'
+    with open(filename, "wb") as fp:
+        i = 0
+        while size > 0:
+            data = "".join(line % (i % 256, i % 199, i % 60, i % 59, i % 997,
+                                   i * 7 % 100000)
+                           for i in range(i, i + 1000)).encode("ascii")
+            fp.write(data[:size])
+            size -= len(data)
+            i += 1000
+
+def _download_text(bench, compression):
+    make_text_file(os.path.join(bench.root, "access.log"),
+                   (32 << 20) * bench.scale)
+    host = bench.connect(compression=compression)
+    target = os.path.join(bench.local, "access.log")
+    def run():
+        host.file_proxy("/access.log").download_to_file(target)
+        return {"files": 1, "bytes": os.path.getsize(target)}
+    yield run
+    host.try_quit()
+
+@benchmark
+def download_text(bench):
+    """download_to_file of one 32 MiB log file."""
+    return _download_text(bench, None)
+
+@benchmark
+def download_text_mode_z(bench):
+    """download_to_file of one 32 MiB log file, compressed with MODE Z."""
+    return _download_text(bench, 1)
+
+@benchmark
+def upload_large(bench):
+    """upload_from_file of one 64 MiB file."""
+    source = os.path.join(bench.local, "large")
+    make_file(source, (64 << 20) * bench.scale)
+    host = bench.connect()
+    def run():
+        host.file_proxy("/large").upload_from_file(source)
+        return {"files": 1, "bytes": os.path.getsize(source)}
+    yield run
+    host.try_quit()
+
+@benchmark
+def upload_large_verify(bench):
+    """upload_from_file of one 64 MiB file, verified by SHA-256."""
+    source = os.path.join(bench.local, "large")
+    make_file(source, (64 << 20) * bench.scale)
+    host = bench.connect()
+    def run():
+        host.file_proxy("/large").upload_from_file(source, verify=True)
+        return {"files": 1, "bytes": os.path.getsize(source)}
+    yield run
+    host.try_quit()
+# }}}
+
+# CPU time of the calling thread, leaving out the server's threads, where
+# there's such a clock.
+_thread_time = getattr(time, "thread_time", None)
+
+def run_benchmark(func, options):
+    """Run benchmark `func` `options.repeat` times, and return a dict with
+    the fastest time, the least CPU time spent by ftptool if that can be
+    told, and what was moved.
+    """
+    bench = Bench(options)
+    try:
+        steps = func(bench)
+        run = next(steps)
+        times = []
+        cpu_times = []
+        moved = None
+        for i in range(options.repeat):
+            started = time.time()
+            if _thread_time is not None:
+                cpu_started = _thread_time()
+            result = run()
+            times.append(time.time() - started)
+            if _thread_time is not None:
+                cpu_times.append(_thread_time() - cpu_started)
+            if isinstance(result, ftptool.TransferStats):
+                if result.errors:
+                    raise result.errors[0][1]
+                result = {"files": result.files, "bytes": result.bytes}
+            moved = result or moved
+        for x in steps:
+            pass
+    finally:
+        bench.close()
+    result = {"seconds": min(times), "times": times}
+    if cpu_times:
+        result["cpu_seconds"] = min(cpu_times)
+    if moved:
+        result.update(moved)
+    return result
+
+def format_result(name, result, baseline=None):
+    line = "%-34s %9.3fs" % (name, result["seconds"])
+    if result.get("files", 0) > 1:
+        line += " %10.1f files/s" % (result["files"] / result["seconds"],)
+    elif result.get("bytes"):
+        line += " %10.1f MiB/s" % (
+            result["bytes"] / result["seconds"] / (1 << 20),)
+    else:
+        line += " " * 17
+    if result.get("files", 0) <= 1 and result.get("bytes") and \
+            "cpu_seconds" in result:
+        line += " %6.2f CPU s/GiB" % (
+            result["cpu_seconds"] / result["bytes"] * (1 << 30),)
+    elif baseline is not None:
+        line += " " * 17
+    if baseline is not None:
+        line += "  %+6.1f%%" % (
+            (result["seconds"] / baseline["seconds"] - 1) * 100,)
+    return line
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("names", nargs="*", metavar="NAME",
+        help="benchmarks to run (default: all)")
+    parser.add_argument("--latency", type=float, default=0,
+        help="milliseconds to delay each reply by")
+    parser.add_argument("--bandwidth", type=float, default=0,
+        help="KiB/s each data connection may send at most")
+    parser.add_argument("--scale", type=int, default=1,
+        help="multiply the number of files and the file sizes by this")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="runs of each benchmark; the fastest counts")
+    parser.add_argument("--no-mlsd", action="store_true",
+        help="don't advertise MLST/MLSD, so LIST is used")
+    parser.add_argument("--json", metavar="FILE",
+        help="save results to FILE")
+    parser.add_argument("--compare", metavar="FILE",
+        help="compare with results saved with --json earlier")
+    parser.add_argument("--list", action="store_true",
+        help="list the benchmarks and exit")
+    options = parser.parse_args(argv)
+
+    if options.list:
+        for func in benchmarks:
+            print("%-34s %s" % (func.__name__, func.__doc__))
+        return 0
+    selected = [func for func in benchmarks
+                if not options.names or func.__name__ in options.names]
+    unknown = set(options.names) - set(f.__name__ for f in benchmarks)
+    if unknown:
+        parser.error("unknown benchmarks: " + ", ".join(sorted(unknown)))
+    baseline = {}
+    if options.compare:
+        with open(options.compare) as fp:
+            baseline = json.load(fp)["results"]
+
+    print("ftptool benchmarks, Python %s, latency %gms, bandwidth %s" % (
+        platform.python_version(), options.latency,
+        "%g KiB/s" % options.bandwidth if options.bandwidth else "unlimited"))
+    results = {}
+    for func in selected:
+        name = func.__name__
+        results[name] = result = run_benchmark(func, options)
+        print(format_result(name, result, baseline.get(name)))
+        sys.stdout.flush()
+
+    if options.json:
+        report = {"python": platform.python_version(),
+                  "platform": platform.platform(),
+                  "options": {"latency": options.latency,
+                              "bandwidth": options.bandwidth,
+                              "scale": options.scale,
+                              "repeat": options.repeat,
+                              "no_mlsd": options.no_mlsd},
+                  "results": results}
+        with open(options.json, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,173 @@
+import io
 import os
+import re
+import errno
+import stat
+import time
+import zlib
+import heapq
+import mmap
+import hashlib
+import itertools
+import calendar
 import posixpath
 import socket
 import ftplib
+import sqlite3
+import threading
 from os import path
 from functools import partial
+from collections import OrderedDict, deque
 
 import six
+from six.moves import queue
 
-def _parse_list_line(line, files=[], subdirs=[], links=None):
+class FTPEntry(object):
+    """An entry in a directory listing.
+
+    `type` is one of "file", "dir" or "link", `size` is in bytes, `mtime` is
+    a UNIX timestamp, `mode` the permission bits as an integer, `target` what
+    a link points to, and `unique` the server's unique identifier for the
+    file (from MLSD listings only). Any of the latter may be None when the
+    listing didn't say.
+    """
+
+    __slots__ = ("name", "type", "size", "mtime", "mode", "target", "unique")
+
+    def __init__(self, name, type, size=None, mtime=None, mode=None,
+                 target=None, unique=None):
+        self.name = name
+        self.type = type
+        self.size = size
+        self.mtime = mtime
+        self.mode = mode
+        self.target = target
+        self.unique = unique
+
+    def __repr__(self):
+        return "%s(%r, %r, size=%r, mtime=%r, mode=%r, target=%r, " \
+            "unique=%r)" % (self.__class__.__name__, self.name, self.type,
+            self.size, self.mtime, self.mode, self.target, self.unique)
+
+    def __eq__(self, other):
+        if not isinstance(other, FTPEntry):
+            return NotImplemented
+        return all(getattr(self, a) == getattr(other, a)
+                   for a in self.__slots__)
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+_list_types = {"-": "file", "d": "dir", "l": "link"}
+_months = dict((m, i + 1) for (i, m) in enumerate(("Jan", "Feb", "Mar",
+    "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")))
+
+def _parse_list_mode(perms):
+    """Parse the nine permission characters of an ls-style listing, like
+    "rwsr-xr-x", into mode bits.
+    """
+    mode = 0
+    for (i, c) in enumerate(perms[:9]):
+        bit = 1 << (8 - i)
+        if c in "rwxst":
+            mode |= bit
+        if c in "sS":
+            # setuid or setgid, depending on whether it's the owner or group
+            # triplet.
+            mode |= 0o4000 if i == 2 else 0o2000
+        elif c in "tT":
+            mode |= 0o1000
+    return mode
+
+def _parse_list_mtime(month, day, time_or_year, now=None):
+    """Parse the date columns of an ls-style listing into a UNIX timestamp,
+    taking the time as UTC. Return None if the date can't be understood.
+
+    Recent files have a time but no year; those are assumed to be at most a
+    day or so into the future, as ls does.
+    """
+    try:
+        month = _months[month.capitalize()]
+        day = int(day)
+        if ":" in time_or_year:
+            hour, minute = map(int, time_or_year.split(":"))
+            if now is None:
+                now = time.time()
+            year = time.gmtime(now).tm_year
+            ts = calendar.timegm((year, month, day, hour, minute, 0, 0, 0, 0))
+            if ts > now + 86400:
+                ts = calendar.timegm((year - 1, month, day, hour, minute,
+                                      0, 0, 0, 0))
+            return ts
+        else:
+            return calendar.timegm((int(time_or_year), month, day,
+                                    0, 0, 0, 0, 0, 0))
+    except (KeyError, ValueError):
+        return None
+
+def _parse_list_entry(line):
+    """Parse an ls-style listing line into an FTPEntry."""
+    parts = line.split(None, 8)
+    perms, name = parts[0], parts[-1]
+    if perms[:1] not in _list_types:
+        raise ValueError("unknown line type %r" % line[:1])
+    type = _list_types[perms[:1]]
+    target = None
+    if type == "link" and " -> " in name:
+        name, target = name.split(" -> ", 1)
+    try:
+        size = int(parts[4])
+    except (IndexError, ValueError):
+        size = None
+    mtime = None
+    if len(parts) == 9:
+        mtime = _parse_list_mtime(*parts[5:8])
+    return FTPEntry(name, type, size, mtime, _parse_list_mode(perms[1:]),
+                    target)
+
+def _parse_mlsd_line(line):
+    """Parse a line of an MLSD listing into an FTPEntry. Return None for the
+    entries for the directory itself and its parent, and for types other than
+    files, directories and links.
+    """
+    facts, _, name = line.partition(" ")
+    entry = FTPEntry(name, None)
+    for fact in facts.split(";"):
+        key, _, value = fact.partition("=")
+        key = key.lower()
+        if key == "type":
+            value = value.lower()
+            if value in ("file", "dir"):
+                entry.type = value
+            elif value.startswith("os.unix=slink") or \
+                    value == "os.unix=symlink":
+                entry.type = "link"
+                # The target has the case it had, which we lost above.
+                target = fact.partition(":")[2]
+                entry.target = target or None
+            else:
+                return None
+        elif key in ("size", "sizd"):
+            entry.size = int(value)
+        elif key == "modify":
+            entry.mtime = _parse_timeval(value)
+        elif key == "unix.mode":
+            entry.mode = int(value, 8)
+        elif key == "unique":
+            entry.unique = value
+    if entry.type is None:
+        return None
+    return entry
+
+def _parse_list_line(line, files=[], subdirs=[], links=None, entries=False):
     """Parse *line* and insert into either *files* or *subdirs* depending on
     whether the line is for a directory or not.
 
+    If *entries* is true, an FTPEntry is inserted rather than the name.
+
     This is used as the callback to the ftplib.FTPConnection.dir callback.
     """
     dst = None
@@ -25,10 +182,960 @@ def _parse_list_line(line, files=[], subdirs=[], links=None):
     # No dst set for this type: ignore.
     if dst is None:
         return
+    if entries:
+        dst.append(_parse_list_entry(line))
+        return
     parts = line.split(None, 8)
     stat, name = parts[0], parts[-1]
     dst.append(name)
 
+# An ls-style line of a file, directory or link: type and permissions, link
+# count, owner, group, size, date in three columns and name. Lines that don't
+# look like this are left to _parse_list_entry.
+_list_line_re = re.compile(r"^([-dl]\S*)[ \t]+\S+[ \t]+\S+[ \t]+\S+[ \t]+(\d+)"
+    r"[ \t]+(\S+)[ \t]+(\S+)[ \t]+(\S+)[ \t]+([^\r\n]*)", re.M)
+
+class FTPListing(object):
+    """A directory listing kept as columns, which takes much less time and
+    memory than an FTPEntry for each entry when directories are big.
+
+    `names`, `types`, `sizes` and `targets` are lists with an item for each
+    entry, as in FTPEntry. Iterating gives FTPEntry objects, with modification
+    time and mode worked out too.
+    """
+
+    __slots__ = ("names", "types", "_sizes", "targets", "_modes", "_mtimes",
+                 "_dates")
+
+    def __init__(self):
+        self.names = []
+        self.types = []
+        self._sizes = []
+        self.targets = []
+        # The permission columns (type included) and tuples of the date
+        # columns of LIST entries, parsed when asked for, or the mode bits
+        # and timestamps themselves. Until needed, the date columns may be
+        # kept in `_dates` as three lists instead.
+        self._modes = []
+        self._mtimes = []
+        self._dates = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def _get_sizes(self):
+        # Sizes from LIST are kept as text until needed.
+        if self._sizes and isinstance(self._sizes[0], six.string_types):
+            self._sizes = list(map(int, self._sizes))
+        return self._sizes
+
+    def _set_sizes(self, sizes):
+        self._sizes = sizes
+
+    sizes = property(_get_sizes, _set_sizes)
+
+    def _unpack_dates(self):
+        if self._dates is not None:
+            self._mtimes = list(zip(*self._dates))
+            self._dates = None
+
+    def __iter__(self):
+        self._unpack_dates()
+        sizes = self.sizes
+        now = time.time()
+        # Most entries share their permissions and dates with others.
+        modes, mtimes = {}, {}
+        for i in range(len(self.names)):
+            mode, mtime = self._modes[i], self._mtimes[i]
+            if isinstance(mode, str):
+                if mode not in modes:
+                    modes[mode] = _parse_list_mode(mode[1:])
+                mode = modes[mode]
+            if isinstance(mtime, tuple):
+                if mtime not in mtimes:
+                    mtimes[mtime] = _parse_list_mtime(*(mtime + (now,)))
+                mtime = mtimes[mtime]
+            yield FTPEntry(self.names[i], self.types[i], sizes[i],
+                           mtime, mode, self.targets[i])
+
+    def append(self, entry):
+        """Add FTPEntry `entry`."""
+        self._unpack_dates()
+        self.names.append(entry.name)
+        self.types.append(entry.type)
+        self.sizes.append(entry.size)
+        self.targets.append(entry.target)
+        self._modes.append(entry.mode)
+        self._mtimes.append(entry.mtime)
+
+    def names_of(self, type):
+        """The names of the entries of `type`, "file", "dir" or "link"."""
+        return [name for (name, t) in zip(self.names, self.types)
+                if t == type]
+
+def _parse_list_text(text):
+    """Parse a whole ls-style listing `text` into an FTPListing.
+
+    When every line has the usual nine columns, which is when no name has
+    whitespace in it, the whole text is split at once and the columns sliced
+    out of that. Otherwise the lines are picked out with one regular
+    expression over all of the text. Either way, no line is looked at by
+    itself in Python, unless some don't look like expected.
+    """
+    lines = text.count("\n")
+    if text and not text.endswith("\n"):
+        lines += 1
+    listing = FTPListing()
+    if not lines:
+        return listing
+    tokens = text.split()
+    if len(tokens) == 9 * lines:
+        perms, sizes = tokens[0::9], tokens[4::9]
+        dates = (tokens[5::9], tokens[6::9], tokens[7::9])
+        names = tokens[8::9]
+        # Make sure the columns really line up.
+        if not ("".join(tokens[1::9]) + "".join(sizes)).isdigit():
+            perms = None
+    else:
+        perms = None
+    if perms is None:
+        matches = _list_line_re.findall(text)
+        if len(matches) != lines:
+            return _parse_list_mixed(text)
+        perms, sizes, months, days, times, names = map(list, zip(*matches))
+        dates = (months, days, times)
+    try:
+        listing.types = types = [_list_types[p[0]] for p in perms]
+    except KeyError:
+        return _parse_list_mixed(text)
+    listing.names = names
+    listing.sizes = sizes
+    listing.targets = targets = [None] * lines
+    listing._modes = perms
+    listing._dates = dates
+    if "link" in types:
+        for (i, type) in enumerate(types):
+            if type == "link" and " -> " in names[i]:
+                names[i], targets[i] = names[i].split(" -> ", 1)
+    return listing
+
+def _parse_list_mixed(text):
+    """Parse ls-style listing `text` like _parse_list_text, for when not all
+    lines have nine columns. The lines are picked out with a regular
+    expression, and those it doesn't match are parsed by _parse_list_entry.
+    """
+    listing = FTPListing()
+    pos = 0
+    for m in _list_line_re.finditer(text):
+        if m.start() > pos:
+            _parse_list_lines(text[pos:m.start()], listing)
+        pos = m.end()
+        perms, size, month, day, time_or_year, name = m.groups()
+        type = _list_types[perms[0]]
+        target = None
+        if type == "link" and " -> " in name:
+            name, target = name.split(" -> ", 1)
+        listing.names.append(name)
+        listing.types.append(type)
+        listing.sizes.append(int(size))
+        listing.targets.append(target)
+        listing._modes.append(perms)
+        listing._mtimes.append((month, day, time_or_year))
+    if pos < len(text):
+        _parse_list_lines(text[pos:], listing)
+    return listing
+
+def _parse_list_lines(text, listing):
+    for line in text.splitlines():
+        if line.strip():
+            listing.append(_parse_list_entry(line))
+
+def _parse_timeval(value):
+    """Parse an RFC 3659 time-val, YYYYMMDDHHMMSS in UTC with optional
+    fractions of a second, into an integer UNIX timestamp.
+    """
+    value = value.strip()
+    # Not time.strptime, which isn't safe to call first from threads.
+    return calendar.timegm((int(value[0:4]), int(value[4:6]),
+        int(value[6:8]), int(value[8:10]), int(value[10:12]),
+        int(value[12:14]), 0, 0, 0))
+
+class TransferStats(object):
+    """Aggregate figures for a batch of transfers, such as a mirror run.
+
+    `errors` is a list of two-tuples (name, exception) for every transfer that
+    failed, `skipped` counts files left alone because they were unchanged, and
+    `pending` lists the (source, destination) transfers a dry run found would
+    be made.
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.errors = []
+        self.skipped = 0
+        self.pending = []
+        self.started = time.time()
+        self.finished = None
+
+    def __str__(self):
+        return "%d files, %d bytes in %.2fs (%.1f KiB/s), %d errors" % (
+            self.files, self.bytes, self.elapsed, self.throughput / 1024.0,
+            len(self.errors))
+
+    def add(self, nbytes):
+        """Record one successfully transferred file of `nbytes` bytes."""
+        self.files += 1
+        self.bytes += nbytes
+
+    def add_skipped(self):
+        """Record one file skipped because it was unchanged."""
+        self.skipped += 1
+
+    def add_pending(self, transfer):
+        """Record that a dry run would have made `transfer`."""
+        self.pending.append(transfer)
+
+    def add_error(self, name, exc):
+        """Record that transferring `name` failed with `exc`."""
+        self.errors.append((name, exc))
+
+    def finish(self):
+        self.finished = time.time()
+
+    @property
+    def elapsed(self):
+        """Seconds from start to finish (or to now, if not finished.)"""
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def throughput(self):
+        """Average bytes per second."""
+        elapsed = self.elapsed
+        if not elapsed:
+            return 0.0
+        return self.bytes / elapsed
+
+_stop_worker = object()
+
+class _Workers(object):
+    """Run `func(host, item)` for each submitted item in `count` threads, each
+    of them with a connection of its own obtained by calling `connect`.
+
+    A failure only takes down the connection it happened on: the item is
+    reported as failed, the connection is dropped, and the thread connects
+    anew for its next item. Permanent errors (5xx replies) and errors with
+    local files leave the connection be, as there is nothing wrong with it.
+
+    Connections are handed back by calling `release(host, broken)`, by
+    default closing them.
+
+    Results are three-tuples (item, result, exception) read with `get`.
+    """
+
+    def __init__(self, connect, func, count, queue_size=None, release=None):
+        self.connect = connect
+        self.release = release or _close_host
+        self.func = func
+        self.jobs = queue.Queue(queue_size or count * 2)
+        self.results = queue.Queue()
+        self.threads = []
+        for i in range(count):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _run(self):
+        host = None
+        try:
+            while True:
+                item = self.jobs.get()
+                if item is _stop_worker:
+                    break
+                try:
+                    if host is None:
+                        host = self.connect()
+                    result = self.func(host, item)
+                except Exception as e:
+                    self.results.put((item, None, e))
+                    if host is not None and not _keeps_connection(e):
+                        self.release(host, True)
+                        host = None
+                else:
+                    self.results.put((item, result, None))
+        finally:
+            if host is not None:
+                self.release(host, False)
+
+    def put(self, item):
+        """Queue `item`, blocking while the queue is full."""
+        self.jobs.put(item)
+
+    def get(self, block=True):
+        return self.results.get(block)
+
+    def close(self, discard=False):
+        """Stop all threads once the queue is drained, and wait for them. If
+        `discard` is True, items not yet started on are dropped instead.
+        """
+        if discard:
+            try:
+                while True:
+                    self.jobs.get(block=False)
+            except queue.Empty:
+                pass
+        for thread in self.threads:
+            self.jobs.put(_stop_worker)
+        for thread in self.threads:
+            thread.join()
+
+def _close_host(host, broken=False):
+    if broken:
+        host.close()
+    else:
+        host.try_quit()
+
+class ListingCache(object):
+    """Directory listings kept for reuse, keyed by absolute path.
+
+    A listing is used for at most `ttl` seconds, and at most `max_entries`
+    directories are kept, the least recently used going first. It's safe to
+    share between connections to the same server, in several threads.
+
+    The counters `hits`, `misses` and `evictions` tell how many lookups found
+    a listing, how many didn't, and how many listings were pushed out to make
+    room.
+    """
+
+    def __init__(self, ttl=60, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Maps paths to two-tuples (time listed, entries), least recently
+        # used first.
+        self._listings = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._listings)
+
+    def __str__(self):
+        return "<%s %d listings, %d hits, %d misses>" % (
+            self.__class__.__name__, len(self), self.hits, self.misses)
+
+    @property
+    def hit_rate(self):
+        """The share of lookups served from the cache."""
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return float(self.hits) / total
+
+    def get(self, directory):
+        """Return the list of FTPEntry objects for `directory`, or None if it
+        isn't cached or has expired.
+        """
+        with self._lock:
+            listing = self._listings.pop(directory, None)
+            if listing is None or time.time() - listing[0] > self.ttl:
+                self.misses += 1
+                return None
+            self._listings[directory] = listing
+            self.hits += 1
+            return listing[1]
+
+    def put(self, directory, entries):
+        """Cache the list of FTPEntry objects `entries` for `directory`."""
+        with self._lock:
+            self._listings.pop(directory, None)
+            self._listings[directory] = (time.time(), entries)
+            while len(self._listings) > self.max_entries:
+                self._listings.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, directory, recursive=False):
+        """Forget the listing of `directory`, and those of all directories
+        below it if `recursive` is True.
+        """
+        prefix = directory.rstrip("/") + "/"
+        with self._lock:
+            self._listings.pop(directory, None)
+            if recursive:
+                for key in list(self._listings):
+                    if key.startswith(prefix):
+                        del self._listings[key]
+
+    def clear(self):
+        """Forget all listings."""
+        with self._lock:
+            self._listings.clear()
+
+class TreeIndex(object):
+    """The listings of a remote tree as of the last FTPHost.walk_changes,
+    with the modification times of the directories, kept in the sqlite
+    database `filename` to carry over to the next run.
+
+    Directories are keyed by absolute path. Don't share an index between
+    walks going on at the same time.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        if six.PY2:
+            # Names are whatever bytes the server sent.
+            self._db.text_factory = str
+        self._db.execute("CREATE TABLE IF NOT EXISTS dirs "
+                         "(path TEXT PRIMARY KEY, mtime REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries "
+                         "(dir TEXT NOT NULL, name TEXT NOT NULL, type TEXT, "
+                         "size INTEGER, mtime REAL, mode INTEGER, "
+                         "target TEXT, uniq TEXT, PRIMARY KEY (dir, name))")
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM dirs").fetchone()[0]
+
+    def __str__(self):
+        return "<%s %r, %d directories>" % (self.__class__.__name__,
+                                            self.filename, len(self))
+
+    def get(self, directory):
+        """Return a two-tuple (mtime, entries) of what is known of
+        `directory`, with a list of FTPEntry objects, or None if nothing is.
+        The time is None if the directory's subtree wasn't walked through.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT mtime FROM dirs WHERE path = ?",
+                                   (directory,)).fetchone()
+            if row is None:
+                return None
+            rows = self._db.execute(
+                "SELECT name, type, size, mtime, mode, target, uniq "
+                "FROM entries WHERE dir = ? ORDER BY name", (directory,))
+            return (row[0], [FTPEntry(*r) for r in rows])
+
+    def put(self, directory, mtime, entries):
+        """Record the FTPEntry objects `entries` as the listing of
+        `directory`, modified at `mtime`.
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM entries WHERE dir = ?",
+                             (directory,))
+            self._db.executemany("INSERT OR REPLACE INTO entries "
+                                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(directory, e.name, e.type, e.size, e.mtime, e.mode,
+                  e.target, e.unique) for e in entries])
+            self._db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)",
+                             (directory, mtime))
+
+    def set_mtime(self, directory, mtime):
+        """Record that `directory` was modified at `mtime`."""
+        with self._lock:
+            self._db.execute("UPDATE dirs SET mtime = ? WHERE path = ?",
+                             (mtime, directory))
+
+    def remove(self, directory):
+        """Forget `directory` and everything below it."""
+        prefix = directory.rstrip("/") + "/"
+        with self._lock:
+            for table, column in (("dirs", "path"), ("entries", "dir")):
+                self._db.execute("DELETE FROM %s WHERE %s = ? OR "
+                                 "substr(%s, 1, ?) = ?" % (table, column,
+                                                           column),
+                                 (directory, len(prefix), prefix))
+
+    def commit(self):
+        """Write the changes so far to disk."""
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        """Write the changes to disk and close the database."""
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+class MirrorJournal(object):
+    """Record of the files and directories a mirror run is done with, kept
+    in the sqlite database `filename`, for a run that was broken off to
+    resume where it left off; see FTPHost.mirror_to_local.
+
+    Records go to disk `batch_size` at a time, so a crash costs at most that
+    many files transferred again. Don't share a journal between runs going
+    on at the same time.
+    """
+
+    def __init__(self, filename, batch_size=100):
+        self.filename = filename
+        self.batch_size = batch_size
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        if six.PY2:
+            self._db.text_factory = str
+        self._db.execute("CREATE TABLE IF NOT EXISTS done "
+                         "(name TEXT PRIMARY KEY)")
+        self._db.commit()
+        self._unflushed = 0
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM done").fetchone()[0]
+
+    def __contains__(self, name):
+        return self._db.execute("SELECT 1 FROM done WHERE name = ?",
+                                (name,)).fetchone() is not None
+
+    def __str__(self):
+        return "<%s %r, %d done>" % (self.__class__.__name__, self.filename,
+                                     len(self))
+
+    def add(self, name):
+        """Record that the file or directory `name` is done with."""
+        self._db.execute("INSERT OR IGNORE INTO done VALUES (?)", (name,))
+        self._unflushed += 1
+        if self._unflushed >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the records so far to disk."""
+        self._db.commit()
+        self._unflushed = 0
+
+    def clear(self):
+        """Forget everything, for the next run to start over."""
+        self._db.execute("DELETE FROM done")
+        self.flush()
+
+    def close(self):
+        """Write the records to disk and close the database."""
+        self.flush()
+        self._db.close()
+
+class _MirrorProgress(object):
+    """Keeps a MirrorJournal up to date as a mirror run goes. A file is done
+    with once it's transferred or found unchanged, and a directory once all
+    of its files and subdirectories are.
+    """
+
+    def __init__(self, journal):
+        self.journal = journal
+        # Directories to the number of their files and subdirectories not
+        # done yet, and those files and subdirectories to their directory.
+        self._pending = {}
+        self._parents = {}
+        self._added = []
+
+    def add_dir(self, directory, children):
+        """Register `directory` with the names of its `children` that are
+        still to do. It's only checked for being done in `settle`.
+        """
+        self._pending[directory] = len(children)
+        for child in children:
+            self._parents[child] = directory
+        self._added.append(directory)
+
+    def settle(self):
+        """Record the directories registered since last time that have
+        nothing to do, deepest first.
+        """
+        added, self._added = self._added, []
+        for directory in reversed(added):
+            if self._pending.get(directory) == 0:
+                self.done(directory)
+
+    def done(self, name):
+        """Record that the file or directory `name` is done with."""
+        self.journal.add(name)
+        self._pending.pop(name, None)
+        directory = self._parents.pop(name, None)
+        if directory is not None:
+            self._pending[directory] -= 1
+            if not self._pending[directory]:
+                self.done(directory)
+
+def _diff_entries(old, new):
+    """Compare the lists of FTPEntry objects `old` and `new` of a directory,
+    and return three lists (added, removed, modified) of entries in `new`
+    that aren't in `old`, the other way around, and those in both that
+    differ, as in `new`.
+    """
+    old = dict((e.name, e) for e in old)
+    added, modified = [], []
+    for entry in new:
+        previous = old.pop(entry.name, None)
+        if previous is None:
+            added.append(entry)
+        elif previous != entry:
+            modified.append(entry)
+    removed = sorted(old.values(), key=lambda e: e.name)
+    return (added, removed, modified)
+
+class FTPMetrics(object):
+    """Figures on what one or more hosts did: for each command, how many were
+    sent, how many failed and how long the replies took (for transfers, until
+    the transfer was done), plus bytes transferred each way and how long that
+    took, and how many transfers were retried.
+
+    The hosts call `command`, `transfer` and `retry` as things happen,
+    possibly from several threads. To send the figures elsewhere, override
+    those, or give the hosts any object with such methods instead.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.errors = {}
+        self.seconds = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.send_seconds = 0.0
+        self.receive_seconds = 0.0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        lines = []
+        for name in sorted(self.counts):
+            lines.append("%-4s %6d sent, %4d failed, %.1f ms average" % (
+                name, self.counts[name], self.errors.get(name, 0),
+                self.latency(name) * 1000))
+        lines.append("%d bytes sent (%.1f KiB/s), %d bytes received "
+            "(%.1f KiB/s), %d retries" % (self.bytes_sent,
+            self.upload_throughput / 1024.0, self.bytes_received,
+            self.download_throughput / 1024.0, self.retries))
+        return "\n".join(lines)
+
+    def command(self, name, seconds, failed):
+        """Record that command `name` got its reply after `seconds`, and
+        whether it `failed`.
+        """
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            if failed:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def transfer(self, direction, nbytes, seconds):
+        """Record that `nbytes` were transferred in `seconds`, in `direction`
+        "upload" or "download".
+        """
+        with self._lock:
+            if direction == "upload":
+                self.bytes_sent += nbytes
+                self.send_seconds += seconds
+            else:
+                self.bytes_received += nbytes
+                self.receive_seconds += seconds
+
+    def retry(self, filename, exc):
+        """Record that transferring `filename` failed with `exc`, and will
+        be retried.
+        """
+        with self._lock:
+            self.retries += 1
+
+    def latency(self, name):
+        """Average seconds command `name` took."""
+        if not self.counts.get(name):
+            return 0.0
+        return self.seconds[name] / self.counts[name]
+
+    @property
+    def upload_throughput(self):
+        """Average bytes per second while uploading."""
+        if not self.send_seconds:
+            return 0.0
+        return self.bytes_sent / self.send_seconds
+
+    @property
+    def download_throughput(self):
+        """Average bytes per second while downloading."""
+        if not self.receive_seconds:
+            return 0.0
+        return self.bytes_received / self.receive_seconds
+
+def _instrument(ftp_obj, metrics):
+    """Have the commands sent over `ftp_obj` timed into `metrics`, or stop
+    it if `metrics` is None.
+
+    A command is timed from when it's sent until its final reply; replies
+    come in the order the commands were sent, even when pipelined.
+    """
+    for name in ("putcmd", "getresp"):
+        ftp_obj.__dict__.pop(name, None)
+    if metrics is None:
+        return
+    putcmd, getresp = ftp_obj.putcmd, ftp_obj.getresp
+    pending = deque()
+
+    def timed_putcmd(line):
+        started = time.time()
+        putcmd(line)
+        pending.append((line.split(" ", 1)[0].upper(), started))
+
+    def timed_getresp():
+        try:
+            resp = getresp()
+        except Exception:
+            if pending:
+                name, started = pending.popleft()
+                metrics.command(name, time.time() - started, True)
+            raise
+        if pending and not resp.startswith("1"):
+            name, started = pending.popleft()
+            metrics.command(name, time.time() - started, False)
+        return resp
+
+    ftp_obj.putcmd = timed_putcmd
+    ftp_obj.getresp = timed_getresp
+
+class _ByteCounter(object):
+    """Callback counting the bytes of the blocks it's called with, and
+    passing them on to `func` if given.
+    """
+
+    def __init__(self, func=None):
+        self.func = func
+        self.bytes = 0
+
+    def __call__(self, data):
+        self.bytes += len(data)
+        if self.func is not None:
+            self.func(data)
+
+# Not affected by changes to the system clock, where there's one.
+_monotonic = getattr(time, "monotonic", time.time)
+
+class RateLimiter(object):
+    """Token bucket holding the transfers going through it to `rate` bytes
+    per second, allowing bursts of up to `burst` bytes (a tenth of a
+    second's worth by default). If `parent` is given, transfers are held to
+    its rate as well, so that limiters for single hosts or transfers can
+    share a global one.
+
+    Transfers sharing the limiter take turns block by block, so each gets
+    its share. Those of higher priority go first; those of lower priority
+    only get to go when no higher priority transfer is waiting.
+
+    `rate` can be changed at any time, but must stay above zero, or
+    ValueError is raised. The `bytes` counter tells how much has gone
+    through.
+    """
+
+    def __init__(self, rate, burst=None, parent=None):
+        self._cond = threading.Condition()
+        self.rate = rate
+        self.burst = burst or max(self.rate / 10.0, 1)
+        self.parent = parent
+        self.bytes = 0
+        self._tokens = self.burst
+        self._updated = _monotonic()
+        # Heap of (-priority, ticket number) of the transfers waiting their
+        # turn; the first one goes next.
+        self._waiting = []
+        self._tickets = itertools.count()
+
+    def __str__(self):
+        return "<%s %d bytes/s, %d bytes>" % (self.__class__.__name__,
+            self.rate, self.bytes)
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate):
+        rate = float(rate)
+        if rate <= 0:
+            raise ValueError("rate must be above zero, not %r" % (rate,))
+        with self._cond:
+            if hasattr(self, "_updated"):
+                # What's been earned so far is at the old rate.
+                self._refill()
+            self._rate = rate
+            # Those waiting go by the new rate.
+            self._cond.notify_all()
+
+    def _refill(self):
+        now = _monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def consume(self, nbytes, priority=0):
+        """Wait until `nbytes` may go through, with `priority`, then take
+        them from the bucket.
+
+        A block bigger than the bucket goes once the bucket is full, and the
+        ones after it wait until it's paid off.
+        """
+        ticket = (-priority, next(self._tickets))
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    self._refill()
+                    timeout = None
+                    if self._waiting[0] == ticket:
+                        needed = min(nbytes, self.burst)
+                        if self._tokens >= needed:
+                            break
+                        timeout = (needed - self._tokens) / self.rate
+                    self._cond.wait(timeout)
+                self._tokens -= nbytes
+                self.bytes += nbytes
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+        if self.parent is not None:
+            self.parent.consume(nbytes, priority)
+
+class _Throttle(object):
+    """Callback holding up the transfer it's called from as `limiters`
+    require, passing blocks on to `func` first if given.
+    """
+
+    def __init__(self, limiters, priority, func=None):
+        self.limiters = limiters
+        self.priority = priority
+        self.func = func
+
+    def __call__(self, data):
+        if self.func is not None:
+            self.func(data)
+        self.consume(len(data))
+
+    def consume(self, nbytes):
+        for limiter in self.limiters:
+            limiter.consume(nbytes, self.priority)
+
+# Hash algorithms a server may compute checksums of files with, best first,
+# by the names hashlib knows them by, except for "crc32", which zlib does.
+_hash_algorithms = ("sha256", "sha512", "sha1", "md5", "crc32")
+
+# Their names in the HASH feature and command, and the older commands
+# computing each.
+_hash_names = {"sha256": "SHA-256", "sha512": "SHA-512", "sha1": "SHA-1",
+               "md5": "MD5", "crc32": "CRC32"}
+_hash_commands = {"sha256": "XSHA256", "sha512": "XSHA512", "sha1": "XSHA1",
+                  "md5": "XMD5", "crc32": "XCRC"}
+
+_hex_re = re.compile(r"^[0-9a-fA-F]+$")
+
+class ChecksumError(ftplib.Error):
+    """The checksum of a transferred file isn't what the server makes it."""
+
+class _CRC32(object):
+    """CRC-32 with the interface of a hashlib object."""
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return "%08x" % (self.value & 0xffffffff)
+
+def _new_hash(algorithm):
+    if algorithm == "crc32":
+        return _CRC32()
+    return hashlib.new(algorithm)
+
+def _hash_file(filename, hash, size=None):
+    """Update `hash` with the contents of local file `filename`, or its
+    first `size` bytes if given, and return it.
+    """
+    fp = open(filename, "rb")
+    try:
+        while size is None or size > 0:
+            data = fp.read(65536 if size is None else min(size, 65536))
+            if not data:
+                break
+            hash.update(data)
+            if size is not None:
+                size -= len(data)
+    finally:
+        fp.close()
+    return hash
+
+class _HashingFile(object):
+    """File object wrapper updating `hash` with whatever is read from or
+    written to `fp`.
+    """
+
+    def __init__(self, fp, hash):
+        self.fp = fp
+        self.hash = hash
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.hash.update(data)
+        return data
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.fp.write(data)
+
+class _CompressingFile(object):
+    """File object wrapper deflating what's read from `fp` at zlib `level`,
+    for uploading in MODE Z.
+    """
+
+    def __init__(self, fp, level):
+        self.fp = fp
+        self.compressobj = zlib.compressobj(level)
+        self.done = False
+
+    def read(self, size=-1):
+        # Only an empty string may tell that the end has been reached.
+        while not self.done:
+            data = self.fp.read(size)
+            if not data:
+                self.done = True
+                return self.compressobj.flush()
+            data = self.compressobj.compress(data)
+            if data:
+                return data
+        return b""
+
+class _Decompressor(object):
+    """Callback inflating the blocks of a MODE Z download, and passing them
+    on to `func`. Call `flush` once the download is done.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.decompressobj = zlib.decompressobj()
+
+    def __call__(self, data):
+        data = self.decompressobj.decompress(data)
+        if data:
+            self.func(data)
+
+    def flush(self):
+        data = self.decompressobj.flush()
+        if data:
+            self.func(data)
+
+def _inflate(decompressobj, data, size):
+    """Yield what the blocks of a MODE Z download inflate to, `size` bytes
+    at most at a time. A `data` of None flushes the rest.
+    """
+    if data is None:
+        data = decompressobj.flush()
+        for i in range(0, len(data), size):
+            yield data[i:i + size]
+        return
+    data = decompressobj.decompress(data, size)
+    while data:
+        yield data
+        data = decompressobj.decompress(decompressobj.unconsumed_tail, size)
+
 class FTPHost(object):
     """Represent a connection to a remote host.
 
@@ -41,6 +1148,29 @@ class FTPHost(object):
         connection and get an FTPHost instance.
         """
         self.ftp_obj = ftp_obj
+        # Set by connect, and used to open more connections like this one.
+        self._connect_args = None
+        # Reply to FEAT, once asked for.
+        self._features = None
+        # The algorithm the HASH command uses on this connection, once known.
+        self._hash_selected = None
+        # A ListingCache to list directories through, if any.
+        self.listing_cache = None
+        # Where to record what's done, if anywhere; see FTPMetrics.
+        self._metrics = None
+        # Absolute paths of directories known to exist, for makedirs.
+        self._known_dirs = set()
+        # The RateLimiter transfers go through, if any, and their priority.
+        self.rate_limiter = None
+        self.priority = 0
+        # The compression level to transfer files with, if any, and the
+        # transfer mode and level the server is set to.
+        self.compression = None
+        self._mode = "S"
+        self._mode_level = None
+        # Whether the server copies files with SITE CPFR and CPTO, once
+        # known.
+        self._can_site_copy = None
 
     def __repr__(self):
         return "%s(%r)" % (self.__class__.__name__, self.ftp_obj)
@@ -51,11 +1181,21 @@ class FTPHost(object):
 
     @classmethod
     def connect(cls, host, port=21, user=None, password=None, account=None,
-                ftp_client=ftplib.FTP, debuglevel=0, timeout=None):
+                ftp_client=ftplib.FTP, debuglevel=0, timeout=None,
+                listing_cache=None, metrics=None, rate_limiter=None,
+                priority=0, compression=None):
         """Connect to host, using port. If user is given, login with given
         user, password and account. The two latter can be None, in which case
         ftplib will set the password to 'anonymous@'. You can choose which
         class to instance by means of ftp_client.
+
+        If `listing_cache` is given, directory listings are served from and
+        kept in it; see ListingCache. If `metrics` is given, commands and
+        transfers are recorded in it; see FTPMetrics. If `rate_limiter` is
+        given, transfers are throttled by it, with `priority`; see
+        RateLimiter. If `compression` is given, a zlib level from 1 to 9,
+        files are transferred compressed with MODE Z at that level if the
+        server advertises it.
         """
         ftp_obj = ftp_client()
         ftp_obj.set_debuglevel(debuglevel)
@@ -70,12 +1210,214 @@ class FTPHost(object):
         # And log in.
         if user:
             ftp_obj.login(user, password, account)
-        return cls(ftp_obj)
+        self = cls(ftp_obj)
+        self.listing_cache = listing_cache
+        self.metrics = metrics
+        self.rate_limiter = rate_limiter
+        self.priority = priority
+        self.compression = compression
+        self._connect_args = dict(host=host, port=port, user=user,
+            password=password, account=account, ftp_client=ftp_client,
+            debuglevel=debuglevel, timeout=timeout)
+        return self
+
+    def clone(self):
+        """Open a new connection to the same server, with the parameters this
+        host was connected with, and return it as a new host instance.
+        """
+        if self._connect_args is None:
+            raise ValueError("%r was not created by connect" % (self,))
+        host = self.__class__.connect(**self._connect_args)
+        # Share the cache, whether given to connect or set afterwards, and
+        # what's known about the server.
+        host.listing_cache = self.listing_cache
+        host._known_dirs = self._known_dirs
+        host.metrics = self.metrics
+        host.rate_limiter = self.rate_limiter
+        host.priority = self.priority
+        host.compression = self.compression
+        return host
+
+    def reconnect(self):
+        """Replace the connection with a new one, made with the parameters
+        this host was connected with, and change back into the working
+        directory if it's known.
+        """
+        new_ftp_obj = self.clone().ftp_obj
+        try:
+            self.ftp_obj.close()
+        except Exception:
+            pass
+        self.ftp_obj = new_ftp_obj
+        self._features = None
+        self._hash_selected = None
+        self._mode = "S"
+        self._mode_level = None
+        if hasattr(self, "_cwd"):
+            self.ftp_obj.cwd(self._cwd)
 
     def file_proxy(self, filename):
         """Creates a file proxy object for filename. See FTPFileProxy."""
-        return FTPFileProxy(self.ftp_obj,
-            posixpath.join(self.current_directory, filename))
+        return FTPFileProxy(self.ftp_obj, self._absolute(filename), host=self)
+
+    def _absolute(self, filename):
+        # Absolute names need no PWD to resolve.
+        if posixpath.isabs(filename):
+            return filename
+        return posixpath.join(self.current_directory, filename)
+
+    def _resolved(self, filename):
+        """Return `filename` as a normalized absolute path, or None if that
+        would take asking the server for the working directory.
+        """
+        if posixpath.isabs(filename) or hasattr(self, "_cwd"):
+            return posixpath.normpath(self._absolute(filename))
+        return None
+
+    def _changed(self, filename, recursive=False):
+        """Drop cached listings that changing `filename` makes stale: its
+        directory's, and its own and those below it if `recursive` is True,
+        in which case it's also forgotten as a known directory.
+        """
+        cache = self.listing_cache
+        if cache is None and not (recursive and self._known_dirs):
+            return
+        filename = posixpath.normpath(self._absolute(filename))
+        if recursive:
+            _discard_known_dirs(self._known_dirs, filename)
+        if cache is not None:
+            cache.invalidate(posixpath.dirname(filename))
+            if recursive:
+                cache.invalidate(filename, recursive=True)
+
+    @property
+    def features(self):
+        """The features the server advertises in its reply to FEAT, as a dict
+        mapping upper-case feature names to their parameters.
+
+        The server is only asked once per connection.
+        """
+        if self._features is None:
+            features = {}
+            try:
+                resp = self.ftp_obj.sendcmd("FEAT")
+            except ftplib.error_perm:
+                # Not implemented; a server from before RFC 2389.
+                pass
+            else:
+                # Features are listed one per line between the first and
+                # last line of the reply, each indented by a space.
+                for line in resp.splitlines()[1:-1]:
+                    name, _, params = line.strip().partition(" ")
+                    features[name.upper()] = params
+            self._features = features
+        return self._features
+
+    @property
+    def hash_algorithms(self):
+        """The algorithms the server advertises computing checksums of files
+        with, best first: "sha256", "sha512", "sha1", "md5" and "crc32". Both
+        the HASH command and the older XSHA256, XSHA512, XSHA1, XMD5 and XCRC
+        commands count.
+        """
+        features = self.features
+        names = set(name.strip().rstrip("*").upper()
+                    for name in features.get("HASH", "").split(";"))
+        return [algorithm for algorithm in _hash_algorithms
+                if _hash_names[algorithm] in names or
+                _hash_commands[algorithm] in features]
+
+    def _checksum_algorithm(self, algorithm=None):
+        """Return `algorithm` if the server computes it, or the best one it
+        does if None. Raise ValueError if it doesn't.
+        """
+        algorithms = self.hash_algorithms
+        if algorithm is None and algorithms:
+            return algorithms[0]
+        if algorithm not in algorithms:
+            raise ValueError("%s doesn't compute %s checksums" %
+                             (self, algorithm or "any"))
+        return algorithm
+
+    def checksum(self, filename, algorithm=None):
+        """Return the checksum of remote file `filename` as a lower-case hex
+        string, as computed by the server with `algorithm`, or the best one
+        it has if None; see `hash_algorithms`.
+
+        The file isn't transferred. HASH is used if the server has it for
+        the algorithm, and the older command for it otherwise.
+        """
+        algorithm = self._checksum_algorithm(algorithm)
+        ftp_obj = self.ftp_obj
+        params = self.features.get("HASH", "")
+        names = [name.strip().upper() for name in params.split(";")]
+        name = _hash_names[algorithm]
+        if name in names or name + "*" in names:
+            if self._hash_selected is None and name + "*" in names:
+                self._hash_selected = algorithm
+            if self._hash_selected != algorithm:
+                ftp_obj.voidcmd("OPTS HASH " + name)
+                self._hash_selected = algorithm
+            # 213 <algorithm> <start>-<end> <hash> <filename>
+            parts = ftp_obj.voidcmd("HASH " + filename)[4:].split(None, 3)
+            value = parts[2] if len(parts) > 2 else ""
+        else:
+            resp = ftp_obj.voidcmd("%s %s" % (_hash_commands[algorithm],
+                                              filename))
+            # 25x [<filename>] <hash>: servers differ in whether the file
+            # name comes first, as in draft-twine-ftpmd5, but the hash is
+            # last either way.
+            parts = resp[4:].rsplit(None, 1)
+            value = parts[-1] if parts else ""
+        if not _hex_re.match(value):
+            raise ftplib.error_reply("no checksum in reply to %s of %s" %
+                                     (_hash_names[algorithm], filename))
+        value = value.lower()
+        if algorithm == "crc32":
+            value = value.zfill(8)
+        return value
+
+    @property
+    def has_mode_z(self):
+        """Whether the server advertises MODE Z, deflate compression of the
+        data connection.
+        """
+        return "Z" in self.features.get("MODE", "").upper().split(",")
+
+    def _transfer_compression(self):
+        """The zlib level to transfer a file with, or None to send it as it
+        is: `compression`, if the server has MODE Z.
+        """
+        if self.compression is None or not self.has_mode_z:
+            return None
+        return self.compression
+
+    def _set_mode(self, mode, level=None):
+        """Switch the server to transfer mode `mode`, "S" for stream or "Z"
+        for compressed at zlib `level`, unless it's there already.
+        """
+        ftp_obj = self.ftp_obj
+        if mode != self._mode:
+            ftp_obj.voidcmd("MODE " + mode)
+            self._mode = mode
+        if mode == "Z" and level is not None and level != self._mode_level:
+            try:
+                ftp_obj.voidcmd("OPTS MODE Z LEVEL %d" % (level,))
+            except ftplib.error_perm:
+                # The server's own level will have to do.
+                pass
+            self._mode_level = level
+
+    def get_metrics(self):
+        return self._metrics
+
+    def set_metrics(self, metrics):
+        self._metrics = metrics
+        _instrument(self.ftp_obj, metrics)
+
+    # Where commands and transfers over this host are recorded, if anywhere;
+    # see FTPMetrics.
+    metrics = property(get_metrics, set_metrics)
 
     def get_current_directory(self):
         if not hasattr(self, "_cwd"):
@@ -91,44 +1433,380 @@ class FTPHost(object):
     def mkdir(self, directory):
         """Make directory."""
         self.ftp_obj.mkd(directory)
+        self._changed(directory)
+        directory = self._resolved(directory)
+        if directory is not None:
+            self._exists(directory)
 
     def rmdir(self, directory):
         """Remove directory."""
         self.ftp_obj.rmd(directory)
+        self._changed(directory, recursive=True)
+
+    def walk(self, directory, entries=False, workers=1, connection_pool=None):
+        """Emulates os.walk very well, even the caveats.
 
-    def walk(self, directory):
-        """Emulates os.walk very well, even the caveats."""
-        (subdirs, files) = self.listdir(directory)
+        If `entries` is True, the subdirectory and file lists hold FTPEntry
+        objects rather than names; see `listdir`.
+
+        With `workers` greater than one, directories are listed concurrently
+        over that many extra connections (see `clone`), breadth first, and
+        yielded in the order the listings complete. Pruning the subdirectory
+        list works just the same. The connections are taken from
+        `connection_pool` if given; see FTPConnectionPool.
+        """
+        if workers > 1:
+            for x in self._walk_parallel(directory, entries, workers,
+                                         connection_pool):
+                yield x
+            return
+        (subdirs, files) = self.listdir(directory, entries=entries)
         # Yield value.
         yield (directory, subdirs, files)
         # Recurse subdirs.
         for subdir in subdirs:
-            for x in self.walk(posixpath.join(directory, subdir)):
+            if entries:
+                subdir = subdir.name
+            for x in self.walk(posixpath.join(directory, subdir), entries):
                 yield x
 
-    def listdir(self, directory, links=False):
+    def walk_changes(self, directory, index, skip_unchanged=False):
+        """Walk `directory` like `walk`, but report what changed since the
+        last walk recorded in the TreeIndex `index`, and record this one.
+        Yield a four-tuple (dirpath, added, removed, modified) of lists of
+        FTPEntry objects for each directory in which something did; see
+        `listdir`. When a directory is removed, only its entry is reported.
+
+        A directory is only listed again if its modification time changed,
+        which happens when entries are added, removed or renamed in it, but
+        not when a file in it is rewritten in place. The times come from
+        the listings of the parent directories, or MLST where those are
+        stale or too coarse to go by. Without MLST, every directory is
+        listed. With `skip_unchanged`, the subtrees of unchanged
+        directories are skipped altogether; changes deep down don't change
+        the times of the directories above them on most servers, so that
+        only suits trees that grow by new directories.
+        """
+        key = posixpath.normpath(self._absolute(directory))
+        try:
+            for x in self._walk_changes(directory, key,
+                                        self._dir_mtime(directory), index,
+                                        skip_unchanged):
+                yield x
+        finally:
+            index.commit()
+
+    def _walk_changes(self, directory, key, mtime, index, skip_unchanged):
+        known = index.get(key)
+        fresh = known is None or mtime is None or known[0] != mtime
+        if fresh:
+            entries = list(self.iterdir(directory))
+            old = known[1] if known is not None else []
+            (added, removed, modified) = _diff_entries(old, entries)
+            # Forget what was below directories that are no more.
+            subdirs = set(e.name for e in entries if e.type == "dir")
+            for entry in old:
+                if entry.type == "dir" and entry.name not in subdirs:
+                    index.remove(posixpath.join(key, entry.name))
+            # The time goes in once all below is up to date, so that a walk
+            # broken off in there looks again.
+            index.put(key, None, entries)
+            if added or removed or modified:
+                yield (directory, added, removed, modified)
+        elif skip_unchanged:
+            return
+        else:
+            entries = known[1]
+        for entry in entries:
+            if entry.type != "dir":
+                continue
+            subdir = posixpath.join(directory, entry.name)
+            if fresh and self.has_mlsd:
+                sub_mtime = entry.mtime
+            else:
+                sub_mtime = self._dir_mtime(subdir)
+            for x in self._walk_changes(subdir,
+                                        posixpath.join(key, entry.name),
+                                        sub_mtime, index, skip_unchanged):
+                yield x
+        index.set_mtime(key, mtime)
+
+    def _dir_mtime(self, directory):
+        """Return the modification time of `directory` as told by MLST, or
+        None if the server can't tell.
+        """
+        if "MLST" not in self.features:
+            return None
+        try:
+            resp = self.ftp_obj.sendcmd("MLST " + directory)
+        except ftplib.error_perm:
+            return None
+        lines = resp.splitlines()
+        if len(lines) < 3:
+            return None
+        for fact in lines[1].strip().partition(" ")[0].split(";"):
+            key, _, value = fact.partition("=")
+            if key.lower() == "modify":
+                try:
+                    return _parse_timeval(value)
+                except ValueError:
+                    return None
+        return None
+
+    def _walk_parallel(self, directory, entries, workers, connection_pool):
+        pool = self._workers(partial(_listdir_one, entries=entries), workers,
+                             connection_pool)
+        pool.put(directory)
+        outstanding = 1
+        try:
+            while outstanding:
+                current_dir, result, exc = pool.get()
+                outstanding -= 1
+                if exc is not None:
+                    raise exc
+                (subdirs, files) = result
+                yield (current_dir, subdirs, files)
+                # Only now that the caller has had a chance to prune them.
+                for subdir in subdirs:
+                    if entries:
+                        subdir = subdir.name
+                    pool.put(posixpath.join(current_dir, subdir))
+                    outstanding += 1
+        finally:
+            pool.close(discard=True)
+
+    def listdir(self, directory, links=False, entries=False):
         """Returns a list of files and directories at `directory`, relative to
         the current working directory. The return value is a two-tuple of
-        (dirs, files).
+        (dirs, files), or a three-tuple (dirs, files, links) if `links` is
+        True.
+
+        If `entries` is True, the lists hold FTPEntry objects with whatever
+        the listing tells about size, modification time, permissions and link
+        targets, rather than just names.
+
+        Uses MLSD if the server supports it, and LIST otherwise. The listing
+        comes from `listing_cache` if it's set and has it.
         """
-        directory = directory.rstrip("/")
-        kwds = dict(files=[], subdirs=[])
+        directory = directory.rstrip("/") or directory
+        kwds = dict(files=[], subdirs=[], entries=entries)
         if links:
             kwds["links"] = []
-        cb = partial(_parse_list_line, **kwds)
-        self.ftp_obj.dir(directory, cb)
+        if self.listing_cache is not None or self.has_mlsd:
+            dsts = {"file": kwds["files"], "dir": kwds["subdirs"],
+                    "link": kwds.get("links")}
+            for entry in self.iterdir(directory):
+                dst = dsts[entry.type]
+                if dst is not None:
+                    dst.append(entry if entries else entry.name)
+        else:
+            listing = self.listing(directory)
+            dsts = {"file": kwds["files"], "dir": kwds["subdirs"],
+                    "link": kwds.get("links")}
+            if entries:
+                for entry in listing:
+                    dst = dsts[entry.type]
+                    if dst is not None:
+                        dst.append(entry)
+            else:
+                for (name, type) in zip(listing.names, listing.types):
+                    dst = dsts[type]
+                    if dst is not None:
+                        dst.append(name)
         if links:
             return (kwds["subdirs"], kwds["files"], kwds["links"])
         else:
             return (kwds["subdirs"], kwds["files"])
 
-    def mirror_to_local(self, source, destination):
-        """Download remote directory found by source to destination."""
+    def listing(self, directory):
+        """Return the listing of `directory` as an FTPListing.
+
+        Without MLSD, the whole LIST output is read at once and parsed in one
+        go rather than line by line, which pays off for huge directories.
+        """
+        directory = directory.rstrip("/") or directory
+        if self.listing_cache is not None or self.has_mlsd:
+            listing = FTPListing()
+            for entry in self.iterdir(directory):
+                listing.append(entry)
+            return listing
+        command = "LIST"
+        if directory:
+            command += " " + directory
+        return _parse_list_text(self._read_text(command))
+
+    def _read_text(self, command):
+        """Send `command` and return all of the text from the data connection
+        it opens.
+        """
+        ftp_obj = self.ftp_obj
+        self._set_mode("S")
+        conn = _start_transfer(ftp_obj, "A", command)
+        completed = False
+        chunks = []
+        try:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+            completed = True
+        finally:
+            _end_transfer(ftp_obj, conn, completed)
+        text = b"".join(chunks)
+        if six.PY3:
+            text = text.decode(ftp_obj.encoding)
+        return text
+
+    @property
+    def has_mlsd(self):
+        """Whether the server supports MLSD listings, according to FEAT."""
+        features = self.features
+        return "MLST" in features or "MLSD" in features
+
+    def iterdir(self, directory):
+        """Yield an FTPEntry for each entry in `directory` as the listing
+        comes in.
+
+        Uses MLSD if the server supports it, which gives exact sizes and
+        modification times and doesn't trip on odd names, and falls back to
+        parsing LIST output otherwise.
+
+        With a `listing_cache`, a cached listing is used if there is one, and
+        a listing read to the end is cached. The entries are then shared, so
+        don't modify them.
+        """
+        directory = directory.rstrip("/") or directory
+        cache = self.listing_cache
+        if cache is not None:
+            key = posixpath.normpath(self._absolute(directory))
+            listing = cache.get(key)
+            if listing is not None:
+                for entry in listing:
+                    yield entry
+                return
+            listing = []
+        if self.has_mlsd:
+            command, parse = "MLSD", _parse_mlsd_line
+        else:
+            command, parse = "LIST", _parse_list_entry
+        if directory:
+            command += " " + directory
+        for line in self._iter_lines(command):
+            entry = parse(line)
+            if entry is not None:
+                if cache is not None:
+                    listing.append(entry)
+                yield entry
+        if cache is not None:
+            cache.put(key, listing)
+
+    def _iter_lines(self, command):
+        """Send `command` and yield the lines of text from the data connection
+        it opens, as they arrive.
+
+        Stopping early closes the data connection, which the server will
+        complain about; that reply is discarded.
+        """
+        ftp_obj = self.ftp_obj
+        self._set_mode("S")
+        conn = _start_transfer(ftp_obj, "A", command)
+        if six.PY3:
+            fp = conn.makefile("r", encoding=ftp_obj.encoding)
+        else:
+            fp = conn.makefile("rb")
+        completed = False
+        try:
+            while True:
+                line = fp.readline()
+                if not line:
+                    break
+                yield line.rstrip("\r\n")
+            completed = True
+        finally:
+            fp.close()
+            _end_transfer(ftp_obj, conn, completed)
+
+    def mirror_to_local(self, source, destination, workers=1,
+                        incremental=False, dry_run=False,
+                        connection_pool=None, verify=False, journal=None):
+        """Download remote directory found by source to destination.
+
+        With `workers` greater than one, files are downloaded concurrently
+        over that many extra connections (see `clone`) while this connection
+        walks the tree. A failed download is then recorded rather than
+        raised, and only costs the worker its connection. The connections
+        are taken from `connection_pool` if given; see FTPConnectionPool.
+
+        If `incremental` is True, files whose local copy has the size and
+        modification time of the remote file are skipped. Downloaded files get
+        the modification time of the remote file, to make this work on the
+        next run. Sizes are taken from the listing, and so are modification
+        times if the server lists with MLSD; otherwise they're asked for. If
+        `dry_run` is True, nothing is downloaded or created; the transfers
+        that would have been made are listed in the `pending` attribute of
+        the result.
+
+        If `verify` is True, downloads are checked against checksums computed
+        by the server (see `checksum`), and a file fails with ChecksumError
+        if it doesn't match. With `incremental`, local files of the right
+        size are then compared by checksum instead of modification time.
+
+        With a MirrorJournal `journal`, the files and directories the run is
+        done with are recorded in it, and those an earlier run that was
+        broken off got done with are left out, directories without being
+        listed again. When a run gets through without errors, the journal
+        is cleared for the next one to start over.
+
+        Returns a `TransferStats` for the run.
+        """
+        if verify:
+            # Fail before anything is done if the server can't.
+            self._checksum_algorithm()
+        stats = TransferStats()
+        progress = None
+        if journal is not None and not dry_run:
+            progress = _MirrorProgress(journal)
+        func = partial(_download_one, incremental=incremental,
+                       dry_run=dry_run, verify=verify)
+        transfers = self._mirror_to_local_files(source, destination, dry_run,
+                                                progress)
+        try:
+            if workers > 1:
+                self._transfer_parallel(func, transfers, workers, stats,
+                                        connection_pool, progress)
+            else:
+                for transfer in transfers:
+                    _record_transfer(stats,
+                                     (transfer, func(self, transfer), None),
+                                     progress)
+        finally:
+            if progress is not None:
+                journal.flush()
+        if progress is not None and not stats.errors:
+            journal.clear()
+        stats.finish()
+        return stats
+
+    def _mirror_to_local_files(self, source, destination, dry_run=False,
+                               progress=None):
+        """Walk remote `source`, creating local directories under
+        `destination` (unless `dry_run` is True) and yielding
+        (remote_file, target_file, size, mtime) for each file. The size and
+        modification time are None if the listing didn't tell, or didn't tell
+        exactly. What the journal of _MirrorProgress `progress` has as done
+        is left out, and the rest registered with it.
+        """
         # Cut off excess slashes.
         source = source.rstrip("/")
         destination = destination.rstrip("/")
 
-        for current_dir, subdirs, files in self.walk(source):
+        exact_mtime = self.has_mlsd
+        for current_dir, subdirs, files in self.walk(source, entries=True):
+            if progress is not None:
+                subdirs[:], files = _journal_filter(progress, current_dir,
+                                                    subdirs, files,
+                                                    posixpath.join)
             # current_destination will be the destination directory, plus the
             # current subdirectory. Have to treat the empty string separately,
             # because otherwise we'd be skipping a byte of current_dir,
@@ -140,23 +1818,84 @@ class FTPHost(object):
                 current_destination = path.join(destination, current_dir)
             # Create all subdirectories lest they exist.
             for subdir in subdirs:
-                subdir_full = path.join(current_destination, subdir)
-                if not path.exists(subdir_full):
+                subdir_full = path.join(current_destination, subdir.name)
+                if not dry_run and not path.exists(subdir_full):
                     os.mkdir(subdir_full)
+            if progress is not None:
+                progress.settle()
             # Download all files in current directory.
-            for filename in files:
-                target_file = path.join(current_destination, filename)
-                remote_file = posixpath.join(source, current_dir, filename)
-                self.file_proxy(remote_file).download_to_file(target_file)
+            for entry in files:
+                target_file = path.join(current_destination, entry.name)
+                remote_file = posixpath.join(current_dir, entry.name)
+                mtime = entry.mtime if exact_mtime else None
+                yield (remote_file, target_file, entry.size, mtime)
+
+    def _workers(self, func, count, connection_pool=None):
+        """Start `count` worker threads for `func`, with connections of their
+        own from `connection_pool` if given, and cloned from this one if not.
+        """
+        if connection_pool is None:
+            return _Workers(self.clone, func, count)
+        # Threads beyond what the pool allows would just sit on their items.
+        count = min(count, connection_pool.max_connections)
+        return _Workers(connection_pool.acquire, func, count,
+                        release=connection_pool.release)
+
+    def _transfer_parallel(self, func, transfers, workers, stats,
+                           connection_pool=None, progress=None):
+        """Run `func(host, transfer)` for each of `transfers` over `workers`
+        connections, recording into `stats` and _MirrorProgress `progress`.
+        `func` returns the number of bytes transferred.
+        """
+        pool = self._workers(func, workers, connection_pool)
+        pending = 0
+        try:
+            for transfer in transfers:
+                pool.put(transfer)
+                pending += 1
+                # Collect whatever finished meanwhile, so results don't pile
+                # up for huge trees.
+                while True:
+                    try:
+                        result = pool.get(block=False)
+                    except queue.Empty:
+                        break
+                    pending -= 1
+                    _record_transfer(stats, result, progress)
+        finally:
+            pool.close()
+        while pending:
+            pending -= 1
+            _record_transfer(stats, pool.get(), progress)
 
     def mirror_to_remote(self, source, destination, create_destination=False,
-            ignore_dotfiles=True):
+            ignore_dotfiles=True, workers=1, incremental=False, dry_run=False,
+            connection_pool=None, verify=False, journal=None):
         """Upload local directory `source` to remote destination `destination`.
 
         Create destination directory only if `create_destination` is True, and
         don't upload or descend into files or directories starting with a dot
         if `ignore_dotfiles` is True.
+
+        The upload happens in two phases: first every remote directory is
+        created in one pipelined batch (see `pipeline`), then the files are
+        uploaded. With `workers` greater than one, files are uploaded
+        concurrently over that many extra connections (from `connection_pool`
+        if given), and failed uploads are recorded rather than raised, as with
+        `mirror_to_local`.
+
+        If `incremental` is True, files are skipped if the remote file has the
+        same size and is no older than the local one. With `dry_run`, nothing
+        is created or uploaded, and the result lists what would have been.
+        With `verify`, uploads are checked against checksums computed by the
+        server, and remote files of the right size are compared by checksum
+        rather than age. With a MirrorJournal `journal`, a run that was
+        broken off is resumed. See `mirror_to_local`.
+
+        Returns a `TransferStats` for the run.
         """
+        if verify:
+            self._checksum_algorithm()
         # Cut off excess slashes.
         source = source.rstrip("/")
         destination = destination.rstrip("/")
@@ -166,87 +1905,220 @@ class FTPHost(object):
             raise ValueError("cannot have a destination with dots when "
                 "ignore_dotfiles is True")
 
-        # Create remote FTP destination
-        if create_destination:
-            try:
-                self.makedirs(destination)
-            except ftplib.Error:
-                pass
+        # Create remote FTP destination
+        if create_destination and not dry_run:
+            try:
+                self.makedirs(destination)
+            except ftplib.Error:
+                pass
+
+        stats = TransferStats()
+        progress = None
+        if journal is not None and not dry_run:
+            progress = _MirrorProgress(journal)
+        directories, transfers = _mirror_to_remote_plan(source, destination,
+            ignore_dotfiles, progress)
+
+        # Create all directories required. Ignore FTP errors here because if
+        # they're fatal, we'll get it later when we upload.
+        # Directories already known to exist are left out.
+        if not dry_run:
+            known = self._known_dirs
+            directories = [(d, self._resolved(d)) for d in directories]
+            directories = [(d, a) for (d, a) in directories if a not in known]
+            replies = self.pipeline("MKD " + d for (d, a) in directories)
+            for ((d, a), reply) in zip(directories, replies):
+                self._changed(d)
+                if a is not None and not isinstance(reply, Exception):
+                    self._exists(a)
+
+        # Upload all files.
+        func = partial(_upload_one, incremental=incremental, dry_run=dry_run,
+                       verify=verify)
+        try:
+            if progress is not None:
+                # Empty directories are done with now that they're made.
+                progress.settle()
+            if workers > 1:
+                self._transfer_parallel(func, transfers, workers, stats,
+                                        connection_pool, progress)
+            else:
+                for transfer in transfers:
+                    _record_transfer(stats,
+                                     (transfer, func(self, transfer), None),
+                                     progress)
+        finally:
+            if progress is not None:
+                journal.flush()
+        if progress is not None and not stats.errors:
+            journal.clear()
+        stats.finish()
+        return stats
+
+    def mirror_to_host(self, source, host, destination, incremental=False,
+                       dry_run=False):
+        """Copy remote directory `source` to `destination` on FTPHost
+        `host`, server to server; see FTPFileProxy.copy. `host` may be this
+        host, to copy a tree within the server.
+
+        If `incremental` is True, files are skipped if the copy on `host`
+        has the same size and is no older. With `dry_run`, nothing is
+        created or copied, and the result lists what would have been.
+
+        Returns a `TransferStats` for the run.
+        """
+        source = source.rstrip("/")
+        destination = destination.rstrip("/")
+        if host is self:
+            # A second connection for the other end of the copies.
+            host = self.clone()
+            close = host.try_quit
+        else:
+            close = None
+        stats = TransferStats()
+        try:
+            for current_dir, subdirs, files in self.walk(source,
+                                                         entries=True):
+                current_destination = posixpath.join(destination,
+                    current_dir[len(source):].lstrip("/")).rstrip("/")
+                if not dry_run:
+                    host.makedirs(current_destination)
+                for entry in files:
+                    transfer = (posixpath.join(current_dir, entry.name),
+                                posixpath.join(current_destination,
+                                               entry.name))
+                    try:
+                        result = _copy_one(self, host, transfer, entry,
+                                           incremental, dry_run)
+                    except ftplib.Error as e:
+                        stats.add_error(transfer[0], e)
+                    else:
+                        _record_transfer(stats, (transfer, result, None))
+        finally:
+            if close is not None:
+                close()
+        stats.finish()
+        return stats
+
+    def _same_server(self, host):
+        """Whether FTPHost `host` is connected to the same server."""
+        if host is None:
+            return False
+        return (getattr(self.ftp_obj, "host", None),
+                getattr(self.ftp_obj, "port", None)) == \
+            (getattr(host.ftp_obj, "host", None),
+             getattr(host.ftp_obj, "port", None))
+
+    def _site_copy(self, source, destination):
+        """Copy remote file `source` to `destination` with SITE CPFR and
+        CPTO, as ProFTPD's mod_copy has them, and return True, or False if
+        the server doesn't have them.
+        """
+        if self._can_site_copy is False:
+            return False
+        ftp_obj = self.ftp_obj
+        try:
+            resp = ftp_obj.sendcmd("SITE CPFR " + source)
+        except ftplib.error_perm as e:
+            if str(e)[:3] not in ("500", "501", "502", "504"):
+                raise
+            self._can_site_copy = False
+            return False
+        if not resp.startswith("3"):
+            raise ftplib.error_reply(resp)
+        ftp_obj.voidcmd("SITE CPTO " + destination)
+        self._can_site_copy = True
+        return True
+
+    # How many commands `pipeline` may have sent without reading their reply.
+    # Set to 1 for servers that can't take pipelined commands.
+    pipeline_window = 32
 
-        for current_dir, subdirs, files in os.walk(source):
-            # Current remote destination = destination dir + current.
-            # See mirror_to_local for the census of special-casing the empty
-            # string.
-            if source:
-                remote_dest_dir = posixpath.join(destination,
-                    current_dir[len(source) + 1:])
-            else:
-                remote_dest_dir = posixpath.join(destination, current_dir)
-
-            # Clean subdirs & files from dotfiles if wanted - some FTP daemons
-            # hate dotfiles.
-            if ignore_dotfiles:
-                # Copy the list, and remove dotfiles and dirs from the real
-                # list. We need to use remove and not some shady filter
-                # because otherwise we'll walk into dotdirs and defeat the
-                # purpose of the parameter.
-                for subdir in subdirs[:]:
-                    if subdir.startswith("."):
-                        subdirs.remove(subdir)
-                for filename in files[:]:
-                    if filename.startswith("."):
-                        files.remove(filename)
-
-            # Create all directories required.
-            for subdir in subdirs:
-                # Ignore FTP exceptions here because if they're fatal, we'll
-                # get it later when we upload.
-                try:
-                    self.mkdir(posixpath.join(remote_dest_dir, subdir))
-                except ftplib.Error:
-                    pass
+    def pipeline(self, commands, callback=None):
+        """Send each of `commands` without waiting for the reply to the one
+        before, and return a list of the replies, in order.
 
-            # Upload all files.
-            for filename in files:
-                local_source_file = path.join(current_dir, filename)
-                remote_dest_file = posixpath.join(remote_dest_dir, filename)
-                f = self.file_proxy(remote_dest_file)
-                f.upload_from_file(local_source_file)
+        Error replies are not raised, but show up in the list as the
+        ftplib.Error instance they would have raised. At most
+        `pipeline_window` commands are in flight at once. If given,
+        `callback(index, reply)` is called as each reply arrives.
+        """
+        ftp_obj = self.ftp_obj
+        replies = []
+        def receive():
+            reply = _getresp_or_error(ftp_obj)
+            if callback is not None:
+                callback(len(replies), reply)
+            replies.append(reply)
+        sent = 0
+        for command in commands:
+            if sent - len(replies) >= self.pipeline_window:
+                receive()
+            ftp_obj.putcmd(command)
+            sent += 1
+        while len(replies) < sent:
+            receive()
+        return replies
 
     def makedirs(self, dpath):
-        """Try to create directories out of each part of `dpath`.
+        """Make sure directory `dpath` exists, creating whatever parts of it
+        don't.
 
-        First tries to change directory into `dpath`, to see if it exists. If
-        it does, returns immediately. Otherwise, splits `dpath` up into parts,
-        trying to create each accumulated part as a directory.
+        Directories this host has created or seen exist are remembered, and
+        not asked about again. Otherwise `dpath` is first simply created,
+        which is all it takes if only its last part is missing. If that fails
+        and it doesn't exist, its parents are checked from the deepest up
+        until one that exists is found, and the missing ones below it are
+        created.
         """
-        # First try to chdir to the target directory, to skip excess attempts
-        # at directory creation. XXX: Probably should try full path, then cut
-        # off a piece and try again, recursively.
-        pwd = self.current_directory
+        known = self._known_dirs
+        directory = posixpath.normpath(self._absolute(dpath))
+        if directory in known or directory == "/":
+            return
         try:
-            self.current_directory = dpath
+            self.mkdir(directory)
         except ftplib.Error:
             pass
         else:
             return
-        finally:
-            self.current_directory = pwd
-        # Then if we're still alive, split the path up.
-        parts = dpath.split(posixpath.sep)
-        # Then iterate through the parts.
-        cdir = ""
-        for dir in parts:
-            cdir += dir + "/"
-            # No point in trying to create the directory again when we only
-            # added a slash.
-            if not dir:
-                continue
+        if self._isdir(directory):
+            self._exists(directory)
+            return
+        missing = [directory]
+        directory = posixpath.dirname(directory)
+        while directory not in known and directory != "/":
+            if self._isdir(directory):
+                self._exists(directory)
+                break
+            missing.append(directory)
+            directory = posixpath.dirname(directory)
+        for directory in reversed(missing):
             try:
-                self.mkdir(cdir)
+                self.mkdir(directory)
             except ftplib.Error:
                 pass
 
+    def _exists(self, directory):
+        _add_known_dir(self._known_dirs, directory)
+
+    def _isdir(self, directory):
+        """Whether `directory` exists, asked with MLST if the server has it,
+        and by changing into it and back if not.
+        """
+        if "MLST" in self.features:
+            try:
+                resp = self.ftp_obj.sendcmd("MLST " + directory)
+            except ftplib.error_perm:
+                return False
+            return _mlst_is_dir(resp)
+        cwd = self.current_directory
+        try:
+            self.ftp_obj.cwd(directory)
+        except ftplib.error_perm:
+            return False
+        self.ftp_obj.cwd(cwd)
+        return True
+
     def quit(self):
         """Send quit command and close connection."""
         self.ftp_obj.quit()
@@ -262,16 +2134,431 @@ class FTPHost(object):
         except:
             self.close()
 
+def _mirror_to_remote_plan(source, destination, ignore_dotfiles,
+                           progress=None):
+    """Walk local `source`, and return a list of remote directories to
+    create, parents first, and a list of (local_file, remote_file) to
+    upload. What the journal of _MirrorProgress `progress` has as done is
+    left out, and the rest registered with it.
+    """
+    directories = []
+    transfers = []
+    for current_dir, subdirs, files in os.walk(source):
+        # Current remote destination = destination dir + current.
+        # See mirror_to_local for the census of special-casing the empty
+        # string.
+        if source:
+            remote_dest_dir = posixpath.join(destination,
+                current_dir[len(source) + 1:])
+        else:
+            remote_dest_dir = posixpath.join(destination, current_dir)
+
+        # Clean subdirs & files from dotfiles if wanted - some FTP daemons
+        # hate dotfiles.
+        if ignore_dotfiles:
+            # Copy the list, and remove dotfiles and dirs from the real
+            # list. We need to use remove and not some shady filter
+            # because otherwise we'll walk into dotdirs and defeat the
+            # purpose of the parameter.
+            for subdir in subdirs[:]:
+                if subdir.startswith("."):
+                    subdirs.remove(subdir)
+            for filename in files[:]:
+                if filename.startswith("."):
+                    files.remove(filename)
+
+        # Keep the order predictable.
+        subdirs.sort()
+        files.sort()
+        if progress is not None:
+            subdirs[:], files = _journal_filter(progress, current_dir,
+                                                subdirs, files, path.join)
+        for subdir in subdirs:
+            directories.append(posixpath.join(remote_dest_dir, subdir))
+        for filename in files:
+            local_source_file = path.join(current_dir, filename)
+            remote_dest_file = posixpath.join(remote_dest_dir, filename)
+            transfers.append((local_source_file, remote_dest_file))
+    return directories, transfers
+
+def _journal_filter(progress, directory, subdirs, files, join):
+    """Return the lists `subdirs` and `files` of `directory`, names or
+    FTPEntry objects, without those the journal of _MirrorProgress
+    `progress` has as done, and register `directory` with what's left.
+    Paths are put together with `join`.
+    """
+    journal = progress.journal
+    left = ([], [])
+    children = []
+    for (entries, todo) in zip((subdirs, files), left):
+        for entry in entries:
+            name = join(directory, getattr(entry, "name", entry))
+            if name not in journal:
+                todo.append(entry)
+                children.append(name)
+    progress.add_dir(directory, children)
+    return left
+
+def _listdir_one(host, directory, entries=False):
+    return host.listdir(directory, entries=entries)
+
+# Returned by _download_one and _upload_one instead of a byte count when they
+# didn't transfer anything.
+_skipped = object()
+_pending = object()
+
+def _download_one(host, transfer, incremental=False, dry_run=False,
+                  verify=False):
+    """Download (remote_file, target_file, size, mtime) over `host`, and
+    return the number of bytes downloaded. The size and modification time of
+    the remote file are asked for if None and needed. If the server can't
+    tell the time, files are compared by size alone, and the downloaded file
+    keeps its own time.
+    """
+    remote_file, target_file, size, mtime = transfer
+    f = host.file_proxy(remote_file)
+    if incremental:
+        if path.exists(target_file):
+            st = os.stat(target_file)
+            if size is None:
+                size = f.size()
+            if size == st.st_size:
+                if verify:
+                    if _same_checksum(f, target_file):
+                        return _skipped
+                else:
+                    if mtime is None:
+                        mtime = _remote_mtime(f)
+                    if mtime is None or mtime == int(st.st_mtime):
+                        return _skipped
+    if dry_run:
+        return _pending
+    f.download_to_file(target_file, verify=verify)
+    if incremental:
+        if mtime is None:
+            mtime = _remote_mtime(f)
+        if mtime is not None:
+            os.utime(target_file, (mtime, mtime))
+    return path.getsize(target_file)
+
+def _remote_mtime(f):
+    """Return the modification time of file proxy `f`, or None if the server
+    won't tell, as without MDTM.
+    """
+    try:
+        return f.mtime()
+    except ftplib.error_perm:
+        return None
+
+def _upload_one(host, transfer, incremental=False, dry_run=False,
+                verify=False):
+    """Upload (local_file, remote_file) over `host`, and return the number of
+    bytes uploaded.
+    """
+    local_file, remote_file = transfer
+    f = host.file_proxy(remote_file)
+    if incremental:
+        st = os.stat(local_file)
+        try:
+            unchanged = f.size() == st.st_size and (
+                _same_checksum(f, local_file) if verify else
+                f.mtime() >= int(st.st_mtime))
+        except ftplib.error_perm:
+            # Most likely there's no such file.
+            unchanged = False
+        if unchanged:
+            return _skipped
+    if dry_run:
+        return _pending
+    f.upload_from_file(local_file, verify=verify)
+    return path.getsize(local_file)
+
+def _same_checksum(f, filename):
+    """Whether remote file proxy `f` and local file `filename` have the same
+    checksum, by the best algorithm the server has.
+    """
+    algorithm = f.host._checksum_algorithm()
+    hash = _hash_file(filename, _new_hash(algorithm))
+    return f.checksum(algorithm) == hash.hexdigest()
+
+def _copy_one(host, target_host, transfer, entry, incremental=False,
+              dry_run=False):
+    """Copy (source_file, target_file) from `host` to `target_host`, and
+    return the number of bytes copied, as told by listing `entry`.
+    """
+    source_file, target_file = transfer
+    if incremental:
+        target = target_host.file_proxy(target_file)
+        try:
+            unchanged = target.size() == entry.size and \
+                target.mtime() >= (entry.mtime or 0)
+        except ftplib.error_perm:
+            # Most likely there's no such file.
+            unchanged = False
+        if unchanged:
+            return _skipped
+    if dry_run:
+        return _pending
+    host.file_proxy(source_file).copy(target_file, target_host)
+    return entry.size or 0
+
+def _record_transfer(stats, result, progress=None):
+    transfer, nbytes, exc = result
+    if exc is not None:
+        stats.add_error(transfer[0], exc)
+        return
+    elif nbytes is _skipped:
+        stats.add_skipped()
+    elif nbytes is _pending:
+        stats.add_pending(transfer[:2])
+        return
+    else:
+        stats.add(nbytes)
+    if progress is not None:
+        progress.done(transfer[0])
+
+def _add_known_dir(known, directory):
+    """Add absolute path `directory`, and so its parents, to the set of
+    directories `known` to exist.
+    """
+    while directory not in known and directory != "/":
+        known.add(directory)
+        directory = posixpath.dirname(directory)
+
+def _discard_known_dirs(known, directory):
+    """Remove `directory` and everything below it from `known`."""
+    prefix = directory.rstrip("/") + "/"
+    for d in list(known):
+        if d == directory or d.startswith(prefix):
+            known.discard(d)
+
+def _mlst_is_dir(resp):
+    """Whether an MLST reply `resp` is about a directory."""
+    lines = resp.splitlines()
+    if len(lines) < 3:
+        return False
+    facts = lines[1].strip().partition(" ")[0]
+    return any(fact.lower() in ("type=dir", "type=cdir", "type=pdir")
+               for fact in facts.split(";"))
+
+# Data connections of FTP_TLS clients, where ftplib has the ssl module.
+_ssl_sockets = getattr(getattr(ftplib, "ssl", None), "SSLSocket", ())
+
+def _start_transfer(ftp_obj, type, command, rest=None):
+    """Switch to transfer type `type`, send `command` and return the data
+    connection it opens.
+    """
+    ftp_obj.voidcmd("TYPE " + type)
+    return ftp_obj.transfercmd(command, rest)
+
+def _end_transfer(ftp_obj, conn, completed):
+    """Close data connection `conn` and read the reply on the transfer. If it
+    wasn't `completed`, the server's complaint about the closed connection is
+    discarded. Either way the reply is read, so the control connection stays
+    in step.
+    """
+    if completed and isinstance(conn, _ssl_sockets):
+        # As ftplib does, end TLS on the data connection cleanly.
+        conn.unwrap()
+    conn.close()
+    if completed:
+        ftp_obj.voidresp()
+    else:
+        try:
+            ftp_obj.voidresp()
+        except ftplib.Error:
+            pass
+
+def _getresp_or_error(ftp_obj):
+    try:
+        return ftp_obj.getresp()
+    except ftplib.Error as e:
+        return e
+
+def _abort(ftp_obj):
+    """Abort the transfer going on over `ftp_obj`, discarding the replies."""
+    try:
+        ftp_obj.putcmd("ABOR")
+        ftp_obj.getresp()
+    except ftplib.error_temp:
+        # 426 for the transfer, then the reply to ABOR.
+        try:
+            ftp_obj.getresp()
+        except ftplib.Error:
+            pass
+    except ftplib.Error:
+        pass
+
+def _fxp(source, destination):
+    """Have the server of file proxy `source` send the file straight to the
+    server of file proxy `destination`, over a data connection between the
+    two (FXP). Both servers must allow that.
+    """
+    src, dst = source.ftp_obj, destination.ftp_obj
+    source._start_mode(compress=False)
+    destination._start_mode(compress=False)
+    src.voidcmd("TYPE I")
+    dst.voidcmd("TYPE I")
+    # The destination listens, and the source connects to it.
+    address, port = dst.makepasv()
+    if ":" in address:
+        src.sendeprt(address, port)
+    else:
+        src.sendport(address, port)
+    # Some servers only reply to STOR once the data connection is made, so
+    # RETR must be sent before waiting for that.
+    dst.putcmd("STOR " + destination.filename)
+    src.putcmd("RETR " + source.filename)
+    replies = [_getresp_or_error(dst), _getresp_or_error(src)]
+    for (i, reply) in enumerate(replies):
+        if not isinstance(reply, Exception) and not reply.startswith("1"):
+            replies[i] = ftplib.error_reply(reply)
+    failed = [reply for reply in replies if isinstance(reply, Exception)]
+    if failed:
+        for (ftp_obj, reply) in zip((dst, src), replies):
+            if not isinstance(reply, Exception):
+                _abort(ftp_obj)
+        raise failed[0]
+    failed = [_getresp_or_error(src), _getresp_or_error(dst)]
+    failed = [reply for reply in failed if isinstance(reply, Exception)]
+    if failed:
+        raise failed[0]
+
+def _allocate(fp, size):
+    """Make the file of file object `fp` `size` bytes long, reserving the
+    disk space for it where the system allows.
+    """
+    fallocate = getattr(os, "posix_fallocate", None)
+    if fallocate is not None and size:
+        try:
+            fallocate(fp.fileno(), 0, size)
+            return
+        except OSError:
+            # Not supported by the file system, say.
+            pass
+    fp.truncate(size)
+
+def _download_range(f, filename, start, end, progress, i):
+    """Download bytes `start` to `end` of remote file proxy `f` into the same
+    place of local file `filename`, adding to `progress[i]` as they're
+    written.
+    """
+    ftp_obj = f.ftp_obj
+    # The offsets are into the file, not into a deflated stream.
+    f._start_mode(compress=False)
+    throttle = f._throttle()
+    metrics, started = f._metrics, time.time()
+    fp = open(filename, "r+b")
+    try:
+        fp.seek(start)
+        conn = _start_transfer(ftp_obj, "I", "RETR %s" % (f.filename,),
+                               start or None)
+        completed = False
+        nbytes = 0
+        try:
+            while start < end:
+                data = conn.recv(min(f.blocksize, end - start))
+                if not data:
+                    raise EOFError("%s ended at %d bytes, before %d" %
+                                   (f.filename, start, end))
+                if throttle is not None:
+                    throttle(data)
+                fp.write(data)
+                nbytes += len(data)
+                start += len(data)
+                progress[i] += len(data)
+            # A range up to the end of the file finishes the transfer.
+            completed = not conn.recv(1)
+        finally:
+            # Otherwise closing the data connection leaves the server to give
+            # up on the rest of the file; no ABOR is sent.
+            _end_transfer(ftp_obj, conn, completed)
+            if metrics is not None:
+                metrics.transfer("download", nbytes, time.time() - started)
+    finally:
+        fp.close()
+
+def _send_mapped(conn, mapped, start, end, blocksize, throttle=None):
+    """Send bytes `start` to `end` of memory map `mapped` over socket `conn`,
+    in blocks of `blocksize` bytes if throttled, and return how many."""
+    if throttle is None:
+        conn.sendall(_view(mapped, start, end))
+        return end - start
+    for offset in range(start, end, blocksize):
+        block = _view(mapped, offset, min(offset + blocksize, end))
+        conn.sendall(block)
+        throttle.consume(len(block))
+    return end - start
+
+def _get_one(host, source, destination):
+    return host.file_proxy(source).download_to_file(destination)
+
+def _put_one(host, source, destination):
+    return host.file_proxy(destination).upload_from_file(source)
+
 class FTPFileClient(FTPHost):
     """Class for emulating an FTP client, that is, get & put files to and from.
+
+    `mget`, `mput` and `mdelete` don't stop at the first file that fails.
+    They return a list with a result for each file, in order: None if it was
+    done, and the exception it failed with if not. `callback(filename,
+    result)`, if given, is called with the same result as each file is done.
     """
 
-    def _apply_all(self, filenames, f):
-        rs = []
-        for filename in filenames:
-            source, destination = filename, path.basename(filename)
-            rs.append(f(source, destination))
-        return rs
+    def _apply_all(self, func, transfers, workers=1, connection_pool=None,
+                   callback=None):
+        """Run `func(host, source, destination)` for each (source,
+        destination) pair of `transfers`, and return the results of the
+        calls as described for the class.
+
+        After a failure, the connection is replaced unless it was a permanent
+        error (5xx reply) or an error with a local file. With `workers`
+        greater than one, the calls are spread over that many extra
+        connections (from `connection_pool` if given).
+        """
+        transfers = list(transfers)
+        results = [None] * len(transfers)
+        def done(i, result):
+            if not isinstance(result, Exception):
+                result = None
+            results[i] = result
+            if callback is not None:
+                callback(transfers[i][0], result)
+        if workers <= 1:
+            for i, (source, destination) in enumerate(transfers):
+                try:
+                    result = func(self, source, destination)
+                except Exception as e:
+                    result = e
+                    if not _keeps_connection(e):
+                        try:
+                            self.reconnect()
+                        except Exception:
+                            # Try again on the next failure.
+                            pass
+                done(i, result)
+            return results
+        pool = self._workers(lambda host, item: func(host, *item[1:]),
+                             workers, connection_pool)
+        pending = 0
+        try:
+            for i, (source, destination) in enumerate(transfers):
+                pool.put((i, source, destination))
+                pending += 1
+                while True:
+                    try:
+                        item, result, exc = pool.get(block=False)
+                    except queue.Empty:
+                        break
+                    pending -= 1
+                    done(item[0], result if exc is None else exc)
+        finally:
+            pool.close()
+        while pending:
+            pending -= 1
+            item, result, exc = pool.get()
+            done(item[0], result if exc is None else exc)
+        return results
 
     def get(self, source, destination):
         return self.file_proxy(source).download_to_file(destination)
@@ -283,14 +2570,52 @@ class FTPFileClient(FTPHost):
         return self.file_proxy(filename).delete()
 
     # {{{ m*
-    def mget(self, filenames):
-        return self._apply_all(self.get, filenames)
+    def mget(self, filenames, workers=1, connection_pool=None, callback=None):
+        """Download each of the remote `filenames` into a local file of the
+        same base name in the current directory, with `workers` connections
+        at once (from `connection_pool` if given). See the class for the
+        results.
+        """
+        transfers = [(self._absolute(filename), path.basename(filename))
+                     for filename in filenames]
+        return self._apply_all(_get_one, transfers, workers, connection_pool,
+                               callback)
+
+    def mput(self, filenames, workers=1, connection_pool=None, callback=None):
+        """Upload each of the local `filenames` into a remote file of the same
+        base name in the current directory, with `workers` connections at
+        once like `mget`. See the class for the results.
+        """
+        transfers = [(filename, self._absolute(path.basename(filename)))
+                     for filename in filenames]
+        return self._apply_all(_put_one, transfers, workers, connection_pool,
+                               callback)
 
-    def mput(self, filenames):
-        return self._apply_all(self.put, filenames)
+    def mdelete(self, filenames, callback=None):
+        """Delete each of the remote `filenames`. See the class for the
+        results.
 
-    def mdelete(self, filenames):
-        return self._apply_all(self.delete, filenames)
+        The DELE commands are pipelined (see `pipeline`), so this costs about
+        one round trip per `pipeline_window` files, and `callback` is called
+        as each reply arrives.
+        """
+        filenames = list(filenames)
+        def done(i, reply):
+            if isinstance(reply, Exception):
+                result = reply
+            elif reply[:3] in ("250", "200"):
+                result = None
+            else:
+                result = ftplib.error_reply(reply)
+            results.append(result)
+            if callback is not None:
+                callback(filenames[i], result)
+        results = []
+        self.pipeline(("DELE " + filename for filename in filenames),
+                      callback=done)
+        for filename in filenames:
+            self._changed(filename)
+        return results
     # }}}
 
 
@@ -306,6 +2631,7 @@ class ExtensionMappedFTPHost(FTPHost):
         extension_map = kw.pop("extension_map", {})
         self = super(ExtensionMappedFTPHost, cls).connect(*a, **kw)
         self.extension_map = extension_map
+        self._connect_args["extension_map"] = extension_map
         return self
 
     def file_proxy(self, filename):
@@ -320,52 +2646,1033 @@ class ExtensionMappedFTPHost(FTPHost):
                 break
         return super(ExtensionMappedFTPHost, self).file_proxy(filename)
 
+class FTPConnectionPool(object):
+    """A pool of logged-in connections to one server, for reuse across jobs.
+
+    Connections are made with `host_class.connect` and the given parameters,
+    at most `max_connections` of them at a time; `acquire` blocks until one
+    is available. An idle connection is checked with a NOOP before it's handed
+    out again, and closed instead if that fails or it's been idle for more
+    than `max_idle` seconds.
+
+    If `keepalive` is given, a thread sends NOOP over idle connections every
+    that many seconds, so the server doesn't time them out.
+
+    The counters `hits`, `misses` and `evictions` tell how many times an idle
+    connection could be reused, how many times a new one had to be made, and
+    how many idle ones were thrown away.
+    """
+
+    def __init__(self, host, port=21, user=None, password=None, account=None,
+                 max_connections=4, max_idle=300, keepalive=None,
+                 host_class=FTPHost, **kwds):
+        self.connect_args = dict(host=host, port=port, user=user,
+                                 password=password, account=account, **kwds)
+        self.host_class = host_class
+        self.max_connections = max_connections
+        self.max_idle = max_idle
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Two-tuples (host, time released), most recently released last.
+        self._idle = []
+        self._in_use = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        if keepalive:
+            thread = threading.Thread(target=self._keepalive_loop,
+                                      args=(keepalive,))
+            thread.daemon = True
+            thread.start()
+
+    @classmethod
+    def from_host(cls, host, **kwds):
+        """Create a pool of connections like `host`, which must have been
+        created by `connect`.
+        """
+        if host._connect_args is None:
+            raise ValueError("%r was not created by connect" % (host,))
+        connect_args = dict(host._connect_args)
+        connect_args.update(kwds)
+        return cls(host_class=host.__class__, **connect_args)
+
+    def __str__(self):
+        return "<%s %s:%d, %d in use, %d idle, %d hits, %d misses>" % (
+            self.__class__.__name__, self.connect_args["host"],
+            self.connect_args["port"], self._in_use, len(self._idle),
+            self.hits, self.misses)
+
+    @property
+    def hit_rate(self):
+        """The share of `acquire` calls served by an idle connection."""
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return float(self.hits) / total
+
+    def acquire(self):
+        """Return a logged-in host, reused if possible."""
+        with self._cond:
+            while self._in_use >= self.max_connections:
+                self._cond.wait()
+            self._in_use += 1
+        try:
+            while True:
+                with self._cond:
+                    if not self._idle:
+                        break
+                    host, released = self._idle.pop()
+                if time.time() - released > self.max_idle:
+                    self._evict(host)
+                    continue
+                try:
+                    host.ftp_obj.voidcmd("NOOP")
+                except Exception:
+                    self._evict(host, broken=True)
+                    continue
+                with self._cond:
+                    self.hits += 1
+                return host
+            with self._cond:
+                self.misses += 1
+            return self.host_class.connect(**self.connect_args)
+        except:
+            self._done()
+            raise
+
+    def release(self, host, broken=False):
+        """Give back `host`, acquired earlier. If `broken` is True, or the
+        pool has been closed, the connection is closed.
+        """
+        if broken or self._closed:
+            _close_host(host, broken)
+        else:
+            with self._cond:
+                self._idle.append((host, time.time()))
+        self._done()
+
+    def connection(self):
+        """Return a context manager that acquires a host, and releases it on
+        exit; as broken if an exception other than a 5xx reply or an error
+        with a local file was raised.
+        """
+        return _PooledConnection(self)
+
+    def prune(self):
+        """Close connections that have been idle for too long."""
+        now = time.time()
+        with self._cond:
+            expired = [(h, t) for (h, t) in self._idle
+                       if now - t > self.max_idle]
+            for pair in expired:
+                self._idle.remove(pair)
+        for (host, released) in expired:
+            self._evict(host)
+
+    def keepalive(self):
+        """Send NOOP over each idle connection, closing those that fail."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+        alive = []
+        for (host, released) in idle:
+            try:
+                host.ftp_obj.voidcmd("NOOP")
+            except Exception:
+                self._evict(host, broken=True)
+            else:
+                alive.append((host, released))
+        with self._cond:
+            self._idle[:0] = alive
+
+    def close(self):
+        """Close all idle connections; those in use are closed as they're
+        released.
+        """
+        self._closed = True
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for (host, released) in idle:
+            _close_host(host)
+
+    def _keepalive_loop(self, interval):
+        while not self._closed:
+            time.sleep(interval)
+            self.prune()
+            self.keepalive()
+
+    def _evict(self, host, broken=False):
+        with self._cond:
+            self.evictions += 1
+        _close_host(host, broken)
+
+    def _done(self):
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify()
+
+class _PooledConnection(object):
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __enter__(self):
+        self.host = self.pool.acquire()
+        return self.host
+
+    def __exit__(self, exc_type, exc_value, tb):
+        broken = exc_type is not None and not _keeps_connection(exc_value)
+        self.pool.release(self.host, broken)
+
+# Errnos of socket errors a transfer is worth retrying after. On Python 3,
+# socket.error is OSError, so these tell network trouble from local trouble
+# like a full disk.
+_network_errnos = frozenset(getattr(errno, name) for name in (
+    "ECONNRESET", "ECONNABORTED", "ECONNREFUSED", "EPIPE", "ETIMEDOUT",
+    "ENETDOWN", "ENETUNREACH", "ENETRESET", "EHOSTDOWN", "EHOSTUNREACH",
+    "ENOTCONN", "ESHUTDOWN") if hasattr(errno, name))
+
+# Exception types of errors with local files. Socket errors are subclasses of
+# these on Python 2, and so are told apart by exact type.
+_local_error_types = tuple(getattr(six.moves.builtins, name) for name in (
+    "IOError", "OSError", "FileNotFoundError", "FileExistsError",
+    "PermissionError", "IsADirectoryError", "NotADirectoryError")
+    if hasattr(six.moves.builtins, name))
+
+def _is_transient(exc):
+    """Whether a transfer that failed with `exc` is worth retrying on a new
+    connection: after a 4xx reply, the connection closing or timing out, or
+    some other network error.
+    """
+    if isinstance(exc, (EOFError, ftplib.error_temp, socket.timeout)):
+        return True
+    if not isinstance(exc, socket.error):
+        return False
+    if six.PY2:
+        return True
+    return isinstance(exc, ConnectionError) or exc.errno in _network_errnos
+
+def _keeps_connection(exc):
+    """Whether a connection is still good after failing with `exc`: a 5xx
+    reply, or an error with a local file.
+    """
+    if isinstance(exc, ftplib.error_perm):
+        return True
+    return type(exc) in _local_error_types and not _is_transient(exc)
+
+# Whether sockets can send files straight from the kernel, as of Python 3.5.
+# Where they can't, files are sent out of memory maps instead.
+_has_sendfile = hasattr(socket.socket, "sendfile")
+
+if six.PY2:
+    def _view(data, start, end):
+        return buffer(data, start, end - start)
+else:
+    def _view(data, start, end):
+        return memoryview(data)[start:end]
+
+# Data connections of these are encrypted, so not for sendfile.
+_tls_clients = getattr(ftplib, "FTP_TLS", ())
+
 class FTPFileProxy(object):
-    def __init__(self, ftp_obj, filename):
-        """Initialize file an ftplib.FTPConnection, and filename."""
+    # Seconds to wait before the first retry of a failed transfer; doubled
+    # for each retry after that.
+    retry_delay = 1.0
+
+    # Bytes to read from or send to the data connection at a time, unless
+    # told otherwise.
+    blocksize = 65536
+
+    # The least bytes worth splitting off into a segment of its own, for
+    # download_segmented.
+    min_segment_size = 8 << 20
+
+    # Whether to upload regular files with sendfile, or out of a memory map
+    # where there's no sendfile, rather than by reading them block by block.
+    use_sendfile = True
+
+    def __init__(self, ftp_obj, filename, host=None):
+        """Initialize file an ftplib.FTPConnection, and filename. If the
+        FTPHost `host` is given, it's used to reconnect when retrying.
+        """
         self.ftp_obj = ftp_obj
         self.filename = filename
+        self.host = host
+        # A RateLimiter for transfers of this file in particular, applied
+        # before the host's, and their priority if not the host's.
+        self.rate_limiter = None
+        self.priority = None
+
+    @property
+    def _metrics(self):
+        if self.host is None:
+            return None
+        return self.host.metrics
+
+    def _throttle(self, func=None):
+        """Return a callback throttling a transfer as the rate limiters of
+        the file and host require, calling `func` with each block, or just
+        `func` if there are none.
+        """
+        limiters = [self.rate_limiter]
+        priority = self.priority
+        if self.host is not None:
+            if self.host.rate_limiter is not self.rate_limiter:
+                limiters.append(self.host.rate_limiter)
+            if priority is None:
+                priority = self.host.priority
+        limiters = [limiter for limiter in limiters if limiter is not None]
+        if not limiters:
+            return func
+        return _Throttle(limiters, priority or 0, func)
+
+    def _start_mode(self, compress=True):
+        """Set the transfer mode of the server for a transfer of the file:
+        MODE Z if the host is set to compress and `compress` is True, and
+        stream mode otherwise. Return the compression level, or None.
+        """
+        if self.host is None:
+            return None
+        level = None
+        if compress:
+            level = self.host._transfer_compression()
+        if level is None:
+            self.host._set_mode("S")
+        else:
+            self.host._set_mode("Z", level)
+        return level
+
+    def _retry(self, transfer, retries):
+        """Call `transfer(attempt)` until it doesn't fail with a transient
+        error, at most `retries` more times. Before each retry, reconnect
+        through the host.
+        """
+        attempt = 0
+        while True:
+            try:
+                if attempt:
+                    self.host.reconnect()
+                    self.ftp_obj = self.host.ftp_obj
+                return transfer(attempt)
+            except Exception as e:
+                if not _is_transient(e) or attempt >= retries or \
+                        self.host is None:
+                    raise
+                if self._metrics is not None:
+                    self._metrics.retry(self.filename, e)
+                time.sleep(self.retry_delay * 2 ** attempt)
+                attempt += 1
+
+    def upload(self, fp, rest=None):
+        """Uploadad file from file-like object fp. If `rest` is given, append
+        to the remote file instead.
+
+        A regular file is sent from where it's at with sendfile, or out of a
+        memory map on Pythons without it, unless `use_sendfile` is False or
+        the transfer is compressed or encrypted.
+        """
+        metrics = self._metrics
+        if rest:
+            command = "APPE %s" % (self.filename,)
+        else:
+            command = "STOR %s" % (self.filename,)
+        level = self._start_mode()
+        if level is not None:
+            fp = _CompressingFile(fp, level)
+        sendfile = level is None and self._can_sendfile(fp)
+        callback = self._throttle()
+        counter = started = None
+        if metrics is not None:
+            counter, started = _ByteCounter(callback), time.time()
+            callback = counter
+        try:
+            if sendfile:
+                nbytes = self._sendfile(command, fp)
+                if counter is not None:
+                    counter.bytes += nbytes
+            else:
+                self._send(command, fp, callback)
+        finally:
+            self._changed()
+            if metrics is not None:
+                metrics.transfer("upload", counter.bytes,
+                                 time.time() - started)
+
+    def _send(self, command, fp, callback=None):
+        """Send `command` and what's left of file-like object `fp` over the
+        data connection it opens, passing each block to `callback` if given.
+        Unlike ftplib's storbinary, the reply is read even if reading `fp`
+        fails.
+        """
+        ftp_obj = self.ftp_obj
+        conn = _start_transfer(ftp_obj, "I", command)
+        completed = False
+        try:
+            while True:
+                data = fp.read(self.blocksize)
+                if not data:
+                    break
+                conn.sendall(data)
+                if callback is not None:
+                    callback(data)
+            completed = True
+        finally:
+            _end_transfer(ftp_obj, conn, completed)
+
+    def _receive(self, command, callback, rest=None):
+        """Send `command` and pass each block arriving over the data
+        connection it opens to `callback`. Unlike ftplib's retrbinary, the
+        reply is read even if `callback` fails.
+        """
+        ftp_obj = self.ftp_obj
+        conn = _start_transfer(ftp_obj, "I", command, rest)
+        completed = False
+        try:
+            while True:
+                data = conn.recv(self.blocksize)
+                if not data:
+                    break
+                callback(data)
+            completed = True
+        finally:
+            _end_transfer(ftp_obj, conn, completed)
+
+    def _can_sendfile(self, fp):
+        if not self.use_sendfile or isinstance(self.ftp_obj, _tls_clients):
+            return False
+        try:
+            return stat.S_ISREG(os.fstat(fp.fileno()).st_mode)
+        except (AttributeError, EnvironmentError, ValueError):
+            # Not backed by a file at all.
+            return False
+
+    def _sendfile(self, command, fp):
+        """Send `command` and the rest of regular file `fp` over the data
+        connection it opens, with sendfile or out of a memory map, and return
+        the number of bytes sent. When throttled, the file goes `blocksize`
+        bytes at a time.
+        """
+        ftp_obj = self.ftp_obj
+        throttle = self._throttle()
+        offset = fp.tell()
+        size = os.fstat(fp.fileno()).st_size
+        mapped = None
+        if not _has_sendfile and size > offset:
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            conn = _start_transfer(ftp_obj, "I", command)
+            completed = False
+            nbytes = 0
+            try:
+                if not _has_sendfile:
+                    # An empty file can't be mapped, and has nothing to send.
+                    if mapped is not None:
+                        nbytes = _send_mapped(conn, mapped, offset, size,
+                                              self.blocksize, throttle)
+                elif throttle is None:
+                    nbytes = conn.sendfile(fp, offset)
+                else:
+                    while True:
+                        n = conn.sendfile(fp, offset + nbytes, self.blocksize)
+                        if not n:
+                            break
+                        nbytes += n
+                        throttle.consume(n)
+                completed = True
+            finally:
+                _end_transfer(ftp_obj, conn, completed)
+        finally:
+            if mapped is not None:
+                mapped.close()
+        fp.seek(offset + nbytes)
+        return nbytes
 
-    def upload(self, fp):
-        """Uploadad file from file-like object fp."""
-        self.ftp_obj.storbinary("STOR %s" % (self.filename,), fp)
+    def _changed(self, filename=None, recursive=False):
+        if self.host is not None:
+            self.host._changed(filename or self.filename, recursive)
 
     def upload_from_str(self, v):
         """Upload file from contents in string v."""
         self.upload(six.BytesIO(v))
 
-    def upload_from_file(self, filename):
-        """Upload file from file identified by name filename."""
-        fp = file(filename, "rb")
+    def upload_from_file(self, filename, resume=False, retries=0,
+                         verify=False):
+        """Upload file from file identified by name filename.
+
+        If `resume` is True and the remote file exists, only the part of the
+        file past its size is uploaded and appended to it. If `retries` is
+        more than zero, failed uploads are retried, resumed, over a new
+        connection up to that many times.
+
+        If `verify` is True, the file is hashed as it's sent, and
+        ChecksumError is raised if the server's checksum of the uploaded file
+        differs; see `checksum`. Only a part already on the server from
+        before is read an extra time for that.
+        """
+        algorithm = self._verify_algorithm(verify)
+        def transfer(attempt):
+            offset = 0
+            if resume or attempt:
+                offset = self._remote_offset(path.getsize(filename))
+                if offset is None:
+                    return None
+            fp = open(filename, "rb")
+            try:
+                fp.seek(offset)
+                if algorithm is None:
+                    self.upload(fp, rest=offset)
+                    return None
+                hash = _new_hash(algorithm)
+                if offset:
+                    _hash_file(filename, hash, offset)
+                self.upload(_HashingFile(fp, hash), rest=offset)
+                return hash
+            finally:
+                fp.close()
+        hash = self._retry(transfer, retries)
+        if algorithm is not None:
+            self._verify(filename, algorithm, hash)
+
+    def _remote_offset(self, size):
+        """Return where to resume transferring a file of `size` bytes with
+        the remote file being what has been transferred so far, or None if
+        it's complete already.
+        """
+        try:
+            offset = self.size()
+        except ftplib.error_perm:
+            return 0
+        if offset == size:
+            return None
+        elif offset > size:
+            # Not the same file; start over.
+            return 0
+        return offset
+
+    def size(self):
+        """Return the size of the file in bytes, as told by the SIZE command.
+        """
+        try:
+            return self.ftp_obj.size(self.filename)
+        except ftplib.error_perm:
+            # Some servers refuse SIZE in ASCII mode, which is what we're in
+            # after a listing.
+            self.ftp_obj.voidcmd("TYPE I")
+            return self.ftp_obj.size(self.filename)
+
+    def mtime(self):
+        """Return the modification time of the file as a UNIX timestamp, as
+        told by the MDTM command.
+        """
+        resp = self.ftp_obj.voidcmd("MDTM " + self.filename)
+        return _parse_timeval(resp[4:])
+
+    def download(self, fp, rest=None):
+        """Download file into file-like object fp. If `rest` is given, start
+        at that offset into the file.
+        """
+        metrics = self._metrics
+        write = decompressor = None
+        if self._start_mode() is not None:
+            write = decompressor = _Decompressor(fp.write)
+        callback = self._throttle(write or fp.write)
+        if metrics is None:
+            self._receive("RETR %s" % (self.filename,), callback, rest)
+        else:
+            counter, started = _ByteCounter(callback), time.time()
+            try:
+                self._receive("RETR %s" % (self.filename,), counter, rest)
+            finally:
+                metrics.transfer("download", counter.bytes,
+                                 time.time() - started)
+        if decompressor is not None:
+            decompressor.flush()
+
+    def iter_chunks(self, blocksize=None, rest=None):
+        """Yield the contents of the file as they arrive, in chunks of at most
+        `blocksize` bytes, starting at offset `rest` if given.
+
+        Stopping early closes the data connection, which ends the transfer
+        on the server; no ABOR is sent.
+        """
+        blocksize = blocksize or self.blocksize
+        ftp_obj = self.ftp_obj
+        throttle = self._throttle()
+        decompressobj = None
+        if self._start_mode() is not None:
+            decompressobj = zlib.decompressobj()
+        metrics, started = self._metrics, time.time()
+        conn = _start_transfer(ftp_obj, "I", "RETR %s" % (self.filename,),
+                               rest)
+        completed = False
+        nbytes = 0
         try:
-            self.upload(fp)
+            while True:
+                data = conn.recv(blocksize)
+                if not data:
+                    break
+                nbytes += len(data)
+                if throttle is not None:
+                    throttle(data)
+                if decompressobj is None:
+                    yield data
+                else:
+                    for chunk in _inflate(decompressobj, data, blocksize):
+                        yield chunk
+            if decompressobj is not None:
+                for chunk in _inflate(decompressobj, None, blocksize):
+                    yield chunk
+            completed = True
         finally:
-            fp.close()
+            _end_transfer(ftp_obj, conn, completed)
+            if metrics is not None:
+                metrics.transfer("download", nbytes, time.time() - started)
+
+    def download_into(self, buffer, blocksize=None, rest=None):
+        """Download file straight into the writable `buffer`, such as a
+        bytearray, a memoryview or an mmap, and return the number of bytes
+        downloaded. Start at offset `rest` into the file if given.
+
+        The data is received right into the buffer, without intermediate
+        copies, and so never compressed. If the file doesn't fit, ValueError
+        is raised.
+        """
+        blocksize = blocksize or self.blocksize
+        view = memoryview(buffer)
+        size = len(view)
+        ftp_obj = self.ftp_obj
+        # Inflating would take copying; this is for when the link is fast.
+        self._start_mode(compress=False)
+        throttle = self._throttle()
+        metrics, started = self._metrics, time.time()
+        conn = _start_transfer(ftp_obj, "I", "RETR %s" % (self.filename,),
+                               rest)
+        completed = False
+        nbytes = 0
+        try:
+            while nbytes < size:
+                n = conn.recv_into(view[nbytes:], min(blocksize,
+                                                      size - nbytes))
+                if not n:
+                    break
+                nbytes += n
+                if throttle is not None:
+                    throttle.consume(n)
+            else:
+                if conn.recv(1):
+                    raise ValueError("buffer of %d bytes too small for %s"
+                                     % (size, self.filename))
+            completed = True
+        finally:
+            _end_transfer(ftp_obj, conn, completed)
+            if metrics is not None:
+                metrics.transfer("download", nbytes, time.time() - started)
+        return nbytes
 
-    def download(self, fp):
-        """Download file into file-like object fp."""
-        self.ftp_obj.retrbinary("RETR %s" % (self.filename,), fp.write)
+    def open(self, block_size=None, readahead=4, cache_blocks=64):
+        """Return a read-only, seekable file object over the file, reading
+        only the parts of it that are asked for; see FTPRemoteFile.
+
+        The file is read `block_size` bytes at a time, the proxy's
+        `blocksize` by default, of which `cache_blocks` are kept. Reading on
+        where the last read left off fetches `readahead` blocks more.
+        """
+        return FTPRemoteFile(self, self.size(), block_size or self.blocksize,
+                             readahead, cache_blocks)
 
     def download_to_str(self):
         """Download file and return its contents."""
-        fp = six.BytesIO()
-        self.download(fp)
-        return fp.getvalue()
+        return b"".join(self.iter_chunks())
+
+    def download_to_file(self, filename, resume=False, retries=0,
+                         verify=False):
+        """Download file into file identified by name filename.
+
+        If `resume` is True and the local file exists, only the part of the
+        remote file past its size is downloaded and appended to it. If
+        `retries` is more than zero, failed downloads are retried, resumed,
+        over a new connection up to that many times.
+
+        If `verify` is True, the file is hashed as it arrives, and
+        ChecksumError is raised if that differs from the server's checksum;
+        see `checksum`. Only a part downloaded before is read an extra time
+        for that.
+        """
+        algorithm = self._verify_algorithm(verify)
+        def transfer(attempt):
+            offset = 0
+            if (resume or attempt) and path.exists(filename):
+                offset = path.getsize(filename)
+                if offset:
+                    size = self.size()
+                    if offset == size:
+                        return None
+                    elif offset > size:
+                        # Not the same file; start over.
+                        offset = 0
+            hash = None
+            if algorithm is not None:
+                hash = _new_hash(algorithm)
+                if offset:
+                    _hash_file(filename, hash, offset)
+            fp = open(filename, "ab" if offset else "wb")
+            try:
+                if hash is None:
+                    self.download(fp, rest=offset or None)
+                else:
+                    self.download(_HashingFile(fp, hash), rest=offset or None)
+            finally:
+                fp.close()
+            return hash
+        hash = self._retry(transfer, retries)
+        if algorithm is not None:
+            self._verify(filename, algorithm, hash)
+
+    def download_segmented(self, filename, segments=4, connection_pool=None,
+                           retries=0, verify=False):
+        """Download file into file identified by name filename, in
+        `segments` parts fetched at once over as many connections, which can
+        make up for the limited throughput of one connection over a long
+        distance. The connections are opened like FTPHost.clone, or taken
+        from `connection_pool`. Files smaller than `min_segment_size` bytes
+        a segment are split into fewer segments.
 
-    def download_to_file(self, filename):
-        """Download file into file identified by name filename."""
-        fp = file(filename, "wb")
+        The local file is allocated in full first, and each part written in
+        place as it arrives; each part is fetched with REST, never
+        compressed, and cut off at the end of its range. If a part fails with
+        a transient error, it's fetched again from where it stopped, at most
+        `retries` times. If the download fails all the same, the file is cut
+        after the first part's bytes, for `download_to_file` to resume.
+
+        If `verify` is True, the complete file is hashed and compared with
+        the server's checksum, raising ChecksumError if they differ.
+        """
+        if self.host is None:
+            raise ValueError("segmented download needs the host of %s" %
+                             (self.filename,))
+        algorithm = self._verify_algorithm(verify)
+        size = self.size()
+        count = max(1, min(segments, size // self.min_segment_size))
+        fp = open(filename, "wb")
         try:
-            self.download(fp)
+            _allocate(fp, size)
         finally:
             fp.close()
+        bounds = [size * i // count for i in range(count + 1)]
+        # Bytes of each part written so far.
+        progress = [0] * count
+        def download_part(host, i):
+            part = host.file_proxy(self.filename)
+            part.rate_limiter, part.priority = self.rate_limiter, self.priority
+            _download_range(part, filename, bounds[i] + progress[i],
+                            bounds[i + 1], progress, i)
+        try:
+            if count == 1:
+                self._retry(lambda attempt: download_part(self.host, 0),
+                            retries)
+            else:
+                self._download_parts(download_part, count, connection_pool,
+                                     retries)
+            if path.getsize(filename) != size or sum(progress) != size:
+                raise EOFError("%s is %d bytes, not %d" %
+                               (filename, sum(progress), size))
+        except:
+            # Cut the file after what the first part got, the only bytes
+            # known to be there without gaps, so that it isn't taken for
+            # complete and a resumed download goes on from there.
+            fp = open(filename, "r+b")
+            try:
+                fp.truncate(bounds[0] + progress[0])
+            finally:
+                fp.close()
+            raise
+        if algorithm is not None:
+            self._verify(filename, algorithm)
+
+    def _download_parts(self, func, count, connection_pool, retries):
+        """Run `func(host, i)` for parts 0 to `count` over as many
+        connections, running failed parts again as `retries` allows.
+        """
+        pool = self.host._workers(func, count, connection_pool)
+        failure = None
+        try:
+            for i in range(count):
+                pool.put(i)
+            attempts = [0] * count
+            pending = count
+            while pending:
+                i, result, exc = pool.get()
+                pending -= 1
+                if exc is None:
+                    continue
+                if not _is_transient(exc) or attempts[i] >= retries:
+                    failure = failure or exc
+                    continue
+                if self._metrics is not None:
+                    self._metrics.retry(self.filename, exc)
+                time.sleep(self.retry_delay * 2 ** attempts[i])
+                attempts[i] += 1
+                pool.put(i)
+                pending += 1
+        finally:
+            pool.close()
+        if failure is not None:
+            raise failure
+
+    def checksum(self, algorithm=None):
+        """Return the checksum of the file as computed by the server, with
+        `algorithm` or the best one it has; see FTPHost.checksum.
+        """
+        if self.host is None:
+            raise ValueError("checksums need the host of %s" %
+                             (self.filename,))
+        return self.host.checksum(self.filename, algorithm)
+
+    def _verify_algorithm(self, verify):
+        if not verify:
+            return None
+        if self.host is None:
+            raise ValueError("checksums need the host of %s" %
+                             (self.filename,))
+        return self.host._checksum_algorithm()
+
+    def _verify(self, filename, algorithm, hash=None):
+        """Raise ChecksumError unless the checksum of the file on the server
+        is `hash`, or that of local file `filename` if None.
+        """
+        if hash is None:
+            # Nothing was transferred; the files should match already.
+            hash = _hash_file(filename, _new_hash(algorithm))
+        local = hash.hexdigest()
+        remote = self.checksum(algorithm)
+        if local != remote:
+            raise ChecksumError("%s checksum of %s is %s, but %s on the "
+                "server" % (_hash_names[algorithm], filename, local, remote))
 
     def delete(self):
         """Delete file."""
         self.ftp_obj.delete(self.filename)
+        self._changed()
 
     def rename(self, new_name):
         """Rename file to new_name, and return an instance of that file."""
         new_abs_name = posixpath.join(path.dirname(self.filename), new_name)
         self.ftp_obj.rename(self.filename, new_abs_name)
-        return self.__class__(self.ftp_obj, new_abs_name)
+        # Directories can be renamed too.
+        self._changed(recursive=True)
+        self._changed(new_abs_name, recursive=True)
+        return self.__class__(self.ftp_obj, new_abs_name, host=self.host)
+
+    def move(self, destination, host=None):
+        """Move the file to `destination`, which may be in another directory
+        and is relative to the working directory unless absolute, and return
+        an instance of the file there.
+
+        If FTPHost `host` is given and connected to another server, the file
+        is copied there (see `copy`) and then deleted here.
+        """
+        if host is not None and host is not self.host and \
+                not host._same_server(self.host):
+            target = self.copy(destination, host)
+            self.delete()
+            return target
+        if self.host is not None:
+            destination = self.host._absolute(destination)
+        else:
+            destination = posixpath.join(posixpath.dirname(self.filename),
+                                         destination)
+        destination = posixpath.normpath(destination)
+        self.ftp_obj.rename(self.filename, destination)
+        self._changed(recursive=True)
+        self._changed(destination, recursive=True)
+        return self.__class__(self.ftp_obj, destination, host=self.host)
+
+    def copy(self, destination, host=None):
+        """Copy the file to `destination` on FTPHost `host`, or this file's
+        host if None, and return an instance of the copy. The contents go
+        from server to server, never through here.
+
+        Within a server, SITE CPFR and CPTO are used if the server has them,
+        as with ProFTPD's mod_copy. Otherwise, and between servers, the
+        source server sends the file straight to the destination server
+        (FXP), which both servers must allow; within a server, a second
+        connection is opened for that, see FTPHost.clone.
+        """
+        if self.host is None:
+            raise ValueError("copying needs the host of %s" %
+                             (self.filename,))
+        if host is None:
+            host = self.host
+        target = host.file_proxy(destination)
+        if host._same_server(self.host) and \
+                host._site_copy(self.filename, target.filename):
+            target._changed()
+            return target
+        if host is self.host:
+            other = host.clone()
+            try:
+                _fxp(self, other.file_proxy(target.filename))
+            finally:
+                other.try_quit()
+        else:
+            _fxp(self, target)
+        target._changed()
+        return target
+
+class FTPRemoteFile(io.RawIOBase):
+    """Read-only, seekable file object over a remote file, for the likes of
+    zipfile and tarfile to look into it without downloading all of it.
+
+    Reads are served from a cache of the last `cache_blocks` blocks of
+    `block_size` bytes read. Missing blocks are fetched with a RETR from
+    where they start, which is aborted once they're in. Fetches continuing
+    where the last one ended take `readahead` blocks more, so reading
+    through the file doesn't take a RETR per block.
+
+    Fetches go over the connection of the file proxy, which is free between
+    them. Get one from FTPFileProxy.open.
+    """
+
+    def __init__(self, proxy, size, block_size, readahead, cache_blocks):
+        super(FTPRemoteFile, self).__init__()
+        self.proxy = proxy
+        self.name = proxy.filename
+        self.size = size
+        self.block_size = block_size
+        self.readahead = readahead
+        self.cache_blocks = max(cache_blocks, 1)
+        # The number of bytes fetched from the server so far.
+        self.bytes_fetched = 0
+        self._blocks = OrderedDict()
+        self._position = 0
+        self._next_block = 0
+
+    def __repr__(self):
+        return "<%s %r size=%d>" % (self.__class__.__name__, self.name,
+                                    self.size)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        elif whence != os.SEEK_SET:
+            raise ValueError("invalid whence (%r)" % (whence,))
+        if offset < 0:
+            raise ValueError("negative seek position %d" % (offset,))
+        self._position = offset
+        return offset
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        start = self._position
+        end = self.size
+        if size is not None and size >= 0:
+            end = min(start + size, end)
+        if end <= start:
+            return b""
+        bs = self.block_size
+        first = start // bs
+        data = b"".join(self._read_blocks(first, (end - 1) // bs))
+        data = data[start - first * bs:end - first * bs]
+        self._position += len(data)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._blocks.clear()
+        super(FTPRemoteFile, self).close()
+
+    def _read_blocks(self, first, last):
+        """Return the blocks `first` through `last`, from the cache where
+        they're in it, fetching the others.
+        """
+        blocks = []
+        i = first
+        while i <= last:
+            block = self._blocks.get(i)
+            if block is not None:
+                # Most recently used last.
+                del self._blocks[i]
+                self._blocks[i] = block
+                blocks.append(block)
+                i += 1
+                continue
+            # Fetch all the missing blocks in a row at once.
+            j = i + 1
+            while j <= last and j not in self._blocks:
+                j += 1
+            count = j - i
+            if j > last and i == self._next_block:
+                count += min(self.readahead,
+                             max(self.cache_blocks - count, 0))
+            fetched = self._fetch(i, count)
+            blocks.extend(fetched[:j - i])
+            if len(fetched) < j - i:
+                # The file is shorter than it was.
+                break
+            i = j
+        return blocks
+
+    def _fetch(self, first, count):
+        """Fetch `count` blocks from block `first` on, caching them, and
+        return them.
+        """
+        proxy = self.proxy
+        bs = self.block_size
+        start = first * bs
+        wanted = max(min(count * bs, self.size - start), 0)
+        buf = bytearray(wanted)
+        view = memoryview(buf)
+        ftp_obj = proxy.ftp_obj
+        # Only whole blocks of the file are of use, not of a deflated stream.
+        proxy._start_mode(compress=False)
+        throttle = proxy._throttle()
+        metrics, started = proxy._metrics, time.time()
+        conn = _start_transfer(ftp_obj, "I", "RETR %s" % (proxy.filename,),
+                               start or None)
+        completed = False
+        nbytes = 0
+        try:
+            while nbytes < wanted:
+                n = conn.recv_into(view[nbytes:], min(proxy.blocksize,
+                                                      wanted - nbytes))
+                if not n:
+                    break
+                nbytes += n
+                if throttle is not None:
+                    throttle.consume(n)
+            # Up to the end, the transfer can finish rather than be aborted.
+            completed = nbytes < wanted or (start + wanted >= self.size and
+                                            not conn.recv(1))
+        finally:
+            _end_transfer(ftp_obj, conn, completed)
+            if metrics is not None:
+                metrics.transfer("download", nbytes, time.time() - started)
+        self.bytes_fetched += nbytes
+        blocks = [bytes(buf[k:k + bs]) for k in range(0, nbytes, bs)]
+        for k, block in enumerate(blocks):
+            self._blocks[first + k] = block
+        while len(self._blocks) > self.cache_blocks:
+            self._blocks.popitem(last=False)
+        self._next_block = first + len(blocks)
+        return blocks
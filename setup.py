@@ -1,9 +1,15 @@
 from distutils.core import setup
 import os
+import sys
 
 readme_fname = os.path.join(os.path.dirname(__file__), "README.rst")
 readme_text = open(readme_fname).read()
 
+py_modules = ["ftptool"]
+# The asyncio interface is written for Python 3.7 and later.
+if sys.version_info >= (3, 7):
+    py_modules.append("aioftptool")
+
 setup(name="ftptool", version="0.7.1",
       url="https://github.com/bloggse/ftptool",
       description="Higher-level interface to ftplib",
@@ -11,4 +17,4 @@ setup(name="ftptool", version="0.7.1",
       author_email="teknik@blogg.se",
       requires=["six"],
       long_description=readme_text,
-      py_modules=["ftptool"])
+      py_modules=py_modules)
@@ -1,5 +1,16 @@
 """Tests for ftptool."""
 
+import os
+import time
+import errno
+import zlib
+import zipfile
+import hashlib
+import socket
+import posixpath
+import shutil
+import threading
+import tempfile
 import unittest
 from StringIO import StringIO
 
@@ -13,7 +24,18 @@ class PhonyDataChannel(object):
         for copy_attr in ("read", "readline", "write"):
             setattr(self, copy_attr, getattr(self.input_data, copy_attr))
         self.recv = self.read
-        self.send = self.write
+        self.send = self.sendall = self.write
+
+    def recv_into(self, buffer, nbytes=0):
+        data = self.read(nbytes or len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def sendfile(self, fp, offset=0, count=None):
+        fp.seek(offset)
+        data = fp.read(count) if count else fp.read()
+        self.write(data)
+        return len(data)
 
     def makefile(self, mode="rb"):
         return self
@@ -21,6 +43,21 @@ class PhonyDataChannel(object):
     def close(self):
         self.closed = True
 
+class BrokenDataChannel(PhonyDataChannel):
+    """A data channel that breaks after having given *count* bytes."""
+
+    def __init__(self, input_data, count):
+        super(BrokenDataChannel, self).__init__(input_data)
+        del self.recv
+        self.count = count
+
+    def recv(self, n):
+        if not self.count:
+            raise socket.error(104, "Connection reset by peer")
+        data = self.read(min(n, self.count))
+        self.count -= len(data)
+        return data
+
 class Listing(PhonyDataChannel):
     @classmethod
     def parse(cls, spec):
@@ -148,10 +185,123 @@ class PhonyFTPClient(object, ftplib.FTP):
     def push_listing(self, spec):
         return self.push_channel(Listing.parse(spec), "ASCII")
 
+    @property
+    def sent_commands(self):
+        return [l for (d, l) in self.dialogue if d == ">"]
+
+    def push_features(self, *features):
+        """Reply to FEAT with *features*, or that there's no such command if
+        none are given.
+        """
+        if not features:
+            self.input_commands.append("502 Command not implemented.")
+            return
+        self.input_commands.append("211-Features:")
+        self.input_commands.extend(" " + f for f in features)
+        self.input_commands.append("211 End")
+
     def __str__(self):
         return "<%s connected_to=%r login_info=%r>" % (
             self.__class__.__name__, self.connected_to, self.login_info)
 
+class TreeFTPClient(PhonyFTPClient):
+    """A phony FTP client that answers listings of the directories in the
+    dict *tree*, mapping paths to Listing specs, whatever order they're asked
+    for in.
+    """
+
+    def __init__(self, tree):
+        super(TreeFTPClient, self).__init__()
+        self.tree = tree
+        self.input_commands.append("220 Hi.")
+
+    def putcmd(self, line):
+        super(TreeFTPClient, self).putcmd(line)
+        if line.startswith("TYPE"):
+            self.input_commands.append("200 TYPE changed.")
+        elif line == "FEAT":
+            self.input_commands.append("502 Command not implemented.")
+        elif line.startswith("LIST "):
+            self.data_channels.append(Listing.parse(self.tree[line[5:]]))
+            self.input_commands.extend(("150 Here it comes.", "226 Done."))
+
+class MLSDTreeFTPClient(PhonyFTPClient):
+    """A phony FTP client with MLSD and MLST, serving the files and
+    directories in the dict *tree*, mapping absolute paths to two-tuples
+    (type, mtime). A file's contents are its path, and RETR of the paths in
+    *broken* fails.
+    """
+
+    def __init__(self, tree):
+        super(MLSDTreeFTPClient, self).__init__()
+        self.tree = tree
+        self.broken = set()
+        self.input_commands.append("220 Hi.")
+
+    def facts(self, path):
+        type_, mtime = self.tree[path]
+        modify = time.strftime("%Y%m%d%H%M%S", time.gmtime(mtime))
+        return "type=%s;modify=%s;" % (type_, modify)
+
+    def putcmd(self, line):
+        super(MLSDTreeFTPClient, self).putcmd(line)
+        if line.startswith("TYPE"):
+            self.input_commands.append("200 TYPE changed.")
+        elif line == "FEAT":
+            self.push_features("MLST type*;modify*;")
+        elif line.startswith("MLST "):
+            path = line[5:]
+            if path not in self.tree:
+                self.input_commands.append("550 No such file.")
+                return
+            self.input_commands.extend(("250-Listing " + path,
+                " %s %s" % (self.facts(path), path), "250 End"))
+        elif line.startswith("MLSD "):
+            directory = line[5:]
+            self.data_channels.append(PhonyDataChannel("".join(
+                "%s %s\r\n" % (self.facts(p), posixpath.basename(p))
+                for p in sorted(self.tree)
+                if p != directory and posixpath.dirname(p) == directory)))
+            self.input_commands.extend(("150 Here it comes.", "226 Done."))
+        elif line.startswith("RETR "):
+            path = line[5:]
+            if path in self.broken:
+                self.input_commands.append("550 Can't read that.")
+                return
+            self.data_channels.append(PhonyDataChannel(path))
+            self.input_commands.extend(("150 Here it comes.", "226 Done."))
+
+class RangeFTPClient(PhonyFTPClient):
+    """A phony FTP client that answers RETR of any file with *data* from
+    where REST said, advertising *features*.
+    """
+
+    def __init__(self, data, features=()):
+        super(RangeFTPClient, self).__init__()
+        self.data = data
+        self.features = features
+        self.rest = 0
+        self.input_commands.append("220 Hi.")
+
+    def putcmd(self, line):
+        super(RangeFTPClient, self).putcmd(line)
+        if line == "FEAT":
+            self.push_features(*self.features)
+        elif line.startswith("TYPE"):
+            self.input_commands.append("200 TYPE changed.")
+        elif line.startswith("MODE "):
+            self.input_commands.append("200 MODE changed.")
+        elif line.startswith("SIZE "):
+            self.input_commands.append("213 %d" % (len(self.data),))
+        elif line.startswith("REST "):
+            self.rest = int(line[5:])
+            self.input_commands.append("350 Restarting.")
+        elif line.startswith("RETR "):
+            self.data_channels.append(
+                PhonyDataChannel(self.data[self.rest:]))
+            self.input_commands.extend(("150 Here it comes.", "226 Done."))
+            self.rest = 0
+
 class ClientTest(unittest.TestCase):
     def setUp(self):
         self.client = PhonyFTPClient()
@@ -238,6 +388,7 @@ class ClientTest(unittest.TestCase):
     def test_walk(self):
         # Make three data channels, the latter being the
         # subdirectories 'a_dir' and 'x_dir" of the first one.
+        self.client.push_features()
         self.client.push_listing("dir:a_dir dir:x_dir file:test")
         self.client.push_listing("file:foo file:bar")  # <- dir:a_dir
         self.client.push_listing("file:gogolog file:foo")  # <- dir:x_dir
@@ -251,49 +402,85 @@ class ClientTest(unittest.TestCase):
             [('/',          ['a_dir'],  ['test']),
              ('/a_dir',     [],         ['foo', 'bar'])])
 
+    def test_walk_parallel(self):
+        tree = {"/": "dir:a_dir dir:x_dir file:test",
+                "/a_dir": "dir:b_dir file:foo",
+                "/a_dir/b_dir": "file:bar",
+                "/x_dir": "file:gogolog"}
+        clients = []
+        def ftp_client():
+            clients.append(TreeFTPClient(tree))
+            return clients[-1]
+        host = ftptool.FTPHost.connect("example.org", ftp_client=ftp_client)
+        x = []
+        for (dirname, sdrs, files) in host.walk("/", workers=3):
+            for sd in sdrs:
+                if sd.startswith("x_"):
+                    sdrs.remove(sd)
+            x.append((dirname, sdrs, files))
+        self.assertEqual(sorted(x),
+            [('/',            ['a_dir'],  ['test']),
+             ('/a_dir',       ['b_dir'],  ['foo']),
+             ('/a_dir/b_dir', [],         ['bar'])])
+        # Listed by the workers, and never the pruned directory.
+        self.assertEqual(clients[0].sent_commands, [])
+        self.assertEqual(sorted(l for c in clients for l in c.sent_commands
+                                if l.startswith("LIST")),
+            ["LIST /", "LIST /a_dir", "LIST /a_dir/b_dir"])
+
     def test_makedirs(self):
         self.test_pwd()  # To cache cwd
         self.client.input_commands.extend((
-            # These three for the attempt at CWDing. First a failed CWD to
-            # dest, then a successful one back to where we were. ftptool also
-            # issues a PWD right after a CWD to see where it got to.
+            # Creating the directory right away fails.
+            '550 No such directory.',
+            '502 Command not implemented.',
+            # Without MLST, the directories are checked for by CWDing into
+            # them (and back), from the deepest up.
+            '550 No such directory.',
+            '550 No such directory.',
             '550 No such directory.',
             '250 OK.',
-            '257 "/" is your current location.',
-            # First attempt fails, the rest succeed.
-            '550 It exists etc.',
-            '257 Directory created.',
+            '250 OK.',
             '257 Directory created.',
             '257 Directory created.',
-            # Now with a relative path.
-            '550 No such directory.',
-            '250 OK.',
-            '257 "/" is your current location.',
-            '550 It exists etc.',
-            '550 It exists etc.',
-            '550 It exists etc.',
             '257 Directory created.'))
         self.host.makedirs("/a_dir/hello/world/foo")
-        self.assertEqual([o[1] for o in self.client.dialogue[-14::2]],
-            ['CWD /a_dir/hello/world/foo',
+        self.assertEqual(self.client.sent_commands[1:],
+            ['MKD /a_dir/hello/world/foo',
+             'FEAT',
+             'CWD /a_dir/hello/world/foo',
+             'CWD /a_dir/hello/world',
+             'CWD /a_dir/hello',
+             'CWD /a_dir',
              'CWD /',
-             'PWD',
-             'MKD /a_dir/',
-             'MKD /a_dir/hello/',
-             'MKD /a_dir/hello/world/',
-             'MKD /a_dir/hello/world/foo/'])
-        self.host.makedirs("a_dir/hello/world/foo")
-        self.assertEqual([o[1] for o in self.client.dialogue[-14::2]],
-            ['CWD a_dir/hello/world/foo',
-             'CWD /',
-             'PWD',
-             'MKD a_dir/',
-             'MKD a_dir/hello/',
-             'MKD a_dir/hello/world/',
-             'MKD a_dir/hello/world/foo/'])
+             'MKD /a_dir/hello',
+             'MKD /a_dir/hello/world',
+             'MKD /a_dir/hello/world/foo'])
+        # Known to exist now.
+        self.host.makedirs("/a_dir/hello/world/foo/")
+        self.assertEqual(len(self.client.sent_commands), 11)
+        # Only the last part is missing.
+        self.client.input_commands.append('257 Directory created.')
+        self.host.makedirs("a_dir/hello/world/bar")
+        self.assertEqual(self.client.sent_commands[11:],
+            ['MKD /a_dir/hello/world/bar'])
+
+    def test_makedirs_mlst(self):
+        self.client.input_commands.append('550 It exists.')
+        self.client.push_features("MLST type*;size*;modify*;")
+        self.client.input_commands.extend((
+            '250-Listing /a_dir/hello',
+            ' type=dir;modify=20090218000000; /a_dir/hello',
+            '250 End.'))
+        self.host.makedirs("/a_dir/hello")
+        self.assertEqual(self.client.sent_commands,
+            ['MKD /a_dir/hello', 'FEAT', 'MLST /a_dir/hello'])
+        self.host.makedirs("/a_dir")
+        self.assertEqual(len(self.client.sent_commands), 3)
 
     def test_list_space_filenames(self):
         self.test_pwd()  # CASHA-CAPOW
+        self.client.push_features("SIZE", "MDTM")
         self.client.push_channel(PhonyDataChannel("""
 -rw-r--r--    1 1000     users      158014 Jan  3 01:27 01869496c6.png
 -rw-r--r--    1 1000     users       16013 Dec 10 16:18 0196015a2b.png
@@ -318,6 +505,1137 @@ lrwxrwxrwx    1 1000     users         306 Feb 24 13:59 hu nhu -> /non/abc ah
               '05d71b43d4.png', '06353e180a.png', '063e6a9d02.png',
               '064ac43992.png']))
 
+    def test_listdir_mlsd(self):
+        self.client.push_features("MDTM", "MLST size*;type*;modify*;", "SIZE")
+        self.client.push_channel(PhonyDataChannel(
+            "type=cdir;modify=20090218120000; /a_dir\r\n"
+            "type=pdir;modify=20090218120000; /\r\n"
+            "Type=file;Size=25966;Modify=20090218000000.5;UNIX.mode=0644;"
+            "Unique=801g4804; 05 celeb.png\r\n"
+            "type=dir;sizd=4096;modify=20090218000000; 84\r\n"
+            "type=OS.unix=slink:/non/Abc;modify=20090218000000; hu nhu\r\n"
+            "type=OS.unix=chr-13/29; tty\r\n"), "ASCII")
+        self.assertEqual(self.host.listdir("/a_dir/", links=True),
+            (['84'], ['05 celeb.png'], ['hu nhu']))
+        self.assertEqual(self.client.sent_commands[-1], "MLSD /a_dir")
+        self.client.push_channel(PhonyDataChannel(
+            "type=file;size=25966;modify=20090218000000;UNIX.mode=0644;"
+            "unique=801g4804; 05 celeb.png\r\n"
+            "type=OS.unix=slink:/non/Abc;modify=20090218000000; hu nhu\r\n"
+            ), "ASCII")
+        # The features are only asked for once.
+        self.assertEqual(list(self.host.iterdir("")),
+            [ftptool.FTPEntry("05 celeb.png", "file", 25966, 1234915200,
+                              0o644, unique="801g4804"),
+             ftptool.FTPEntry("hu nhu", "link", None, 1234915200,
+                              target="/non/Abc")])
+        self.assertEqual(self.client.sent_commands[-2:], ["TYPE A", "MLSD"])
+
+    def test_iterdir_list(self):
+        self.client.push_features("SIZE")
+        self.client.push_listing("dir:a_dir file:test file:foo")
+        entries = self.host.iterdir("/")
+        self.assertEqual(next(entries).name, "a_dir")
+        # Stop listening half-way.
+        entries.close()
+        self.assertEqual(self.client.dialogue[-1], ("<", "226 I"))
+        self.assertEqual(self.client.sent_commands[-1], "LIST /")
+
+    def test_walk_entries(self):
+        self.client.push_features()
+        self.client.push_listing("dir:a_dir file:test")
+        self.client.push_listing("file:foo")  # <- dir:a_dir
+        x = [(dirname, [e.name for e in sdrs], [(e.name, e.size, e.mode)
+                                               for e in files])
+             for (dirname, sdrs, files) in self.host.walk("/", entries=True)]
+        self.assertEqual(x,
+            [('/',          ['a_dir'],  [('test', 123, 0o775)]),
+             ('/a_dir',     [],         [('foo', 123, 0o775)])])
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.clients = []
+        def ftp_client():
+            c = PhonyFTPClient()
+            c.input_commands.extend(("220 Hi.", "331 Password?", "230 OK."))
+            self.clients.append(c)
+            return c
+        self.pool = ftptool.FTPConnectionPool("example.org", user="fbi",
+            password="SecretPassword", max_connections=2,
+            ftp_client=ftp_client)
+
+    def test_reuse(self):
+        host = self.pool.acquire()
+        self.assertEqual(self.clients[0].login_info,
+            ("fbi", "SecretPassword", None))
+        self.pool.release(host)
+        self.clients[0].input_commands.append("200 Zzz...")
+        self.assertTrue(self.pool.acquire() is host)
+        self.assertEqual(self.clients[0].sent_commands[-1], "NOOP")
+        self.assertEqual((self.pool.hits, self.pool.misses), (1, 1))
+
+    def test_evict_broken(self):
+        with self.pool.connection() as host:
+            pass
+        # The NOOP will fail, so there'll be a new connection.
+        with self.pool.connection() as host:
+            self.assertTrue(host.ftp_obj is self.clients[1])
+        self.assertEqual((self.pool.hits, self.pool.misses,
+                          self.pool.evictions), (0, 2, 1))
+        try:
+            with self.pool.connection() as host:
+                raise EOFError("Connection lost.")
+        except EOFError:
+            pass
+        self.assertEqual(self.pool._idle, [])
+
+    def test_evict_idle(self):
+        self.pool.max_idle = 0
+        self.pool.release(self.pool.acquire())
+        time.sleep(0.01)
+        self.pool.prune()
+        self.assertEqual((self.pool._idle, self.pool.evictions), ([], 1))
+        self.assertEqual(self.clients[0].sent_commands[-1], "QUIT")
+
+    def test_max_connections(self):
+        hosts = [self.pool.acquire(), self.pool.acquire()]
+        got = []
+        thread = threading.Thread(target=lambda: got.append(
+            self.pool.acquire()))
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(got, [])
+        self.clients[1].input_commands.append("200 Zzz...")
+        self.pool.release(hosts[1])
+        thread.join()
+        self.assertEqual(got, [hosts[1]])
+
+    def test_walk_with_pool(self):
+        tree = {"/": "dir:a_dir file:test", "/a_dir": "file:foo"}
+        def ftp_client():
+            self.clients.append(TreeFTPClient(tree))
+            self.clients[-1].input_commands.extend(
+                ("331 Password?", "230 OK."))
+            return self.clients[-1]
+        self.pool.connect_args["ftp_client"] = ftp_client
+        host = ftptool.FTPHost(PhonyFTPClient())
+        self.assertEqual(len(list(host.walk("/", workers=3,
+                                            connection_pool=self.pool))), 2)
+        # At most two connections, handed back when done.
+        self.assertTrue(len(self.clients) <= 2)
+        self.assertEqual(len(self.pool._idle), len(self.clients))
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.filename = os.path.join(self.local, "test.txt")
+        self.clients = []
+        def ftp_client():
+            c = PhonyFTPClient()
+            c.input_commands.append("220 Hi.")
+            self.clients.append(c)
+            return c
+        self.host = ftptool.FTPHost.connect("example.org",
+            ftp_client=ftp_client)
+        self.client = self.clients[0]
+        self.f = self.host.file_proxy("/test.txt")
+        self.f.retry_delay = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.local)
+
+    def test_resume_download(self):
+        with open(self.filename, "wb") as fp:
+            fp.write("Hello")
+        self.client.input_commands.extend((
+            "213 12",
+            "200 TYPE is now 8-bit binary",
+            "350 Restarting at 5."))
+        self.client.push_channel(PhonyDataChannel(" world!"))
+        del self.client.input_commands[3]
+        self.f.download_to_file(self.filename, resume=True)
+        with open(self.filename, "rb") as fp:
+            self.assertEqual(fp.read(), "Hello world!")
+        self.assertEqual(self.client.sent_commands,
+            ["SIZE /test.txt", "TYPE I", "REST 5", "RETR /test.txt"])
+
+    def test_resume_upload(self):
+        with open(self.filename, "wb") as fp:
+            fp.write("Hello!")
+        dc = PhonyDataChannel("")
+        self.client.input_commands.append("213 3")
+        self.client.push_channel(dc)
+        self.f.upload_from_file(self.filename, resume=True)
+        self.assertEqual(dc.input_data.getvalue(), "lo!")
+        self.assertEqual(self.client.sent_commands,
+            ["SIZE /test.txt", "TYPE I", "APPE /test.txt"])
+        # Nothing left to upload.
+        self.client.input_commands.append("213 6")
+        self.f.upload_from_file(self.filename, resume=True)
+        self.assertEqual(self.client.sent_commands[-1], "SIZE /test.txt")
+
+    def test_upload_sendfile(self):
+        with open(self.filename, "wb") as fp:
+            fp.write("Hello!")
+        has_sendfile = ftptool._has_sendfile
+        try:
+            for value in (True, False):
+                ftptool._has_sendfile = value
+                for limiter in (None, ftptool.RateLimiter(1 << 30)):
+                    self.f.blocksize, self.f.rate_limiter = 4, limiter
+                    dc = PhonyDataChannel("")
+                    self.client.push_channel(dc)
+                    self.f.upload_from_file(self.filename)
+                    self.assertEqual(dc.input_data.getvalue(), "Hello!")
+                    self.assertEqual(self.client.sent_commands[-2:],
+                                     ["TYPE I", "STOR /test.txt"])
+        finally:
+            ftptool._has_sendfile = has_sendfile
+            self.f.rate_limiter = None
+        # Not a regular file, so it's read the usual way.
+        dc = PhonyDataChannel("")
+        dc.sendfile = None
+        self.client.push_channel(dc)
+        self.f.upload(StringIO("Hi!"))
+        self.assertEqual(dc.input_data.getvalue(), "Hi!")
+
+    def test_upload_empty_without_sendfile(self):
+        open(self.filename, "wb").close()
+        has_sendfile = ftptool._has_sendfile
+        ftptool._has_sendfile = False
+        try:
+            dc = PhonyDataChannel("")
+            # Like a socket of Python 2.
+            dc.sendfile = None
+            self.client.push_channel(dc)
+            self.f.upload_from_file(self.filename)
+        finally:
+            ftptool._has_sendfile = has_sendfile
+        self.assertEqual(dc.input_data.getvalue(), "")
+        self.assertEqual(self.client.sent_commands, ["TYPE I",
+                                                     "STOR /test.txt"])
+
+    def test_retry_download(self):
+        self.client.push_channel(BrokenDataChannel("Hello!", 3))
+        def ftp_client():
+            c = PhonyFTPClient()
+            c.input_commands.extend(("220 Hi again.", "213 6",
+                "200 TYPE is now 8-bit binary", "350 Restarting at 3."))
+            c.push_channel(PhonyDataChannel("lo!"))
+            del c.input_commands[4]
+            self.clients.append(c)
+            return c
+        self.host._connect_args["ftp_client"] = ftp_client
+        self.f.download_to_file(self.filename, retries=1)
+        with open(self.filename, "rb") as fp:
+            self.assertEqual(fp.read(), "Hello!")
+        self.assertEqual(len(self.clients), 2)
+        self.assertTrue(self.host.ftp_obj is self.clients[1])
+        self.assertEqual(self.clients[1].sent_commands,
+            ["SIZE /test.txt", "TYPE I", "REST 3", "RETR /test.txt"])
+
+    def test_retry_gives_up(self):
+        self.assertRaises(EOFError, self.f.download_to_file, self.filename,
+                          retries=2)
+        self.assertEqual(len(self.clients), 3)
+
+    def test_local_error_not_retried(self):
+        filename = os.path.join(self.local, "missing", "test.txt")
+        self.assertRaises(IOError, self.f.download_to_file, filename,
+                          retries=2)
+        self.assertEqual(len(self.clients), 1)
+
+    def test_local_error_partway(self):
+        # The reply on the transfer is read, so the connection that's kept
+        # after the error is still in step.
+        class FullDisk(object):
+            def write(self, data):
+                raise IOError(errno.ENOSPC, "No space left on device")
+        class BadFile(object):
+            def read(self, size):
+                raise IOError(errno.EIO, "Input/output error")
+        self.f.blocksize = 5
+        self.client.push_channel(PhonyDataChannel("Hello world!"),
+                                 ["Aborted."])
+        try:
+            self.f.download(FullDisk())
+        except IOError as e:
+            self.assertTrue(ftptool._keeps_connection(e))
+        else:
+            self.fail("IOError not raised")
+        self.client.input_commands.append("200 NOOP ok.")
+        self.assertEqual(self.client.voidcmd("NOOP"), "200 NOOP ok.")
+        self.client.push_channel(PhonyDataChannel(""), ["Truncated."])
+        self.assertRaises(IOError, self.f.upload, BadFile())
+        self.client.input_commands.append("200 NOOP ok.")
+        self.assertEqual(self.client.voidcmd("NOOP"), "200 NOOP ok.")
+
+    def test_transient_errors(self):
+        for exc in (EOFError(), ftplib.error_temp("421 Bye."),
+                    socket.timeout(), socket.error(errno.ECONNRESET, "reset")):
+            self.assertTrue(ftptool._is_transient(exc))
+            self.assertFalse(ftptool._keeps_connection(exc))
+        for exc in (IOError(errno.ENOSPC, "full"),
+                    OSError(errno.EACCES, "denied")):
+            self.assertFalse(ftptool._is_transient(exc))
+            self.assertTrue(ftptool._keeps_connection(exc))
+        self.assertTrue(ftptool._keeps_connection(ftplib.error_perm("550")))
+
+class ListingCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ftptool.ListingCache(max_entries=2)
+        self.client = TreeFTPClient({"/src": "dir:sub file:a",
+                                     "/src/sub": "file:b"})
+        self.host = ftptool.FTPHost.connect("example.org",
+            ftp_client=lambda: self.client, listing_cache=self.cache)
+
+    def lists(self):
+        return [l for l in self.client.sent_commands if l.startswith("LIST")]
+
+    def test_lru_and_ttl(self):
+        for d in ("/a", "/b", "/a", "/c"):
+            if self.cache.get(d) is None:
+                self.cache.put(d, [])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 3))
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(self.cache.get("/b"), None)
+        self.assertEqual(self.cache.get("/a"), [])
+        self.cache.ttl = -1
+        self.assertEqual(self.cache.get("/a"), None)
+        self.assertEqual(self.cache.hit_rate, 2.0 / 7)
+
+    def test_walk_twice(self):
+        for i in range(2):
+            self.assertEqual(list(self.host.walk("/src")),
+                [("/src", ["sub"], ["a"]), ("/src/sub", [], ["b"])])
+        self.assertEqual(self.lists(), ["LIST /src", "LIST /src/sub"])
+        self.assertEqual(self.cache.hits, 2)
+
+    def test_invalidation(self):
+        self.host.listdir("/src")
+        self.host.listdir("/src/sub")
+        self.client.input_commands.append("250 Deleted.")
+        self.host.file_proxy("/src/sub/b").delete()
+        self.host.listdir("/src")
+        self.host.listdir("/src/sub")
+        self.client.input_commands.append("250 Removed.")
+        self.host.rmdir("/src/sub/")
+        self.host.listdir("/src/")
+        self.assertEqual(self.lists(),
+            ["LIST /src", "LIST /src/sub", "LIST /src/sub", "LIST /src"])
+
+    def test_clone_shares_cache(self):
+        self.host.listdir("/src")
+        self.client.input_commands.append("220 Hi.")
+        self.assertTrue(self.host.clone().listing_cache is self.cache)
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.client = PhonyFTPClient()
+        self.client.input_commands.append("220 Hi.")
+        self.metrics = ftptool.FTPMetrics()
+        self.host = ftptool.FTPHost.connect("example.org",
+            ftp_client=lambda: self.client, metrics=self.metrics)
+
+    def test_commands(self):
+        self.client.input_commands.extend((
+            "257 Created.", "550 It exists.", "250 OK.", "550 Nope."))
+        self.host.mkdir("/a")
+        self.assertRaises(ftplib.error_perm, self.host.mkdir, "/a")
+        self.host.pipeline(["CWD /a", "CWD /b"])
+        self.assertEqual(self.metrics.counts, {"MKD": 2, "CWD": 2})
+        self.assertEqual(self.metrics.errors, {"MKD": 1, "CWD": 1})
+        self.assertTrue(self.metrics.latency("MKD") >= 0)
+
+    def test_transfers(self):
+        self.client.push_channel(PhonyDataChannel("Hello world!"))
+        self.client.push_channel(PhonyDataChannel(""))
+        f = self.host.file_proxy("/test.txt")
+        self.assertEqual(f.download_to_str(), "Hello world!")
+        f.upload_from_str("Hello!")
+        self.assertEqual(self.metrics.counts,
+                         {"TYPE": 2, "RETR": 1, "STOR": 1})
+        self.assertEqual(self.metrics.bytes_received, 12)
+        self.assertEqual(self.metrics.bytes_sent, 6)
+
+    def test_disabled(self):
+        self.host.metrics = None
+        self.client.input_commands.append("257 Created.")
+        self.host.mkdir("/a")
+        self.assertEqual(self.metrics.counts, {})
+        self.assertFalse("putcmd" in self.client.__dict__)
+
+class StreamTest(unittest.TestCase):
+    def setUp(self):
+        self.client = PhonyFTPClient()
+        self.client.input_commands.append("220 Hi.")
+        self.host = ftptool.FTPHost.connect("example.org",
+            ftp_client=lambda: self.client)
+        self.f = self.host.file_proxy("/test.txt")
+
+    def test_iter_chunks(self):
+        self.client.push_channel(PhonyDataChannel("Hello world!"))
+        chunks = list(self.f.iter_chunks(blocksize=5))
+        self.assertEqual(chunks, ["Hello", " worl", "d!"])
+        self.assertEqual(self.client.sent_commands,
+            ["TYPE I", "RETR /test.txt"])
+        self.assertEqual(self.client.input_commands, [])
+
+    def test_iter_chunks_stopped_early(self):
+        dc = PhonyDataChannel("Hello world!")
+        self.client.push_channel(dc, ["Aborted."])
+        chunks = self.f.iter_chunks(blocksize=5)
+        self.assertEqual(next(chunks), "Hello")
+        chunks.close()
+        self.assertTrue(dc.closed)
+        self.assertEqual(self.client.input_commands, [])
+
+    def test_download_into(self):
+        self.client.push_channel(PhonyDataChannel("Hello world!"))
+        buf = bytearray(16)
+        self.assertEqual(self.f.download_into(buf, blocksize=5), 12)
+        self.assertEqual(bytes(buf[:12]), "Hello world!")
+
+    def test_download_into_too_small(self):
+        self.client.push_channel(PhonyDataChannel("Hello world!"))
+        buf = bytearray(5)
+        self.assertRaises(ValueError, self.f.download_into, buf)
+        self.assertEqual(bytes(buf), "Hello")
+        self.assertEqual(self.client.input_commands, [])
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.local)
+        self.client = PhonyFTPClient()
+        self.client.input_commands.append("220 Hi.")
+        self.host = ftptool.FTPFileClient.connect("example.org",
+            ftp_client=lambda: self.client)
+        self.progress = []
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.local)
+
+    def callback(self, filename, result):
+        self.progress.append(filename)
+
+    def test_mdelete(self):
+        self.client.input_commands.extend((
+            "250 Deleted.", "550 No such file.", "250 Deleted."))
+        results = self.host.mdelete(["/a", "/b", "/c"],
+                                    callback=self.callback)
+        # All commands go out before the first reply is read.
+        self.assertEqual([d for d, l in self.client.dialogue[1:]],
+                         [">"] * 3 + ["<"] * 3)
+        self.assertEqual(results[0], None)
+        self.assertTrue(isinstance(results[1], ftplib.error_perm))
+        self.assertEqual(results[2], None)
+        self.assertEqual(self.progress, ["/a", "/b", "/c"])
+
+    def test_mget_continues_after_error(self):
+        self.client.input_commands.extend((
+            "200 TYPE is now 8-bit binary", "550 No such file."))
+        self.client.push_channel(PhonyDataChannel("Hello!"))
+        results = self.host.mget(["/x/a", "/x/b"], callback=self.callback)
+        self.assertTrue(isinstance(results[0], ftplib.error_perm))
+        self.assertEqual(results[1], None)
+        with open("b", "rb") as fp:
+            self.assertEqual(fp.read(), "Hello!")
+        self.assertEqual(self.progress, ["/x/a", "/x/b"])
+
+    def test_mput_parallel(self):
+        for name in ("a", "b", "c"):
+            with open(name, "wb") as fp:
+                fp.write("Hello!")
+        channels = []
+        def ftp_client():
+            c = PhonyFTPClient()
+            c.input_commands.append("220 Hi.")
+            for i in range(3):
+                channels.append(PhonyDataChannel(""))
+                c.push_channel(channels[-1])
+            return c
+        self.host._connect_args["ftp_client"] = ftp_client
+        self.client.input_commands.append('257 "/x" is your current location')
+        results = self.host.mput(["a", "b", "c"], workers=2,
+                                 callback=self.callback)
+        self.assertEqual(results, [None, None, None])
+        self.assertEqual(sorted(self.progress), ["a", "b", "c"])
+        self.assertEqual(
+            [dc.input_data.getvalue() for dc in channels].count("Hello!"), 3)
+        self.assertEqual(self.client.sent_commands, ["PWD"])
+
+class RateLimiterTest(unittest.TestCase):
+    def test_rate(self):
+        limiter = ftptool.RateLimiter(100000, burst=10000)
+        started = time.time()
+        limiter.consume(10000)
+        limiter.consume(20000)
+        limiter.consume(1)
+        self.assertTrue(time.time() - started >= 0.19)
+        self.assertEqual(limiter.bytes, 30001)
+
+    def test_rate_above_zero(self):
+        self.assertRaises(ValueError, ftptool.RateLimiter, 0)
+        limiter = ftptool.RateLimiter(1000)
+        def set_rate(rate):
+            limiter.rate = rate
+        self.assertRaises(ValueError, set_rate, -1)
+        self.assertEqual(limiter.rate, 1000)
+
+    def test_priority(self):
+        limiter = ftptool.RateLimiter(10000, burst=1000)
+        limiter.consume(3000)
+        order = []
+        def consume(name, priority):
+            limiter.consume(100, priority)
+            order.append(name)
+        low = threading.Thread(target=consume, args=("low", 0))
+        high = threading.Thread(target=consume, args=("high", 1))
+        low.start()
+        time.sleep(0.05)
+        high.start()
+        low.join()
+        high.join()
+        self.assertEqual(order, ["high", "low"])
+
+    def test_parent(self):
+        parent = ftptool.RateLimiter(1000000)
+        limiter = ftptool.RateLimiter(1000000, parent=parent)
+        limiter.consume(100)
+        self.assertEqual((limiter.bytes, parent.bytes), (100, 100))
+
+    def test_throttled_transfers(self):
+        client = PhonyFTPClient()
+        client.input_commands.append("220 Hi.")
+        limiter = ftptool.RateLimiter(1000000)
+        host = ftptool.FTPHost.connect("example.org",
+            ftp_client=lambda: client, rate_limiter=limiter)
+        f = host.file_proxy("/test.txt")
+        f.rate_limiter = ftptool.RateLimiter(1000000)
+        client.push_channel(PhonyDataChannel("Hello world!"))
+        client.push_channel(PhonyDataChannel(""))
+        self.assertEqual(f.download_to_str(), "Hello world!")
+        f.upload_from_str("Hello!")
+        self.assertEqual(limiter.bytes, 18)
+        self.assertEqual(f.rate_limiter.bytes, 18)
+
+class CopyTest(unittest.TestCase):
+    def setUp(self):
+        self.clients = []
+        self.hosts = [ftptool.FTPHost.connect("example.org",
+                          ftp_client=self.ftp_client)
+                      for i in range(2)]
+        self.src, self.dst = self.clients
+        for client in self.clients:
+            client.af = socket.AF_INET
+        self.f = self.hosts[0].file_proxy("/a/test.txt")
+
+    def ftp_client(self):
+        client = PhonyFTPClient()
+        client.input_commands.append("220 Hi.")
+        self.clients.append(client)
+        return client
+
+    def test_site_copy(self):
+        self.src.input_commands.extend(("350 Ready.", "250 Copied."))
+        copy = self.f.copy("/b/test.txt")
+        self.assertEqual(copy.filename, "/b/test.txt")
+        self.assertEqual(self.src.sent_commands,
+            ["SITE CPFR /a/test.txt", "SITE CPTO /b/test.txt"])
+
+    def test_fxp(self):
+        self.dst.host = "example.com"
+        self.src.input_commands.extend(("200 TYPE I.", "200 PORT OK.",
+            "150 Sending.", "226 Sent."))
+        self.dst.input_commands.extend(("200 TYPE I.",
+            "227 Entering Passive Mode (10,0,0,1,4,1).",
+            "150 Receiving.", "226 Received."))
+        self.f.copy("/b/test.txt", self.hosts[1])
+        self.assertEqual(self.src.sent_commands,
+            ["TYPE I", "PORT 10,0,0,1,4,1", "RETR /a/test.txt"])
+        self.assertEqual(self.dst.sent_commands,
+            ["TYPE I", "PASV", "STOR /b/test.txt"])
+
+    def test_fxp_fails(self):
+        self.dst.host = "example.com"
+        self.src.input_commands.extend(("200 TYPE I.", "200 PORT OK.",
+            "550 No such file."))
+        self.dst.input_commands.extend(("200 TYPE I.",
+            "227 Entering Passive Mode (10,0,0,1,4,1).",
+            "150 Receiving.", "426 Aborted.", "226 ABOR OK."))
+        self.assertRaises(ftplib.error_perm, self.f.copy, "/b/test.txt",
+                          self.hosts[1])
+        self.assertEqual(self.dst.sent_commands[-1], "ABOR")
+        self.assertEqual(self.dst.input_commands, [])
+
+    def test_move(self):
+        self.src.input_commands.extend(('257 "/a" is your current location.',
+            "350 Ready.", "250 Moved."))
+        moved = self.f.move("../b/test.txt")
+        self.assertEqual(moved.filename, "/b/test.txt")
+        self.assertEqual(self.src.sent_commands,
+            ["PWD", "RNFR /a/test.txt", "RNTO /b/test.txt"])
+
+class CompressionTest(unittest.TestCase):
+    def setUp(self):
+        self.client = PhonyFTPClient()
+        self.client.input_commands.append("220 Hi.")
+        self.host = ftptool.FTPHost.connect("example.org",
+            ftp_client=lambda: self.client, compression=9)
+        self.f = self.host.file_proxy("/test.txt")
+        self.data = "Hello world! " * 1000
+
+    def test_download(self):
+        self.client.push_features("MODE Z")
+        self.client.input_commands.extend(("200 MODE Z.", "200 Level 9."))
+        self.client.push_channel(PhonyDataChannel(zlib.compress(self.data)))
+        self.client.push_channel(PhonyDataChannel(zlib.compress(self.data)))
+        self.assertEqual(self.f.download_to_str(), self.data)
+        chunks = list(self.f.iter_chunks(blocksize=4096))
+        self.assertEqual("".join(chunks), self.data)
+        self.assertEqual(max(map(len, chunks)), 4096)
+        self.assertEqual(self.client.sent_commands, ["FEAT", "MODE Z",
+            "OPTS MODE Z LEVEL 9", "TYPE I", "RETR /test.txt", "TYPE I",
+            "RETR /test.txt"])
+
+    def test_upload_then_list(self):
+        self.client.push_features("MODE Z")
+        self.client.input_commands.extend(("200 MODE Z.", "200 Level 9."))
+        channel = PhonyDataChannel("")
+        self.client.push_channel(channel)
+        self.f.upload_from_str(self.data)
+        self.assertEqual(zlib.decompress(channel.input_data.getvalue()),
+                         self.data)
+        self.client.input_commands.append("200 MODE S.")
+        self.client.push_listing("file:foo")
+        self.assertEqual(self.host.listdir("/"), ([], ["foo"]))
+        self.assertEqual(self.client.sent_commands[-3:],
+                         ["MODE S", "TYPE A", "LIST /"])
+
+    def test_not_advertised(self):
+        self.client.push_features("MDTM")
+        self.client.push_channel(PhonyDataChannel(self.data))
+        self.assertEqual(self.f.download_to_str(), self.data)
+        self.assertEqual(self.client.sent_commands,
+                         ["FEAT", "TYPE I", "RETR /test.txt"])
+
+class ChecksumTest(unittest.TestCase):
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.filename = os.path.join(self.local, "test.txt")
+        self.client = PhonyFTPClient()
+        self.client.input_commands.append("220 Hi.")
+        self.host = ftptool.FTPHost.connect("example.org",
+            ftp_client=lambda: self.client)
+        self.f = self.host.file_proxy("/test.txt")
+        self.md5 = hashlib.md5("Hello world!").hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.local)
+
+    def test_hash(self):
+        self.client.push_features("HASH SHA-256;MD5*;CRC32")
+        self.client.input_commands.extend((
+            "213 MD5 0-12 %s /test.txt" % (self.md5.upper(),),
+            "200 SHA-256", "213 SHA-256 0-12 ab12 /test.txt"))
+        self.assertEqual(self.host.hash_algorithms,
+                         ["sha256", "md5", "crc32"])
+        self.assertEqual(self.f.checksum("md5"), self.md5)
+        self.assertEqual(self.f.checksum(), "ab12")
+        self.assertEqual(self.client.sent_commands, ["FEAT",
+            "HASH /test.txt", "OPTS HASH SHA-256", "HASH /test.txt"])
+
+    def test_x_commands(self):
+        self.client.push_features("XCRC", "XMD5")
+        self.client.input_commands.extend((
+            "251 " + self.md5.upper(), "250 /test.txt 1A2B",
+            "250 /abc def/cafe 1A2B"))
+        self.assertEqual(self.host.hash_algorithms, ["md5", "crc32"])
+        self.assertEqual(self.f.checksum(), self.md5)
+        self.assertEqual(self.f.checksum("crc32"), "00001a2b")
+        # A file name looking like a hash isn't taken for one.
+        self.assertEqual(self.host.checksum("/abc def/cafe", "crc32"),
+                         "00001a2b")
+        self.assertRaises(ValueError, self.f.checksum, "sha1")
+
+    def test_download_verified(self):
+        self.client.push_features("XMD5")
+        self.client.push_channel(PhonyDataChannel("Hello world!"))
+        self.client.input_commands.append("251 " + self.md5)
+        self.f.download_to_file(self.filename, verify=True)
+        self.client.push_channel(PhonyDataChannel("Hello world?"))
+        self.client.input_commands.append("251 " + self.md5)
+        self.assertRaises(ftptool.ChecksumError, self.f.download_to_file,
+                          self.filename, verify=True)
+
+    def test_upload_resumed_verified(self):
+        with open(self.filename, "wb") as fp:
+            fp.write("Hello world!")
+        self.client.push_features("XMD5")
+        self.client.input_commands.append("213 6")
+        channel = PhonyDataChannel("")
+        self.client.push_channel(channel)
+        self.client.input_commands.append("251 " + self.md5)
+        self.f.upload_from_file(self.filename, resume=True, verify=True)
+        self.assertEqual(channel.input_data.getvalue(), "world!")
+
+    def test_verify_unsupported(self):
+        self.client.push_features()
+        self.assertRaises(ValueError, self.f.download_to_file,
+                          self.filename, verify=True)
+        self.assertEqual(self.client.sent_commands, ["FEAT"])
+
+class SegmentedDownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.filename = os.path.join(self.local, "test.txt")
+        self.data = "".join("%02d" % (i,) for i in range(50))
+        self.clients = []
+        self.client = PhonyFTPClient()
+        self.client.input_commands.extend(("220 Hi.", "213 100"))
+        self.host = ftptool.FTPHost.connect("example.org",
+            ftp_client=lambda: self.client)
+        self.host._connect_args["ftp_client"] = self.ftp_client
+        self.f = self.host.file_proxy("/test.txt")
+        self.f.min_segment_size = 30
+
+    def tearDown(self):
+        shutil.rmtree(self.local)
+
+    def ftp_client(self):
+        client = RangeFTPClient(self.data)
+        self.clients.append(client)
+        return client
+
+    def test_segments(self):
+        self.f.download_segmented(self.filename, segments=4)
+        with open(self.filename, "rb") as fp:
+            self.assertEqual(fp.read(), self.data)
+        rests = sorted(l for c in self.clients for l in c.sent_commands
+                       if l.startswith("REST"))
+        self.assertEqual(rests, ["REST 33", "REST 66"])
+
+    def test_segments_uncompressed(self):
+        # REST offsets are into the file, so no part goes through MODE Z.
+        def ftp_client():
+            client = RangeFTPClient(self.data, ("MODE Z",))
+            self.clients.append(client)
+            return client
+        self.host._connect_args["ftp_client"] = ftp_client
+        self.host.compression = 9
+        self.f.download_segmented(self.filename, segments=4)
+        with open(self.filename, "rb") as fp:
+            self.assertEqual(fp.read(), self.data)
+        self.assertFalse([l for c in self.clients for l in c.sent_commands
+                          if l.startswith("MODE")])
+
+    def test_part_retried(self):
+        def ftp_client():
+            client = self.ftp_client()
+            if len(self.clients) == 1:
+                client.data = client.data[:40]
+            return client
+        self.host._connect_args["ftp_client"] = ftp_client
+        self.f.retry_delay = 0
+        self.f.download_segmented(self.filename, segments=2, retries=1)
+        with open(self.filename, "rb") as fp:
+            self.assertEqual(fp.read(), self.data)
+
+    def test_part_fails(self):
+        self.host._connect_args["ftp_client"] = lambda: RangeFTPClient("")
+        self.assertRaises(EOFError, self.f.download_segmented, self.filename)
+        # Not left at full size, to pass for complete.
+        self.assertEqual(os.path.getsize(self.filename), 0)
+
+    def test_part_fails_resumed(self):
+        def ftp_client():
+            client = self.ftp_client()
+            if len(self.clients) == 2:
+                client.data = ""
+            return client
+        self.host._connect_args["ftp_client"] = ftp_client
+        self.assertRaises(EOFError, self.f.download_segmented, self.filename,
+                          segments=2)
+        with open(self.filename, "rb") as fp:
+            self.assertEqual(fp.read(), self.data[:50])
+
+class TreeIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.index_file = os.path.join(self.local, "index.db")
+        self.tree = {"/": ("dir", 100), "/a": ("dir", 100),
+                     "/a/x": ("file", 100), "/b": ("dir", 100),
+                     "/b/c": ("dir", 100), "/b/c/y": ("file", 100)}
+        self.client = MLSDTreeFTPClient(self.tree)
+        self.host = ftptool.FTPHost.connect("example.org",
+            ftp_client=lambda: self.client)
+
+    def tearDown(self):
+        shutil.rmtree(self.local)
+
+    def changes(self, **kwds):
+        del self.client.dialogue[:]
+        index = ftptool.TreeIndex(self.index_file)
+        try:
+            return [(d, [e.name for e in a], [e.name for e in r],
+                     [e.name for e in m])
+                    for (d, a, r, m) in self.host.walk_changes("/", index,
+                                                               **kwds)]
+        finally:
+            index.close()
+
+    def listed(self):
+        return [l[5:] for l in self.client.sent_commands
+                if l.startswith("MLSD")]
+
+    def test_walk_changes(self):
+        self.assertEqual(self.changes(), [("/", ["a", "b"], [], []),
+            ("/a", ["x"], [], []), ("/b", ["c"], [], []),
+            ("/b/c", ["y"], [], [])])
+        # Nothing changed, and only the times are looked at.
+        self.assertEqual(self.changes(), [])
+        self.assertEqual(self.listed(), [])
+        self.assertEqual([l for l in self.client.sent_commands
+                          if l.startswith("MLST")],
+                         ["MLST /", "MLST /a", "MLST /b", "MLST /b/c"])
+        del self.tree["/a/x"]
+        self.tree["/a"] = ("dir", 200)
+        self.tree["/b/c/z"] = ("file", 200)
+        self.tree["/b/c"] = ("dir", 200)
+        self.assertEqual(self.changes(), [("/a", [], ["x"], []),
+                                          ("/b/c", ["z"], [], [])])
+        self.assertEqual(self.listed(), ["/a", "/b/c"])
+        # Removing a directory forgets what was in it.
+        for path in ("/b", "/b/c", "/b/c/y", "/b/c/z"):
+            del self.tree[path]
+        self.tree["/"] = ("dir", 300)
+        # The time of /a changed since / was last listed.
+        self.assertEqual(self.changes(), [("/", [], ["b"], ["a"])])
+        self.assertEqual(len(ftptool.TreeIndex(self.index_file)), 2)
+
+    def test_skip_unchanged(self):
+        self.changes()
+        self.tree["/b/c/z"] = ("file", 200)
+        self.tree["/b/c"] = ("dir", 200)
+        self.assertEqual(self.changes(skip_unchanged=True), [])
+        self.assertEqual(self.client.sent_commands, ["MLST /"])
+        self.tree["/b"] = ("dir", 200)
+        self.tree["/"] = ("dir", 200)
+        self.assertEqual(self.changes(skip_unchanged=True),
+                         [("/", [], [], ["b"]), ("/b", [], [], ["c"]),
+                          ("/b/c", ["z"], [], [])])
+        self.assertEqual(self.listed(), ["/", "/b", "/b/c"])
+
+class RemoteFileTest(unittest.TestCase):
+    def setUp(self):
+        self.data = "".join("%02d" % (i,) for i in range(50))
+        self.client = RangeFTPClient(self.data)
+        self.host = ftptool.FTPHost.connect("example.org",
+            ftp_client=lambda: self.client)
+
+    def rests(self):
+        return [l for l in self.client.sent_commands
+                if l.startswith(("REST", "RETR"))]
+
+    def test_read_and_seek(self):
+        f = self.host.file_proxy("/test.txt").open(
+            block_size=10, readahead=2, cache_blocks=4)
+        self.assertEqual(f.seek(-5, os.SEEK_END), 95)
+        self.assertEqual(f.read(), self.data[95:])
+        self.assertEqual(f.read(), "")
+        f.seek(0)
+        self.assertEqual(f.read(3), self.data[:3])
+        # Reading on fetches two blocks more.
+        self.assertEqual(f.read(20), self.data[3:23])
+        self.assertEqual(f.tell(), 23)
+        self.assertEqual(f.read(27), self.data[23:50])
+        self.assertEqual(self.rests(), ["REST 90", "RETR /test.txt",
+            "RETR /test.txt", "REST 10", "RETR /test.txt"])
+        self.assertEqual(f.bytes_fetched, 60)
+        # Block 0 has been evicted since.
+        f.seek(5)
+        self.assertEqual(f.read(10), self.data[5:15])
+        self.assertEqual(self.rests()[-1], "RETR /test.txt")
+        f.close()
+        self.assertRaises(ValueError, f.read)
+
+    def test_zipfile(self):
+        fp = StringIO()
+        with zipfile.ZipFile(fp, "w") as z:
+            z.writestr("a.txt", "a" * 1000)
+            z.writestr("b.txt", "Hello!")
+        self.client.data = fp.getvalue()
+        f = self.host.file_proxy("/test.zip").open(block_size=64)
+        with zipfile.ZipFile(f) as z:
+            self.assertEqual(z.namelist(), ["a.txt", "b.txt"])
+            self.assertEqual(z.read("b.txt"), "Hello!")
+        self.assertTrue(f.bytes_fetched < len(self.client.data))
+
+class ListEntryTest(unittest.TestCase):
+    def test_parse_list_entry(self):
+        e = ftptool._parse_list_entry(
+            "-rwsr-x--T    1 1000     users       25966 Feb 18  2009 a b")
+        self.assertEqual(e, ftptool.FTPEntry("a b", "file", 25966,
+            1234915200, 0o5750))
+        e = ftptool._parse_list_entry(
+            "lrwxrwxrwx    1 1000     users         306 Feb 24 13:59 "
+            "hu nhu -> /non/abc ah")
+        self.assertEqual((e.name, e.type, e.target, e.mode),
+            ("hu nhu", "link", "/non/abc ah", 0o777))
+
+    def test_parse_list_text(self):
+        listing = ftptool._parse_list_text(
+            "drwxr-xr-x    2 1000     users        4096 Feb 18  2009 sub\r\n"
+            "-rwsr-x--T    1 1000     users       25966 Feb 18  2009 a b\r\n"
+            "lrwxrwxrwx    1 1000     users         306 Feb 24  2009 "
+            "hu nhu -> /non/abc ah\r\n"
+            # No group column.
+            "-rw-r--r--    1 1000       12 Feb 18  2009 short\r\n")
+        self.assertEqual(listing.names, ["sub", "a b", "hu nhu", "short"])
+        self.assertEqual(listing.types, ["dir", "file", "link", "file"])
+        self.assertEqual(listing.sizes, [4096, 25966, 306, None])
+        self.assertEqual(listing.names_of("file"), ["a b", "short"])
+        entries = list(listing)
+        self.assertEqual(entries[1], ftptool.FTPEntry("a b", "file", 25966,
+            1234915200, 0o5750))
+        self.assertEqual(entries[2].target, "/non/abc ah")
+        self.assertEqual(entries[3].name, "short")
+        self.assertRaises(ValueError, ftptool._parse_list_text,
+                          "total 12\r\n")
+        # Names without spaces take the quick way.
+        listing = ftptool._parse_list_text(
+            "drwxr-xr-x    2 1000     users        4096 Feb 18  2009 sub\r\n"
+            "-rwsr-x--T    1 1000     users       25966 Feb 18  2009 a\r\n")
+        self.assertEqual(list(listing), [
+            ftptool.FTPEntry("sub", "dir", 4096, 1234915200, 0o755),
+            ftptool.FTPEntry("a", "file", 25966, 1234915200, 0o5750)])
+
+    def test_parse_list_mtime(self):
+        # 2010-01-05 00:00:00 UTC
+        now = 1262649600
+        self.assertEqual(ftptool._parse_list_mtime("Jan", "3", "01:27", now),
+            1262482020)
+        # Way in the future, so must be last year.
+        self.assertEqual(ftptool._parse_list_mtime("Dec", "10", "16:18", now),
+            1260461880)
+        self.assertEqual(ftptool._parse_list_mtime("Foo", "10", "16:18", now),
+            None)
+
+class IncrementalMirrorTest(unittest.TestCase):
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.client = PhonyFTPClient()
+        self.client.input_commands.append("220 Hi.")
+        self.host = ftptool.FTPHost.connect("example.org",
+            ftp_client=lambda: self.client)
+        # 2009-02-18 12:00:00 UTC
+        self.mtime = 1234958400
+        with open(os.path.join(self.local, "a"), "wb") as fp:
+            fp.write("Hello!")
+        os.utime(os.path.join(self.local, "a"), (self.mtime, self.mtime))
+
+    def tearDown(self):
+        shutil.rmtree(self.local)
+
+    def test_mirror_to_local_incremental(self):
+        self.client.push_features()
+        self.client.push_listing("file:a file:b")
+        # The listing says 123 bytes, so a has changed.
+        self.client.push_channel(PhonyDataChannel("Hello!"))
+        self.client.input_commands.append(
+            "213 20090218120000")  # MDTM /src/a
+        self.client.push_channel(PhonyDataChannel("New!"))
+        self.client.input_commands.append(
+            "213 20090218130000")  # MDTM /src/b
+        stats = self.host.mirror_to_local("/src", self.local,
+                                          incremental=True)
+        self.assertEqual((stats.files, stats.skipped), (2, 0))
+        st = os.stat(os.path.join(self.local, "b"))
+        self.assertEqual((st.st_size, st.st_mtime), (4, self.mtime + 3600))
+        self.assertEqual(["RETR /src/a", "MDTM /src/a", "RETR /src/b",
+                          "MDTM /src/b"],
+            [l for d, l in self.client.dialogue if d == ">" and
+             l.split()[0] in ("SIZE", "MDTM", "RETR")])
+
+    def test_mirror_to_local_incremental_no_mdtm(self):
+        with open(os.path.join(self.local, "a"), "wb") as fp:
+            fp.write("x" * 123)
+        self.client.push_features()
+        self.client.push_listing("file:a file:b")
+        # Without MDTM, the size of a is all there is to go by.
+        self.client.input_commands.append("502 Command not implemented.")
+        self.client.push_channel(PhonyDataChannel("New!"))
+        self.client.input_commands.append("502 Command not implemented.")
+        stats = self.host.mirror_to_local("/src", self.local,
+                                          incremental=True)
+        self.assertEqual((stats.files, stats.skipped, stats.errors),
+                         (1, 1, []))
+        with open(os.path.join(self.local, "b"), "rb") as fp:
+            self.assertEqual(fp.read(), "New!")
+        self.assertEqual(self.client.input_commands, [])
+
+    def test_mirror_to_local_incremental_mlsd(self):
+        # With MLSD, the listing has all there is to know.
+        self.client.push_features("MLST type*;size*;modify*;")
+        self.client.push_channel(PhonyDataChannel(
+            "type=file;size=6;modify=20090218120000; a\r\n"
+            "type=file;size=4;modify=20090218130000; b\r\n"))
+        self.client.push_channel(PhonyDataChannel("New!"))
+        stats = self.host.mirror_to_local("/src", self.local,
+                                          incremental=True)
+        self.assertEqual((stats.files, stats.skipped), (1, 1))
+        st = os.stat(os.path.join(self.local, "b"))
+        self.assertEqual((st.st_size, st.st_mtime), (4, self.mtime + 3600))
+        self.assertEqual(["FEAT", "TYPE A", "MLSD /src", "TYPE I",
+                          "RETR /src/b"],
+            [l for d, l in self.client.dialogue if d == ">"])
+
+    def test_mirror_to_remote_dry_run(self):
+        with open(os.path.join(self.local, "b"), "wb") as fp:
+            fp.write("Hello!")
+        self.client.input_commands.extend((
+            "213 6",  # SIZE /dst/a
+            "213 20090218120000",  # MDTM /dst/a
+            "550 No such file.",  # SIZE /dst/b
+            "200 TYPE is now 8-bit binary",  # Could be ASCII mode, retry.
+            "550 No such file."))
+        stats = self.host.mirror_to_remote(self.local, "/dst",
+                                           incremental=True, dry_run=True)
+        self.assertEqual((stats.files, stats.skipped), (0, 1))
+        self.assertEqual(stats.pending,
+            [(os.path.join(self.local, "b"), "/dst/b")])
+        self.assertEqual(self.client.input_commands, [])
+
+class MirrorJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.destination = os.path.join(self.local, "dst")
+        os.mkdir(self.destination)
+        self.journal_file = os.path.join(self.local, "journal.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.local)
+
+    def test_mirror_to_local_resumed(self):
+        tree = {"/src": ("dir", 100), "/src/a": ("file", 100),
+                "/src/d": ("dir", 100), "/src/d/b": ("file", 100),
+                "/src/e": ("dir", 100), "/src/e/c": ("file", 100),
+                "/src/f": ("dir", 100)}
+        client = MLSDTreeFTPClient(tree)
+        client.broken.add("/src/e/c")
+        host = ftptool.FTPHost.connect("example.org",
+            ftp_client=lambda: client)
+        journal = ftptool.MirrorJournal(self.journal_file, batch_size=1000)
+        self.assertRaises(ftplib.error_perm, host.mirror_to_local, "/src",
+                          self.destination, journal=journal)
+        journal.close()
+        # What was done is on disk, d included as it was done with.
+        journal = ftptool.MirrorJournal(self.journal_file)
+        self.assertEqual(len(journal), 3)
+        for name in ("/src/a", "/src/d", "/src/d/b"):
+            self.assertTrue(name in journal)
+        client.broken.clear()
+        del client.dialogue[:]
+        stats = host.mirror_to_local("/src", self.destination,
+                                     journal=journal)
+        self.assertEqual(stats.files, 1)
+        self.assertEqual([l for l in client.sent_commands
+                          if l.startswith(("MLSD", "RETR"))],
+                         ["MLSD /src", "MLSD /src/e", "RETR /src/e/c",
+                          "MLSD /src/f"])
+        with open(os.path.join(self.destination, "e", "c"), "rb") as fp:
+            self.assertEqual(fp.read(), "/src/e/c")
+        # All done, so the next run starts over.
+        self.assertEqual(len(journal), 0)
+
+    def test_mirror_to_remote_resumed(self):
+        source = os.path.join(self.local, "src")
+        os.makedirs(os.path.join(source, "sub"))
+        for name in ("a", "c", os.path.join("sub", "b")):
+            with open(os.path.join(source, name), "wb") as fp:
+                fp.write("Hello!")
+        client = PhonyFTPClient()
+        client.input_commands.append("220 Hi.")
+        host = ftptool.FTPHost.connect("example.org",
+            ftp_client=lambda: client)
+        journal = ftptool.MirrorJournal(self.journal_file)
+        journal.add(os.path.join(source, "a"))
+        journal.add(os.path.join(source, "sub"))
+        dc = PhonyDataChannel("")
+        client.push_channel(dc)
+        stats = host.mirror_to_remote(source, "/dst", journal=journal)
+        self.assertEqual((stats.files, stats.errors), (1, []))
+        self.assertEqual(client.sent_commands, ["TYPE I", "STOR /dst/c"])
+        self.assertEqual(len(journal), 0)
+
+class ParallelMirrorTest(unittest.TestCase):
+    def setUp(self):
+        self.destination = tempfile.mkdtemp()
+        self.client = PhonyFTPClient()
+        self.client.input_commands.append("220 Hi.")
+        self.worker_clients = []
+        clients = [self.client]
+        def ftp_client():
+            if clients:
+                return clients.pop(0)
+            c = PhonyFTPClient()
+            c.input_commands.append("220 Hi.")
+            self.worker_clients.append(c)
+            # Make the first worker connection drop on its first command.
+            if len(self.worker_clients) > 1:
+                for i in range(3):
+                    c.push_channel(PhonyDataChannel("Hello!"))
+            return c
+        self.host = ftptool.FTPHost.connect("example.org",
+            ftp_client=ftp_client)
+
+    def tearDown(self):
+        shutil.rmtree(self.destination)
+
+    def test_mirror_to_local_parallel(self):
+        self.client.push_features()
+        self.client.push_listing("dir:sub file:a file:b")
+        self.client.push_listing("file:c")  # <- dir:sub
+        stats = self.host.mirror_to_local("/src", self.destination, workers=2)
+        # One transfer failed along with its connection, which got replaced.
+        self.assertEqual(stats.files, 2)
+        self.assertEqual(stats.bytes, 12)
+        self.assertEqual(len(stats.errors), 1)
+        self.assertTrue(isinstance(stats.errors[0][1], EOFError))
+        self.assertTrue(len(self.worker_clients) >= 2)
+        self.assertTrue(os.path.isdir(os.path.join(self.destination, "sub")))
+        self.assertEqual(["LIST /src", "LIST /src/sub"],
+            [l for d, l in self.client.dialogue if l.startswith("LIST")])
+
+    def test_mirror_to_remote_parallel(self):
+        os.makedirs(os.path.join(self.destination, "sub", "deeper"))
+        for name in ("a", os.path.join("sub", "b")):
+            with open(os.path.join(self.destination, name), "wb") as fp:
+                fp.write("Hello!")
+        self.client.input_commands.extend((
+            '257 Directory created.',
+            '550 It exists etc.'))
+        stats = self.host.mirror_to_remote(self.destination, "/dst",
+                                           workers=2)
+        # The directories are created first, without waiting for replies.
+        self.assertEqual(self.client.dialogue,
+            [("<", "220 Hi."),
+             (">", "MKD /dst/sub"),
+             (">", "MKD /dst/sub/deeper"),
+             ("<", "257 Directory created."),
+             ("<", "550 It exists etc.")])
+        self.assertEqual(stats.files, 1)
+        self.assertEqual(stats.bytes, 6)
+        self.assertEqual(len(stats.errors), 1)
+        stored = [l for c in self.worker_clients for d, l in c.dialogue
+                  if l.startswith("STOR")]
+        failed = stats.errors[0][0][len(self.destination):]
+        self.assertEqual(sorted(stored + ["STOR /dst" + failed]),
+            ["STOR /dst/a", "STOR /dst/sub/b"])
+
 if __name__ == "__main__":
     import doctest
     import sys
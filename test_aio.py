@@ -0,0 +1,163 @@
+"""Tests for aioftptool, against the FTP server of bench.py. Python 3.7 and
+later only.
+"""
+
+import os
+import errno
+import asyncio
+import ftplib
+import shutil
+import filecmp
+import tempfile
+import unittest
+
+import bench
+import aioftptool
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 10))
+
+class AsyncTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.local = tempfile.mkdtemp()
+        self.server = bench.FTPServer(self.root).start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.local)
+
+    async def connect(self):
+        return await aioftptool.AsyncFTPHost.connect("127.0.0.1",
+            port=self.server.port, user="user", password="secret")
+
+    def test_listdir(self):
+        bench.make_tree(self.root, 2, 3, 10)
+        async def listdir():
+            host = await self.connect()
+            try:
+                return (await host.listdir("/"),
+                        await host.listdir("/dir001", entries=True))
+            finally:
+                await host.try_quit()
+        top, entries = run(listdir())
+        self.assertEqual(top, (["dir000", "dir001"], []))
+        subdirs, files = entries
+        self.assertEqual(subdirs, [])
+        self.assertEqual([(e.name, e.type, e.size) for e in files],
+                         [("file%04d" % (i,), "file", 10) for i in range(3)])
+
+    def test_upload_download(self):
+        filename = os.path.join(self.local, "a")
+        with open(filename, "wb") as fp:
+            fp.write(b"Hello world!")
+        async def transfer():
+            host = await self.connect()
+            try:
+                f = await host.file_proxy("/a")
+                await f.upload_from_str(b"Hello")
+                await f.upload_from_file(filename, resume=True)
+                data = await f.download_to_str()
+                target = os.path.join(self.local, "b")
+                with open(target, "wb") as fp:
+                    fp.write(b"Hello")
+                await f.download_to_file(target, resume=True)
+                with open(target, "rb") as fp:
+                    return data, fp.read(), await f.size()
+            finally:
+                await host.try_quit()
+        self.assertEqual(run(transfer()),
+                         (b"Hello world!", b"Hello world!", 12))
+
+    def test_local_error_partway(self):
+        # The connection is still in step after a local file fails.
+        with open(os.path.join(self.root, "a"), "wb") as fp:
+            fp.write(b"x" * 300000)
+        class FullDisk(object):
+            def write(self, data):
+                raise OSError(errno.ENOSPC, "No space left on device")
+        class BadFile(object):
+            def read(self, size):
+                raise OSError(errno.EIO, "Input/output error")
+        async def transfer():
+            host = await self.connect()
+            try:
+                f = await host.file_proxy("/a")
+                with self.assertRaises(OSError):
+                    await f.download(FullDisk())
+                size = await f.size()
+                with self.assertRaises(OSError):
+                    await f.upload(BadFile())
+                return size, await host.listdir("/")
+            finally:
+                await host.try_quit()
+        self.assertEqual(run(transfer()), (300000, ([], ["a"])))
+
+    def test_mirror_parallel(self):
+        bench.make_tree(self.root, 3, 5, 1000)
+        destination = os.path.join(self.local, "copy")
+        os.mkdir(destination)
+        async def mirror():
+            host = await self.connect()
+            try:
+                down = await host.mirror_to_local("/", destination,
+                                                  workers=3)
+                await host.mkdir("/up")
+                up = await host.mirror_to_remote(destination, "/up",
+                                                 workers=3)
+                return down, up
+            finally:
+                await host.try_quit()
+        down, up = run(mirror())
+        self.assertEqual((down.files, down.errors), (15, []))
+        self.assertEqual((up.files, up.errors), (15, []))
+        for name in ("dir000", "dir002"):
+            cmp = filecmp.dircmp(os.path.join(self.root, name),
+                                 os.path.join(self.root, "up", name))
+            self.assertEqual((cmp.left_only, cmp.right_only,
+                              cmp.diff_files), ([], [], []))
+
+    def test_mirror_failed_transfer(self):
+        bench.make_tree(self.root, 1, 3, 100)
+        destination = os.path.join(self.local, "copy")
+        os.mkdir(destination)
+        download_one = aioftptool._download_one
+        async def flaky(host, transfer, incremental, dry_run):
+            if transfer[0].endswith("file0001"):
+                raise ftplib.error_temp("421 Go away.")
+            return await download_one(host, transfer, incremental, dry_run)
+        async def mirror():
+            host = await self.connect()
+            try:
+                return await host.mirror_to_local("/", destination,
+                                                  workers=2)
+            finally:
+                await host.try_quit()
+        aioftptool._download_one = flaky
+        try:
+            stats = run(mirror())
+        finally:
+            aioftptool._download_one = download_one
+        self.assertEqual(stats.files, 2)
+        self.assertEqual([name for (name, e) in stats.errors],
+                         ["dir000/file0001"])
+
+    def test_workers_error(self):
+        # An error with the queue full still gets out.
+        stats = aioftptool.TransferStats()
+        async def hang(host, transfer, incremental, dry_run):
+            await asyncio.Event().wait()
+        async def fill():
+            host = await self.connect()
+            try:
+                async with aioftptool._Workers(host, 2, stats) as pool:
+                    for i in range(6):
+                        await pool.put(hang, (str(i),), False, False)
+                    raise RuntimeError("stop")
+            finally:
+                await host.try_quit()
+        self.assertRaises(RuntimeError, run, fill())
+
+if __name__ == "__main__":
+    unittest.main()